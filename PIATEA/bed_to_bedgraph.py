@@ -7,13 +7,14 @@ Convert BED to BEDGRAPH by counting the number of BED segments overlapping each
 Uses 0-based, half-open coordinates for consistency with the UCSC browser
 (see http://genomewiki.ucsc.edu/index.php/Coordinate_Transforms).
 
-Note: This may use a lot of memory.
+Coverage is computed from the segment ends (see bedgraph.py), so memory and time grow with the number of
+BED segments rather than with their total length.
 '''
 
 from __future__ import print_function
 import sys
-import array
 import argparse
+import bedgraph
 
 def parse_cl():
     parser = argparse.ArgumentParser()
@@ -23,34 +24,20 @@ def parse_cl():
                         help='LASTZ output file to convert [default: STDOUT]')
     parser.add_argument('--subtract_1', action='store_true', default=False,
                         help='subtract 1 from all positions (to eliminate self-alignment) [default: False]')
+    parser.add_argument('--cpus', type=int, default=1,
+                        help='number of chromosomes to process in parallel [default: 1]')
     return parser.parse_args()
 
+def chromosome_coverage(task):
+    (chrom, starts, ends, subtract_1) = task
+    (run_starts, run_ends, counts) = bedgraph.coverage(starts, ends)
+    if subtract_1:
+        counts = counts - 1
+    return bedgraph.format_runs(chrom, run_starts, run_ends, counts, '%i')
+
 if __name__ == '__main__':
     
     args = parse_cl()
-    counts = {}
-    
-    for line in args.infile:
-        if '#' == line[0]:              # ignore comment lines
-            continue
-        (chrom, start, end) = (line.split())[0:3]
-        start = int(start); end = int(end)
-        if chrom not in counts:
-            counts[chrom] = array.array('I')  # unsigned int (long)
-        if len(counts[chrom]) < end:
-            counts[chrom].extend([0]*(end-len(counts[chrom])))
-        for i in range(start,end):
-            counts[chrom][i] = counts[chrom][i]+1
-    
-    for chrom in counts:
-        a = counts[chrom]
-        i = 0
-        x = a[i]
-        for j in range(len(a)):
-            if x != a[j] or len(a)-1 == j:
-                if args.subtract_1: x=x-1
-                if x > 0:
-                    print('%s\t%i\t%i\t%i' % (chrom,i,j,x), file=args.outfile)
-                i = j
-                x = a[i]
-    
\ No newline at end of file
+    intervals = bedgraph.read_intervals(args.infile)
+    tasks = [(chrom, starts, ends, args.subtract_1) for (chrom, (starts, ends)) in intervals.items()]
+    bedgraph.map_chromosomes(chromosome_coverage, tasks, args.outfile, args.cpus)
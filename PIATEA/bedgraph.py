@@ -0,0 +1,244 @@
+#!/usr/bin/env python
+
+'''
+Shared BED/BedGraph coverage code for the PIATEA scripts.
+
+Coverage is computed by an event sweep rather than per base: each interval adds its weight at its start
+and subtracts it at its end, and a cumulative sum over the sorted event positions gives the value of each
+run between consecutive positions. Nothing is materialized per base, so time and memory depend on the
+number of intervals, not on their lengths.
+
+BedGraph tracks are held per chromosome as runs (Track). Per-base operations are applied a chunk at a
+time (Track.map), so only CHUNK_LENGTH bases plus a margin are ever expanded, and the results are
+run-length encoded again before the next chunk. Chromosomes are independent, and map_chromosomes() runs
+a per-chromosome function on a process pool.
+
+Uses 0-based, half-open coordinates for consistency with the UCSC browser
+(see http://genomewiki.ucsc.edu/index.php/Coordinate_Transforms).
+'''
+
+from __future__ import print_function
+import sys
+import array
+import collections
+import multiprocessing
+import numpy
+
+CHUNK_LENGTH = 1 << 20                                                      # bases expanded at a time by Track.map
+
+def is_header(line):
+    return line[0] == '#' or line[0:5] == 'track' or line[0:7] == 'browser'
+
+def read_intervals(infile, with_values=False, warn=False):
+    '''
+    Read BED intervals (or, with_values, BedGraph intervals and their values), grouped by chromosome in order
+    of first appearance. Returns an OrderedDict: chrom -> (starts, ends) or (starts, ends, values) as NumPy
+    arrays. Header lines are ignored (with a warning if warn), as are empty intervals.
+    '''
+    columns = collections.OrderedDict()
+    for line in infile:
+        if is_header(line):
+            if warn:
+                print('WARNING: Ignoring line: '+line.rstrip('\n'), file=sys.stderr)
+            continue
+        fields = line.split()
+        (chrom, start, end) = fields[0:3]
+        start = int(start); end = int(end)
+        if end <= start:
+            continue
+        if chrom not in columns:
+            columns[chrom] = (array.array('l'), array.array('l'), array.array('d'))
+        columns[chrom][0].append(start)
+        columns[chrom][1].append(end)
+        if with_values:
+            columns[chrom][2].append(float(fields[3]))
+    result = collections.OrderedDict()
+    for chrom in columns:
+        (starts, ends, values) = [numpy.array(column) for column in columns[chrom]]
+        result[chrom] = (starts, ends, values) if with_values else (starts, ends)
+    return result
+
+def coverage(starts, ends, weights=None, dtype=numpy.float64):
+    '''
+    Sum of weights (default 1) of the intervals [starts, ends) covering each base, as runs of equal value.
+    Returns (run_starts, run_ends, run_values), covering [min(starts), max(ends)) without gaps; bases not
+    covered by any interval have value 0. Weights are added in interval order and each partial sum is
+    rounded to dtype, as when accumulating into a per-base array of that type.
+    '''
+    positions = numpy.concatenate((starts, ends))
+    if weights is None:
+        counts = numpy.concatenate((numpy.ones(len(starts), dtype=numpy.int64), -numpy.ones(len(ends), dtype=numpy.int64)))
+        order = numpy.argsort(positions, kind='mergesort')
+        (positions, first) = numpy.unique(positions[order], return_index=True)
+        values = numpy.cumsum(numpy.add.reduceat(counts[order], first))
+    else:
+        # A running sum of +weight/-weight would leave rounding residue behind each interval, so instead add
+        # up the weights of the intervals covering each run, one layer of overlap at a time (for BedGraph
+        # input there is usually only one).
+        positions = numpy.unique(positions)
+        first = numpy.searchsorted(positions, starts)
+        counts = numpy.searchsorted(positions, ends) - first                    # runs covered by each interval
+        interval = numpy.repeat(numpy.arange(len(starts)), counts)
+        run = numpy.arange(len(interval)) - numpy.repeat(numpy.cumsum(counts) - counts, counts) + first[interval]
+        order = numpy.argsort(run, kind='mergesort')
+        (run, interval) = (run[order], interval[order])
+        layer = numpy.arange(len(run)) - numpy.searchsorted(run, run)           # how many earlier intervals cover the run
+        values = numpy.zeros(len(positions), dtype=dtype)
+        for n in range(layer.max() + 1 if len(layer) else 0):
+            selected = layer == n
+            values[run[selected]] = values[run[selected]] + weights[interval[selected]]
+    return merge_runs(positions[:-1], positions[1:], values[:-1])
+
+def differ(a, b):
+    '''a != b elementwise, except that NaN (no value) equals NaN, so that runs without a value merge.'''
+    return (a != b) & ~(numpy.isnan(a) & numpy.isnan(b))
+
+def merge_runs(run_starts, run_ends, run_values):
+    '''Merge adjacent runs (which must be contiguous) of equal value.'''
+    if len(run_values) == 0:
+        return (run_starts, run_ends, run_values)
+    changes = numpy.concatenate(([True], differ(run_values[1:], run_values[:-1])))
+    last = numpy.concatenate((changes[1:], [True]))
+    return (run_starts[changes], run_ends[last], run_values[changes])
+
+def read_tracks(infile):
+    '''
+    Read a BedGraph file into one Track per chromosome, in order of first appearance. Values of overlapping
+    intervals are summed; values are single precision, as in the per-base arrays the scripts used before.
+    '''
+    tracks = collections.OrderedDict()
+    intervals = read_intervals(infile, with_values=True, warn=True)
+    for chrom in intervals:
+        (starts, ends, values) = intervals[chrom]
+        (run_starts, run_ends, run_values) = coverage(starts, ends, values, numpy.float32)
+        tracks[chrom] = Track(run_starts, run_ends, run_values)
+    return tracks
+
+
+class Track():
+    '''
+    Values of one chromosome as contiguous runs [starts[i], ends[i]) of value values[i], covering
+    [0, length); length is the end of the last BedGraph interval.
+    '''
+
+    def __init__(self, starts, ends, values):
+        if len(starts) and starts[0] > 0:                                       # bases before the first interval are 0
+            ends = numpy.concatenate((starts[:1], ends))
+            starts = numpy.concatenate(([0], starts))
+            values = numpy.concatenate(([0], values)).astype(values.dtype)
+        self.starts = starts
+        self.ends = ends
+        self.values = values
+        self.length = int(ends[-1]) if len(ends) else 0
+
+    def __len__(self):
+        return self.length
+
+    def to_array(self, start, end):
+        '''Per-base values from start to end (clipped to [0, length)) as a NumPy array.'''
+        start = max(start, 0)
+        end = min(end, self.length)
+        if end <= start:
+            return numpy.zeros(0, dtype=self.values.dtype)
+        first = numpy.searchsorted(self.ends, start, 'right')
+        last = numpy.searchsorted(self.starts, end, 'left')
+        lengths = numpy.minimum(self.ends[first:last], end) - numpy.maximum(self.starts[first:last], start)
+        return numpy.repeat(self.values[first:last], lengths)
+
+    @staticmethod
+    def from_array(values, offset=0):
+        '''Run-length encode per-base values starting at offset.'''
+        changes = numpy.flatnonzero(differ(values[1:], values[:-1])) + 1
+        starts = numpy.concatenate(([0], changes)) if len(values) else changes
+        ends = numpy.concatenate((changes, [len(values)])) if len(values) else changes
+        return (starts + offset, ends + offset, values[starts])
+
+    def map(self, function, left=0, right=0, chunk_length=CHUNK_LENGTH):
+        '''
+        Apply a vectorized per-base function a chunk at a time, returning a new Track of the same length.
+        function(values, offset, start, end) gets the values of [start-left, end+right), clipped to the
+        track, beginning at base offset, and returns the results for bases [start, end).
+        '''
+        pieces = []
+        for start in range(0, self.length, chunk_length):
+            end = min(start + chunk_length, self.length)
+            offset = max(start - left, 0)
+            results = function(self.to_array(offset, end + right), offset, start, end)
+            pieces.append(Track.from_array(results, start))
+        if not pieces:
+            return Track(self.starts, self.ends, self.values)
+        (starts, ends, values) = merge_runs(*[numpy.concatenate(columns) for columns in zip(*pieces)])
+        return Track(starts, ends, values)
+
+    def format(self, chrom, value_format='%.1f', keep='positive'):
+        '''BedGraph lines for the runs selected by keep (see format_runs), as one string.'''
+        return format_runs(chrom, self.starts, self.ends, self.values, value_format, keep)
+
+    def write(self, outfile, chrom, value_format='%.1f', keep='positive'):
+        '''Write the runs selected by keep (see format_runs) as BedGraph lines.'''
+        outfile.write(self.format(chrom, value_format, keep))
+
+
+def window_sums(values, starts, ends, block_length):
+    '''
+    Sums of values[starts[k]:ends[k]] for every k (0 if empty), for windows no longer than block_length. The cumulative
+    sums restart every block_length bases, so the rounding error of each sum depends only on the values
+    of the (at most two) blocks its window touches, however long the chromosome is.
+    '''
+    blocks = numpy.concatenate((values, numpy.zeros(-len(values) % block_length, dtype=values.dtype)))
+    cumulative = numpy.cumsum(blocks.reshape(-1, block_length), axis=1).ravel()
+    cumulative = numpy.concatenate(([0], cumulative))                           # cumulative[i]: block's sum up to and including i-1
+    (first, last) = (starts // block_length, (ends - 1) // block_length)
+    head = numpy.where(starts % block_length == 0, 0, cumulative[starts])        # the part of the first block before the window
+    tail = cumulative[ends]
+    total = cumulative[(first + 1) * block_length]
+    sums = numpy.where(first == last, tail - head, total - head + tail)
+    return numpy.where(ends > starts, sums, 0)
+
+def block_sums(values, block_length):
+    '''Sums of values over consecutive blocks of block_length bases.'''
+    blocks = numpy.concatenate((values, numpy.zeros(-len(values) % block_length, dtype=values.dtype)))
+    return blocks.reshape(-1, block_length).sum(axis=1)
+
+def format_runs(chrom, run_starts, run_ends, run_values, value_format='%i', keep='positive'):
+    '''
+    BedGraph lines, as one string, for the runs with value > 0 (keep='positive'), value != 0 ('nonzero')
+    or all runs ('all'). Runs without a value (NaN, or any other non-finite value) are never written.
+    '''
+    if keep == 'positive':
+        keep = run_values > 0
+    elif keep == 'nonzero':
+        keep = run_values != 0
+    elif keep == 'all':
+        keep = numpy.ones(len(run_values), dtype=bool)
+    else:
+        raise ValueError('keep must be positive, nonzero or all, not ' + repr(keep))
+    keep = keep & numpy.isfinite(run_values)
+    line_format = '%s\t%i\t%i\t' + value_format + '\n'
+    return ''.join([line_format % (chrom, start, end, value) for (start, end, value) in
+                    zip(run_starts[keep].tolist(), run_ends[keep].tolist(), run_values[keep].tolist())])
+
+def write_runs(outfile, chrom, run_starts, run_ends, run_values, value_format='%i', keep='positive'):
+    '''Write the runs selected by keep (see format_runs) as BedGraph lines.'''
+    outfile.write(format_runs(chrom, run_starts, run_ends, run_values, value_format, keep))
+
+def map_chromosomes(function, tasks, outfile, cpus=1):
+    '''
+    Call function(task) for each task, typically one per chromosome, and write the strings it returns to
+    outfile in task order. Chromosomes are independent, so with cpus > 1 the tasks run on a process pool;
+    function must then be defined at module level. Small tasks (e.g. scaffolds) are sent in batches.
+    '''
+    if cpus <= 1:
+        for task in tasks:
+            outfile.write(function(task))
+        return
+    pool = multiprocessing.Pool(cpus)
+    try:
+        for result in pool.imap(function, tasks, 1 + len(tasks) // (16 * cpus)):
+            outfile.write(result)
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
@@ -4,14 +4,16 @@
 Attempt to measure consistency of input BedGraph data in 2 ways:
 1. Compare the mean over segments to the left and the right of each location.
 2. Compare the variation of a segment, e.g. using standard or median absolute variation.
+(--statistic ttest and variation respectively). Window statistics are computed from cumulative sums, in
+time proportional to the track length whatever the window length.
 '''
 
 from __future__ import print_function
 import sys
-import array
 import argparse
+import numpy
 import scipy.stats
-import math
+import bedgraph
 
 def parse_cl():
     parser = argparse.ArgumentParser()
@@ -19,84 +21,117 @@ def parse_cl():
                         help='BedGraph input file [default: STDIN]')
     parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
                         help='BedGraph output file [default: STDOUT]')
-    return parser.parse_args()
+    parser.add_argument('-s', '--statistic', choices=['variation', 'ttest'], default='variation',
+                        help='variation: coefficient of variation over a window centred on each base; '
+                             'ttest: -log10 P of a t-test between windows to the left and right of each base '
+                             '[default: variation]')
+    parser.add_argument('-l', '--length', type=int, default=100,
+                        help='window length; variation windows are centred on each base [default: 100]')
+    parser.add_argument('--cpus', type=int, default=1,
+                        help='number of chromosomes to process in parallel [default: 1]')
+    args = parser.parse_args()
+    if args.length < 2:
+        exit('ERROR: --length must be at least 2.')
+    return args
 
-    
-def read_values(infile):
-    values = {}
-    for line in infile:
-        if '#' == line[0] or 'track' == line[0:5]:              # ignore comment lines
-            print('WARNING: Ignoring line: '+line, sys.stderr)
-            continue
-        (chrom, start, end, val) = (line.split())[0:4]
-        start = int(start); end = int(end); val = float(val)
-        if chrom not in values:
-            values[chrom] = array.array('f')  # float
-        if len(values[chrom]) < end:
-            values[chrom].extend([0]*(end-len(values[chrom])))
-        for i in range(start,end):
-            values[chrom][i] = values[chrom][i]+val
-    return values
 
-def scan(values):
-    LENGTH = 100
-    results = {}
-    #START = False
-    for chrom in values:
-        results[chrom] = array.array('f')
-        results[chrom].extend([0]*(len(values[chrom])))
-        for i in range(len(values[chrom])):
-            # t-test
-            #if i-LENGTH>=0 and i+LENGTH<=len(values[chrom]):
-            #    a = values[chrom][i-LENGTH:i]
-            #    b = values[chrom][i:i+LENGTH]
-            #    if math.fsum(a) + math.fsum(b) == 0:
-            #        t_result = -99
-            #        v_result = -99
-            #    else:
-            #        START = True
-            #        if max(a) == min(a) and max(b) == min(b):
-            #            if a[0] == b[0]:
-            #                t_result = -1
-            #                v_result = -1
-            #            else:
-            #                t_result = 99
-            #                v_result = 99
-            #        else:
-            #            t_result = math.floor(-math.log10((scipy.stats.ttest_ind(a,b))[1]))
-            #    if START:
-            #        print('%s\t%i\t%i\t%i' % (chrom,i,i+1,t_result))
-            # variation
-            if i-LENGTH/2>0 and i-LENGTH/2<len(values[chrom]):
-                c = values[chrom][i-LENGTH/2:i+LENGTH/2]
-                if math.fsum(c) == 0:
-                    v = -1
-                else:
-                    #START = True
-                    v = scipy.stats.variation(c)
-                results[chrom][i] = v
-                #if START:
-                    #print('%s\t%i\t%i\t%-.2f' % (chrom,i,i+1,v_result))
+ILL_CONDITIONED = 1e-4      # windows whose squared deviations are below this fraction of their blocks' are recomputed directly
+NEAR_TIE = 1e-4             # variations this close (in units of the last written digit) to a rounding tie are recomputed directly
+
+def window_stats(values, starts, ends, block_length):
+    '''
+    For the windows values[starts[k]:ends[k]]: sum, sum of squared deviations from the mean, and whether
+    the window is all zero or constant. Sums come from cumulative sums of x and x^2 (taken about the
+    chunk's mean); windows where those would lose too much to cancellation are computed directly, the
+    same way as scipy.stats.variation.
+    '''
+    n = ends - starts
+    shift = values.mean()
+    x = values - shift
+    sums = bedgraph.window_sums(x, starts, ends, block_length)
+    squares = bedgraph.window_sums(x * x, starts, ends, block_length)
+    deviations = numpy.maximum(squares - sums * sums / n, 0)
+    sums = sums + shift * n
+    changes = numpy.concatenate(([0], values[1:] != values[:-1])).astype(numpy.int64)
+    constant = bedgraph.window_sums(changes, starts + 1, ends, block_length) == 0     # no change after the first base
+    zero = bedgraph.window_sums((values != 0).astype(numpy.int64), starts, ends, block_length) == 0
+    deviations[constant] = 0
+    scale = bedgraph.block_sums(x * x, block_length)
+    scale = scale[starts // block_length] + scale[(ends - 1) // block_length]
+    for window_length in numpy.unique(n):
+        selected = numpy.flatnonzero((deviations < ILL_CONDITIONED * scale) & ~constant & (n == window_length))
+        if len(selected):
+            windows = values[starts[selected, numpy.newaxis] + numpy.arange(window_length)]
+            sums[selected] = windows.sum(axis=1)
+            deviations[selected] = ((windows - (sums[selected] / window_length)[:, numpy.newaxis]) ** 2).sum(axis=1)
+    return (sums, deviations, zero, constant)
+
+def variation(values, offset, start, end, length):
+    '''
+    Coefficient of variation over the length bases centred on each base (-1 if they are all 0). Results
+    that would round to one decimal differently with a different order of summation are recomputed
+    directly by scipy.stats.variation, so the written values do not depend on how the sums were taken.
+    '''
+    half = length // 2
+    results = numpy.zeros(end-start, dtype=numpy.float32)
+    positions = numpy.arange(max(start, half+1), end)
+    if len(positions) == 0:
+        return results
+    single = values
+    values = values.astype(numpy.float64)
+    starts = positions - half - offset
+    ends = numpy.minimum(positions + half - offset, len(values))                # windows are cut short at the end
+    n = ends - starts
+    (sums, deviations, zero, constant) = window_stats(values, starts, ends, length)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        v = numpy.sqrt(deviations / n) / (sums / n)
+    v = numpy.where(zero, -1, v).astype(numpy.float32)
+    digits = v.astype(numpy.float64) * 10
+    tie = numpy.abs(digits - numpy.floor(digits) - 0.5) < NEAR_TIE
+    for window_length in numpy.unique(n[tie]):
+        selected = numpy.flatnonzero(tie & (n == window_length))
+        windows = single[starts[selected, numpy.newaxis] + numpy.arange(window_length)]
+        v[selected] = scipy.stats.variation(windows, axis=1)
+    results[positions-start] = v
+    return results
+
+def ttest(values, offset, start, end, length):
+    '''
+    -log10 of the t-test P value comparing the length bases to the left and to the right of each base,
+    rounded down (at most 99): -99 if they are all 0, -1 if they are constant and equal, 99 if constant
+    and different. Bases without length bases on both sides are NaN (not tested, so not written).
+    '''
+    results = numpy.full(end-start, numpy.nan, dtype=numpy.float32)
+    positions = numpy.arange(max(start, length), min(end, offset + len(values) - length + 1))
+    if len(positions) == 0:
+        return results
+    values = values.astype(numpy.float64)
+    middles = positions - offset
+    (left_sums, left_deviations, left_zero, left_constant) = window_stats(values, middles - length, middles, length)
+    (right_sums, right_deviations, right_zero, right_constant) = window_stats(values, middles, middles + length, length)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
+        variances = (left_deviations + right_deviations) / (2*length - 2)         # pooled, equal sizes
+        t = (left_sums - right_sums) / length / numpy.sqrt(variances * 2 / length)
+        p = 2 * scipy.stats.t.sf(numpy.abs(t), 2*length - 2)
+        t_result = numpy.minimum(numpy.floor(-numpy.log10(p)), 99)
+    both_constant = left_constant & right_constant
+    t_result = numpy.where(both_constant, numpy.where(values[middles-1] == values[middles], -1, 99), t_result)
+    results[positions-start] = numpy.where(left_zero & right_zero, -99, t_result)
     return results
 
-def write_results(results, outfile):
-    for chrom in results:
-        a = results[chrom]
-        i = 0
-        x = a[i]
-        for j in range(len(a)):
-            if x != a[j] or len(a)-1 == j:
-                #if args.subtract_1: x=x-1
-                if x > 0:
-                    print('%s\t%i\t%i\t%.1f' % (chrom,i,j,x), file=outfile)
-                i = j
-                x = a[i]
+def scan(task):
+    (chrom, track, statistic, length) = task
+    if statistic == 'ttest':
+        function = lambda values, offset, start, end: ttest(values, offset, start, end, length)
+        return track.map(function, left=length, right=length).format(chrom, '%i', keep='all')   # codes can be <= 0
+    else:
+        function = lambda values, offset, start, end: variation(values, offset, start, end, length)
+        return track.map(function, left=length//2, right=length//2).format(chrom, '%.1f')
 
 
 
 if __name__ == '__main__':
     args = parse_cl()
-    values = read_values(args.infile)
-    results = scan(values)
-    write_results(results, args.outfile)
-    #raw_input("Press any key to exit.")
+    tracks = bedgraph.read_tracks(args.infile)
+    tasks = [(chrom, tracks[chrom], args.statistic, args.length) for chrom in tracks]
+    bedgraph.map_chromosomes(scan, tasks, args.outfile, args.cpus)
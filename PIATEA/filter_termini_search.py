@@ -24,6 +24,12 @@
     identifying direct overlapping repeats and palindromes (inverted overlapping repeats),
     which may be useful in identifying certain types of elements (e.g., Helitrons). For these
     types, overlaps are not currently resolved.
+    
+    With --by_chrom, the input is processed one chromosome at a time (it must be grouped by
+    chromosome, as termini_search.py output is), so memory is bounded by the largest chromosome
+    and each chromosome's output is written as soon as it is finished. Clusters are then never
+    formed across chromosomes. With --cpus, chromosomes are processed in parallel; output is
+    still written in input order.
 '''
 
 from __future__ import print_function
@@ -31,6 +37,11 @@ import sys
 import argparse
 import collections
 import math
+import heapq
+import bisect
+import itertools
+import multiprocessing
+import numpy
 
 def parse_cl():
     parser = argparse.ArgumentParser()
@@ -79,17 +90,22 @@ def parse_cl():
     parser.add_argument('--max_truncation', type=int, default=30,
                         help='if any hit (not pair) length is trimmed by more than this % (due to overlaps), the corresponding pair is discarded [default: 30]')
 
+    # execution
+    parser.add_argument('--by_chrom', action='store_true',
+                        help='process the input one chromosome at a time (input must be grouped by chromosome)')
+    parser.add_argument('--cpus', type=int, default=1,
+                        help='with --by_chrom, number of chromosomes to process in parallel [default: 1]')
+
     return parser.parse_args()
 
 class Hit:
-    def __init__(self, line):
-        d = line.strip().split('\t')
-        self.chrom  = d[0]
-        self.start  = int(d[1])
-        self.end    = int(d[2])
-        self.id     = d[3]
-        self.score  = float(d[4])
-        self.strand = d[5]
+    def __init__(self, chrom, start, end, id, score, strand):
+        self.chrom  = chrom
+        self.start  = start
+        self.end    = end
+        self.id     = id
+        self.score  = score
+        self.strand = strand
         self.orientation = self.id[-1]
         self.originalLength = self.length()
     
@@ -191,158 +207,424 @@ class HitPair:
         return max(x,y)
 
 class HitPairCollection:
+    def __init__(self, hitPairs):
+        self.hitPairs = hitPairs
+        self.end = max(pair.end for pair in hitPairs)
+
+class HitPairClusterer:
+    '''
+    Forms the single-link clusters of hit pairs (pairs with any overlap between any of their hits) in
+    O(n log n), using a sweep line over the hit intervals plus union-find over the pairs.
+    Pairs must be added in order of start. The sweep line keeps the union of the hits seen so far as a
+    sorted list of disjoint spans; all hits in a span belong to the same cluster, so a new hit only needs
+    to be checked against the spans it overlaps (found by bisection), not against every open pair.
+    Spans that end before the current pair starts can never be overlapped again and are dropped, and the
+    clusters they belong to are complete once no open span refers to them.
+    Clusters are returned as HitPairCollections in the same order, and with their pairs in the same
+    order, as the original cluster-by-cluster comparison, so output is unchanged: a cluster is complete
+    when a pair starts at or after its end, clusters completed together are returned in order of their
+    most recently added pair, and each cluster's pairs are sorted by start, with ties in the order in
+    which the clusters were merged.
+    '''
     def __init__(self):
-        self.hitPairs = []
-        self.end = -1
-    
-    def overlaps(self, hitPair):
-        for p in self.hitPairs:
-            if p.overlaps(hitPair):
-                return True
-        return False
-    
-    def add(self, hitPair):
-        self.hitPairs.append(hitPair)
-        self.hitPairs.sort(key=lambda x:x.start)
-        if hitPair.end > self.end:
-            self.end = hitPair.end
-        None
-    
-    def addAll(self, hitPairCollections):
-        for coll in hitPairCollections:
-            for pair in coll.hitPairs:
-                self.add(pair)
-
-def readPairs(args):
-    allPairs = []
-    for line1 in args.infile:
-        a = Hit(line1)
-        try:
-            b = Hit(args.infile.next())
-        except StopIteration:
+        self.pairs = []
+        self.parent = []                                                        # union-find; the root of a cluster is its most recently added pair
+        self.merged = []                                                        # for each root, the roots of the clusters merged into it, in order
+        self.end = []                                                           # for each root, the end of its cluster
+        self.open = []                                                          # heap of (end, root) of clusters that may still grow
+        self.spanStarts = []
+        self.spanEnds = []
+        self.spanPairs = []                                                     # a pair with a hit in each span
+        self.firstSpan = 0                                                      # spans before this one end before the sweep line
+    
+    def find(self, i):
+        root = i
+        while self.parent[root] != root:
+            root = self.parent[root]
+        while self.parent[i] != root:                                           # path compression
+            (self.parent[i], i) = (root, self.parent[i])
+        return root
+    
+    # Add a pair and return a list of the clusters completed by it.
+    def add(self, pair):
+        completed = self.complete(pair.start)
+        k = len(self.pairs)
+        self.pairs.append(pair)
+        self.parent.append(k)
+        roots = set()
+        for hit in (pair.a, pair.b):
+            for i in self.insertSpan(hit, k):
+                roots.add(self.find(i))
+        roots.discard(k)                                                        # the pair's own other hit
+        roots = sorted(roots)
+        end = pair.end
+        for root in roots:
+            self.parent[root] = k
+            end = max(end, self.end[root])
+        self.merged.append(roots)
+        self.end.append(end)
+        heapq.heappush(self.open, (end, k))
+        return completed
+    
+    # Return all remaining clusters.
+    def finish(self):
+        return self.complete(None)
+    
+    # Remove and return the clusters that end at or before position (all clusters if position is None).
+    def complete(self, position):
+        roots = []
+        while self.open and (position is None or self.open[0][0] <= position):
+            (end, root) = heapq.heappop(self.open)
+            if self.parent[root] == root:                                       # otherwise, merged into a later cluster
+                roots.append(root)
+        if position is not None:
+            while self.firstSpan < len(self.spanStarts) and self.spanEnds[self.firstSpan] <= position:
+                self.firstSpan = self.firstSpan + 1
+            if self.firstSpan > 1000 and 2*self.firstSpan > len(self.spanStarts):
+                del self.spanStarts[:self.firstSpan]
+                del self.spanEnds[:self.firstSpan]
+                del self.spanPairs[:self.firstSpan]
+                self.firstSpan = 0
+        return [HitPairCollection(self.members(root)) for root in sorted(roots)]
+    
+    # Insert the hit of pair k into the spans, merging the spans it overlaps; return the pairs of those spans.
+    def insertSpan(self, hit, k):
+        i = max(bisect.bisect_right(self.spanStarts, hit.start, self.firstSpan) - 1, self.firstSpan)
+        if i < len(self.spanStarts) and self.spanEnds[i] <= hit.start:
+            i = i + 1
+        j = i
+        start = hit.start
+        end = hit.end
+        overlapping = []
+        while j < len(self.spanStarts) and self.spanStarts[j] < hit.end and self.spanEnds[j] > hit.start:
+            overlapping.append(self.spanPairs[j])
+            start = min(start, self.spanStarts[j])
+            end = max(end, self.spanEnds[j])
+            j = j + 1
+        self.spanStarts[i:j] = [start]
+        self.spanEnds[i:j] = [end]
+        self.spanPairs[i:j] = [k]
+        return overlapping
+    
+    # The pairs of a cluster, sorted by start; ties are in merge order.
+    def members(self, root):
+        order = []
+        stack = [root]
+        while stack:
+            node = stack.pop()
+            if node < 0:                                                        # all merged clusters done: now the pair itself
+                order.append(self.pairs[-node - 1])
+            else:
+                stack.append(-node - 1)
+                stack.extend(reversed(self.merged[node]))
+                self.merged[node] = None                                        # release memory
+        order.sort(key=lambda pair: pair.start)                                 # stable
+        return order
+
+class HitPairColumns:
+    '''
+    All the hit pairs of a termini BED file as NumPy columns (one element per pair), so that self-overlap
+    trimming and the filters can be applied to every pair at once; only the pairs that pass are then
+    turned into HitPair objects. The methods mirror those of HitPair, element-wise.
+    '''
+    DTYPES = (None, numpy.int64, numpy.int64, None, numpy.float64, None)     # chrom, start, end, id, score, strand (None: strings)
+
+    def __init__(self, infile, chunkLines=1000000):
+        infile = iter(infile)                                                   # may be a list of lines
+        columns = [[] for i in range(6)]
+        while True:
+            lines = list(itertools.islice(infile, chunkLines))
+            if len(lines) == 0:
+                break
+            fields = list(zip(*[line.strip().split('\t')[:6] for line in lines]))
+            for (i, dtype) in enumerate(HitPairColumns.DTYPES):
+                columns[i].append(numpy.array(fields[i], dtype=dtype) if dtype is None
+                                  else numpy.array(fields[i]).astype(dtype))
+        (chrom, start, end, id, score, strand) = [numpy.concatenate(c) if len(c) > 0
+                                                  else numpy.array([], dtype=dtype or str)    # typed, so the filters get typed empty arrays
+                                                  for (c, dtype) in zip(columns, HitPairColumns.DTYPES)]
+        if len(chrom) % 2 != 0:
             exit('ERROR: Unexpected end of file. Last line has no matching pair.')
-        pair = HitPair(a,b)
+        first = numpy.arange(0, len(chrom), 2)
+        second = first + 1
+        mismatched = numpy.nonzero(id[first] != id[second])[0]
+        if len(mismatched) > 0:
+            i = first[mismatched[0]]
+            exit('ERROR: IDs do not match!%s\n%s' % ('\t'.join(str(c[i]) for c in (chrom, start, end, id, score, strand)),
+                                                     '\t'.join(str(c[i+1]) for c in (chrom, start, end, id, score, strand))))
+        swap = start[second] < start[first]                                     # a is the hit that starts first (the first line if tied)
+        a = numpy.where(swap, second, first)
+        b = numpy.where(swap, first, second)
+        self.chrom = chrom[a]
+        self.id = id[a]
+        self.score = score[a]
+        self.orientation = numpy.array([i[-1] for i in self.id.tolist()], dtype=str)
+        self.aStart = start[a]
+        self.aEnd = end[a]
+        self.aStrand = strand[a]
+        self.bStart = start[b]
+        self.bEnd = end[b]
+        self.bStrand = strand[b]
+        self.start = numpy.minimum(self.aStart, self.bStart)
+        self.end = numpy.maximum(self.aEnd, self.bEnd)
+        self.aOriginalLength = self.aLength()
+        self.bOriginalLength = self.bLength()
+        self.trimmedSelfOverlap = numpy.zeros(len(a), dtype=numpy.int64)
+    
+    def __len__(self):
+        return len(self.start)
+    
+    def trimSelfOverlap(self):
+        overlap = self.selfOverlap()
+        trim = overlap > 0
+        x = numpy.ceil(overlap/2).astype(numpy.int64)                           # same division semantics as HitPair.trimSelfOverlap
+        y = overlap - x
+        self.aEnd = numpy.where(trim, self.aEnd - x, self.aEnd)
+        self.bStart = numpy.where(trim, self.bStart + y, self.bStart)
+        self.aOriginalLength = numpy.where(trim, self.aLength(), self.aOriginalLength)
+        self.bOriginalLength = numpy.where(trim, self.bLength(), self.bOriginalLength)
+        self.trimmedSelfOverlap = numpy.where(trim, overlap, self.trimmedSelfOverlap)
+    
+    def aLength(self):
+        return self.aEnd - self.aStart
+    
+    def bLength(self):
+        return self.bEnd - self.bStart
+    
+    def selfOverlap(self):
+        return self.aEnd - self.bStart
+    
+    def selfOverlapPct(self):
+        return 100*self.selfOverlap()*2/self.totalHitLength()
+    
+    def trimmedSelfOverlapPct(self):
+        return 100.0*self.trimmedSelfOverlap/self.originalHitLength()
+    
+    def length(self):
+        return self.end - self.start
+    
+    def totalHitLength(self):
+        return self.aLength() + self.bLength()
+    
+    def originalHitLength(self):
+        return self.aOriginalLength + self.bOriginalLength
+    
+    def hitSeparation(self):
+        return self.bStart - self.aEnd
+    
+    # HitPair objects for the pairs selected by mask.
+    def hitPairs(self, mask):
+        pairs = []
+        selected = [column[mask].tolist() for column in (
+            self.chrom, self.id, self.score, self.aStart, self.aEnd, self.aStrand, self.aOriginalLength,
+            self.bStart, self.bEnd, self.bStrand, self.bOriginalLength, self.start, self.end, self.trimmedSelfOverlap)]
+        for (chrom, id, score, aStart, aEnd, aStrand, aOriginalLength, bStart, bEnd, bStrand, bOriginalLength,
+             start, end, trimmedSelfOverlap) in zip(*selected):
+            a = Hit(chrom, aStart, aEnd, id, score, aStrand)
+            b = Hit(chrom, bStart, bEnd, id, score, bStrand)
+            a.originalLength = aOriginalLength
+            b.originalLength = bOriginalLength
+            pair = HitPair(a, b)
+            pair.start = start                                                  # before self-overlap trimming, as in HitPair
+            pair.end = end
+            pair.trimmedSelfOverlap = trimmedSelfOverlap
+            pairs.append(pair)
+        return pairs
+
+def readPairs(infile, args):
+    columns = HitPairColumns(infile)
+    with numpy.errstate(divide='ignore', invalid='ignore'):
         if args.type == 'LTR' or args.type == 'TIR':
-            pair.trimSelfOverlap()                                              # if hits overlap, truncate
-        if passesFilters(pair, args):
-            allPairs.append(pair)
-        if not selfOverlapIsAcceptable(pair, args):
-            None
-    return allPairs
+            columns.trimSelfOverlap()                                           # if hits overlap, truncate
+        return columns.hitPairs(passesFilters(columns, args))
 
 def process(args):
-    sortedPairs = sorted(readPairs(args), key=lambda pair:pair.start)
-    remaining = []
+    if args.by_chrom:
+        processByChromosome(args)
+    else:
+        processPairs(readPairs(args.infile, args), args, args.outfile)
+
+def processPairs(pairs, args, outfile):
+    sortedPairs = sorted(pairs, key=lambda pair:pair.start)
+    clusterer = HitPairClusterer()
     for pair in sortedPairs:
-        overlapping = []
-        remove = []
-        for coll in remaining:
-            if coll.end <= pair.start:                                          # '<=' not just '<' b/c of 0-based indexing
-                remove.append(coll)
-                output(coll, args)
-            elif coll.overlaps(pair):
-                remove.append(coll)
-                overlapping.append(coll)
-        for coll in remove:                                                     # can't do it in-place in the loop b/c it messes up the iteration!!
-            remaining.remove(coll)
-        
-        if len(overlapping) > 0:
-            merged = HitPairCollection()
-            merged.addAll(overlapping)
-            merged.add(pair)
-            remaining.append(merged)
-        else:
-            newColl = HitPairCollection()
-            newColl.add(pair)
-            remaining.append(newColl)
-    for coll in remaining:
-        output(coll, args)
+        for coll in clusterer.add(pair):                                        # clusters ending at or before pair.start are complete
+            output(coll, args, outfile)
+    for coll in clusterer.finish():
+        output(coll, args, outfile)
 
-def passesFilters(pair, args):
+# Yield the lines of each chromosome in turn.
+def chromosomeBlocks(infile):
+    seen = set()
+    for (chrom, lines) in itertools.groupby(infile, key=lambda line: line.split('\t', 1)[0]):
+        if chrom in seen:
+            exit('ERROR: Input is not grouped by chromosome (%s appears more than once). Sort it first, e.g. sort -s -k1,1.' % chrom)
+        seen.add(chrom)
+        yield list(lines)
+
+class OutputBuffer:
+    def __init__(self):
+        self.parts = []
+    
+    def write(self, s):
+        self.parts.append(s)
+
+# Filter one chromosome and return the output as a string; runs in a worker process.
+def processChromosome(task):
+    (lines, args) = task
+    outfile = OutputBuffer()
+    processPairs(readPairs(lines, args), args, outfile)
+    return ''.join(outfile.parts)
+
+def processByChromosome(args):
+    if args.cpus <= 1:
+        for lines in chromosomeBlocks(args.infile):
+            processPairs(readPairs(lines, args), args, args.outfile)
+            args.outfile.flush()
+        return
+    workerArgs = argparse.Namespace(**dict((k, v) for (k, v) in vars(args).items() if k not in ('infile', 'outfile')))    # files can't be sent to workers
+    pool = multiprocessing.Pool(args.cpus)
+    try:
+        pending = collections.deque()                                           # results in input order; bounded, so input is read only as needed
+        for lines in chromosomeBlocks(args.infile):
+            pending.append(pool.apply_async(processChromosome, ((lines, workerArgs),)))
+            if len(pending) >= 2 * args.cpus:
+                args.outfile.write(pending.popleft().get())
+        while len(pending) > 0:
+            args.outfile.write(pending.popleft().get())
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
+# The filters are applied to all pairs at once: pairs is a HitPairColumns and each filter returns a boolean array.
+def passesFilters(pairs, args):
     if args.type == 'LTR' or args.type == 'TIR':
         return (
-            typeIsCorrect(pair, args) and
-            selfOverlapIsAcceptable(pair, args) and
-            scoreIsAcceptable(pair, args) and
-            pairLengthIsAcceptable(pair, args) and
-            hitLengthIsAcceptable(pair, args) and
-            separationIsAcceptable(pair, args))
+            typeIsCorrect(pairs, args) &
+            selfOverlapIsAcceptable(pairs, args) &
+            scoreIsAcceptable(pairs, args) &
+            pairLengthIsAcceptable(pairs, args) &
+            hitLengthIsAcceptable(pairs, args) &
+            separationIsAcceptable(pairs, args))
     else:
         assert args.type == 'direct_overlapping' or args.type == 'palindrome'
         return (
-            typeIsCorrect(pair, args) and
-            selfOverlapIsAcceptable(pair, args) and
-            scoreIsAcceptable(pair, args) and
-            pairLengthIsAcceptable(pair, args) and
-            hitLengthIsAcceptable(pair, args))
-
-def typeIsCorrect(pair, args):
-    if pair.orientation == '+':
-        return args.type == 'LTR' or args.type == 'direct_overlapping'
+            typeIsCorrect(pairs, args) &
+            selfOverlapIsAcceptable(pairs, args) &
+            scoreIsAcceptable(pairs, args) &
+            pairLengthIsAcceptable(pairs, args) &
+            hitLengthIsAcceptable(pairs, args))
+
+def typeIsCorrect(pairs, args):
+    assert numpy.all((pairs.orientation == '+') | (pairs.orientation == '-'))
+    if args.type == 'LTR' or args.type == 'direct_overlapping':
+        return pairs.orientation == '+'
     else:
-        assert pair.orientation == '-'
-        return args.type == 'TIR' or args.type == 'palindrome'
+        return pairs.orientation == '-'
 
-def selfOverlapIsAcceptable(pair, args):
+def selfOverlapIsAcceptable(pairs, args):
     if args.type == 'LTR' or args.type == 'TIR':
-        return pair.trimmedSelfOverlapPct() < args.hit_overlap_pct
+        return pairs.trimmedSelfOverlapPct() < args.hit_overlap_pct
     else:
         assert args.type == 'direct_overlapping' or args.type == 'palindrome'
-        return pair.selfOverlapPct() > args.hit_overlap_pct
+        return pairs.selfOverlapPct() > args.hit_overlap_pct
 
-def scoreIsAcceptable(pair, args):
+def scoreIsAcceptable(pairs, args):
     if args.score_filter == 'filter_1':
-        return pair.score >= args.min_score
+        return pairs.score >= args.min_score
     else:
         assert args.score_filter == 'filter_2'
         return (
-            pair.score >= args.accept_score or (
-            pair.score > args.min_score and pair.score*args.score_multiplier > pair.length()))               
+            (pairs.score >= args.accept_score) | (
+            (pairs.score > args.min_score) & (pairs.score*args.score_multiplier > pairs.length())))
+
+def pairLengthIsAcceptable(pairs, args):
+    return (pairs.length() >= args.min_pair_length) & (pairs.length() <= args.max_pair_length)
 
-def pairLengthIsAcceptable(pair, args):
-    return pair.length() >= args.min_pair_length and pair.length() <= args.max_pair_length
+def hitLengthIsAcceptable(pairs, args):
+    return numpy.maximum(pairs.aLength(), pairs.bLength()) < args.max_hit_length
 
-def hitLengthIsAcceptable(pair, args):
-    return max(pair.a.length(), pair.b.length()) < args.max_hit_length
+def separationIsAcceptable(pairs, args):
+    return pairs.hitSeparation() >= args.min_hit_separation
 
-def separationIsAcceptable(pair, args):
-    return pair.hitSeparation() >= args.min_hit_separation
+class HitIndex:
+    '''
+    Static index of the hits of a list of pairs, for finding the pairs with a hit overlapping a given interval.
+    Hits are sorted by start; since no hit is longer than the longest, only hits starting within that
+    distance before the interval need to be examined. Hits only ever shrink (by truncation), so indexing
+    their original extent can only over-report, never miss, an overlap.
+    '''
+    def __init__(self, pairs):
+        hits = []
+        for (i, pair) in enumerate(pairs):
+            hits.append((pair.a.start, pair.a.end, i))
+            hits.append((pair.b.start, pair.b.end, i))
+        hits.sort()
+        self.starts = [hit[0] for hit in hits]
+        self.ends = [hit[1] for hit in hits]
+        self.pairs = [hit[2] for hit in hits]
+        self.maxLength = max([end - start for (start, end, i) in hits] + [0])
+    
+    # Indices of the pairs with a hit touching or overlapping [start, end].
+    def overlapping(self, start, end):
+        result = set()
+        first = bisect.bisect_left(self.starts, start - self.maxLength)
+        last = bisect.bisect_right(self.starts, end)
+        for j in range(first, last):
+            if self.ends[j] >= start:
+                result.add(self.pairs[j])
+        return result
 
-def output(hitPairCollection, args):
+def output(hitPairCollection, args, outfile):
     pairs = sorted(hitPairCollection.hitPairs, key=lambda pair: pair.score, reverse=True)
-    while len(pairs) > 0:
+    index = HitIndex(pairs)
+    queue = [(-pair.score, i) for (i, pair) in enumerate(pairs)]                # a heap: already in (score, then collection) order
+    removed = [False] * len(pairs)                                              # removed pairs are left in the queue and skipped
+    while len(queue) > 0:
         # Find all pairs with scores 'close' to the top score
         topPair = None
         topScoring = []
-        for p in pairs:
-            if p.a.id == '8-':
-                None
-            if (len(topScoring) == 0 or
-                topScoring[0].score - p.score < (args.score_buffer_pct/100.0)*topScoring[0].score):     # must be '100.0' not '100' or else integer division is used, so the test always fails
-                    topScoring.append(p)
+        while len(queue) > 0:
+            i = queue[0][1]
+            p = pairs[i]
+            if removed[i]:
+                heapq.heappop(queue)
+            elif (len(topScoring) == 0 or
+                pairs[topScoring[0]].score - p.score < (args.score_buffer_pct/100.0)*pairs[topScoring[0]].score):     # must be '100.0' not '100' or else integer division is used, so the test always fails
+                    topScoring.append(heapq.heappop(queue)[1])
             else:
                 break
+        if len(topScoring) == 0:
+            break
         if len(topScoring) == 1:
-            topPair = topScoring[0]
+            top = topScoring[0]
         else:
             maxTotalHitLength = 0
-            for p in topScoring:
-                maxTotalHitLength = max(p.totalHitLength(), maxTotalHitLength)
-            for p in topScoring:
-                if topPair is None or (
+            for i in topScoring:
+                maxTotalHitLength = max(pairs[i].totalHitLength(), maxTotalHitLength)
+            top = None
+            for i in topScoring:
+                p = pairs[i]
+                if top is None or (
                     100*(maxTotalHitLength-p.totalHitLength())/maxTotalHitLength < args.hit_length_buffer_pct
-                    and p.length() > topPair.length()):
-                        topPair = p
+                    and p.length() > pairs[top].length()):
+                        top = i
+        topPair = pairs[top]
+        for i in topScoring:
+            if i != top:
+                heapq.heappush(queue, (-pairs[i].score, i))
         # Remove all pairs overlapping by >33% or truncate if overlapping by less.
-        pairs.remove(topPair)                                                   # always remove at least 1 pair, guarantee loop completion
-        remove = []
-        for p in pairs:
-            t = p.truncateAll(topPair)
-            if t > args.max_truncation:                                         # careful: if truncation is 100%, positions are set to (-1,-1), which is bound to cause downstream errors
-                remove.append(p)
-        for coll in remove:                                                     # can't do it in-place in the loop b/c it messes up the iteration!!
-            pairs.remove(coll)
-        print(topPair, file=args.outfile)
+        removed[top] = True                                                     # always remove at least 1 pair, guarantee loop completion
+        candidates = index.overlapping(topPair.a.start, topPair.a.end) | index.overlapping(topPair.b.start, topPair.b.end)
+        for i in candidates:                                                    # only pairs overlapping topPair can be truncated
+            if not removed[i]:
+                t = pairs[i].truncateAll(topPair)
+                if t > args.max_truncation:                                     # careful: if truncation is 100%, positions are set to (-1,-1), which is bound to cause downstream errors
+                    removed[i] = True
+        print(topPair, file=outfile)
 
 
 
@@ -9,7 +9,7 @@ Output: A new BED file with all perfect non-overlapping TSDs within the specifie
 from __future__ import print_function
 import argparse
 #import os.path
-from Bio import SeqIO
+import packed_seq
 
 class Termini():
     def __init__(self):
@@ -35,18 +35,19 @@ def parse_cl():
     return parser.parse_args()
 
 def find_tsds(seqfilepath, bedfilepath):
-    seq = readseq(seqfilepath)
+    seq = read_seq(seqfilepath)
     for termini in parsepairs(bedfilepath):
         find_tsds(seq, termini)
 
 
-def read_seq(infile):
-    result = list(SeqIO.parse(infile, "fasta"))
+def read_seq(infilename):
+    """Open the sequence as a memory-mapped packed sequence (see packed_seq.py); slices are decoded on demand."""
+    result = packed_seq.open_fasta(infilename)
     if len(result) == 0:
-        raise Exception("No sequence found in file %s. Are you sure this is a FASTA file?" % (infile.name))
+        raise Exception("No sequence found in file %s. Are you sure this is a FASTA file?" % (infilename))
     if len(result) > 1:
-        raise Exception("More than one sequence found in file %s." % (infile.name))
-    return result[0]
+        raise Exception("More than one sequence found in file %s." % (infilename))
+    return result.records[0]
 
 if __name__ == '__main__':
     args = parse_cl()
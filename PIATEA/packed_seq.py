@@ -0,0 +1,271 @@
+#!/usr/bin/env python
+
+'''
+On-disk, memory-mapped, 2bit-style packed sequence store, so that windows and subsequences can be
+extracted from a genome in O(window) time without parsing the whole FASTA file into memory.
+
+Bases are packed 4 per byte (T=0, C=1, A=2, G=3, as in UCSC .2bit). Everything else is stored as runs
+alongside the packed bases:
+    - exception runs: runs of a single non-ACGT letter, e.g. N gaps or IUPAC ambiguity codes
+    - mask runs: runs of lower-case (soft-masked) letters
+so extraction reproduces the FASTA sequence exactly.
+
+The store for a FASTA file is kept next to it as [fasta].pseq, and is (re)built automatically by
+open_fasta() if it is missing or older than the FASTA file. It can also be built explicitly:
+    ./packed_seq.py genome.fas
+
+File layout (all integers little-endian, unsigned 64-bit unless noted):
+    header:  magic 'PSEQ', version (32-bit), index offset
+    data:    for each record: packed bases, exception runs (start, length, letter), mask runs (start, length)
+    index:   record count, then for each record: name length (32-bit), name, length, packed bases offset,
+             exception runs offset, exception run count, mask runs offset, mask run count
+'''
+
+from __future__ import print_function
+import sys
+import os
+import re
+import mmap
+import struct
+import bisect
+import argparse
+
+MAGIC = b'PSEQ'
+VERSION = 1
+HEADER = struct.Struct('<4sIQ')
+INDEX_ENTRY = struct.Struct('<QQQQQQ')
+EXCEPTION_RUN = struct.Struct('<QQQ')
+MASK_RUN = struct.Struct('<QQ')
+EXTENSION = '.pseq'
+CHUNK_LENGTH = 1 << 20                                                      # bases packed per step when building; multiple of 4
+
+BASES = 'TCAG'
+PACK = dict((a+b+c+d, (BASES.index(a)<<6) | (BASES.index(b)<<4) | (BASES.index(c)<<2) | BASES.index(d))
+            for a in BASES for b in BASES for c in BASES for d in BASES)
+UNPACK = [None] * 256
+for quad, byte in PACK.items():
+    UNPACK[byte] = quad
+
+EXCEPTION_PATTERN = re.compile(r'([^ACGT])\1*')
+MASK_PATTERN = re.compile(r'[a-z]+')
+
+
+class PackedSeq():
+    '''One record of a PackedSeqFile. Slicing returns a str; only the requested bases are decoded.'''
+
+    def __init__(self, store, name, length, packed_offset, exceptions, masks):
+        self.store = store
+        self.name = name
+        self.id = name
+        self.length = length
+        self.packed_offset = packed_offset
+        self.exceptions = exceptions                                            # [(start, end, letter)], sorted
+        self.masks = masks                                                      # [(start, end)], sorted
+        self.exception_starts = [run[0] for run in exceptions]
+        self.mask_starts = [run[0] for run in masks]
+
+    def __len__(self):
+        return self.length
+
+    def __getitem__(self, key):
+        if not isinstance(key, slice):
+            return self.fetch(key, key+1)
+        (start, end, step) = key.indices(self.length)
+        if step != 1:
+            return self.fetch(start, end)[::step]
+        return self.fetch(start, end)
+
+    def fetch(self, start, end):
+        '''Sequence from start to end (zero-based, end exclusive), as a str.'''
+        start = max(start, 0)
+        end = min(end, self.length)
+        if end <= start:
+            return ''
+        first = start >> 2
+        last = (end + 3) >> 2
+        data = self.store.data[self.packed_offset+first:self.packed_offset+last]
+        offset = first << 2
+        seq = list(''.join([UNPACK[byte] for byte in bytearray(data)])[start-offset:end-offset])
+        for (run_start, run_end, letter) in overlapping(self.exceptions, self.exception_starts, start, end):
+            (left, right) = (max(run_start, start) - start, min(run_end, end) - start)
+            seq[left:right] = letter * (right - left)
+        for (run_start, run_end) in overlapping(self.masks, self.mask_starts, start, end):
+            (left, right) = (max(run_start, start) - start, min(run_end, end) - start)
+            seq[left:right] = ''.join(seq[left:right]).lower()
+        return ''.join(seq)
+
+    def exception_runs(self, start=0, end=None):
+        '''Runs of non-ACGT letters, e.g. Ns, overlapping [start, end), as (start, end, letter).'''
+        if end is None:
+            end = self.length
+        return overlapping(self.exceptions, self.exception_starts, start, end)
+
+    def mask_runs(self, start=0, end=None):
+        '''Runs of soft-masked (lower-case) letters overlapping [start, end), as (start, end).'''
+        if end is None:
+            end = self.length
+        return overlapping(self.masks, self.mask_starts, start, end)
+
+
+def overlapping(runs, run_starts, start, end):
+    '''Runs (sorted and non-overlapping) that overlap [start, end).'''
+    i = bisect.bisect_right(run_starts, start) - 1
+    if i < 0 or runs[i][1] <= start:
+        i = i + 1
+    result = []
+    while i < len(runs) and runs[i][0] < end:
+        result.append(runs[i])
+        i = i + 1
+    return result
+
+
+class PackedSeqFile():
+    '''A memory-mapped packed sequence store. Records are available by name or in file order.'''
+
+    def __init__(self, filename):
+        self.filename = filename
+        self.file = open(filename, 'rb')
+        self.data = mmap.mmap(self.file.fileno(), 0, access=mmap.ACCESS_READ)
+        (magic, version, index_offset) = HEADER.unpack_from(self.data, 0)
+        if magic != MAGIC or version != VERSION:
+            raise Exception("%s is not a packed sequence file (version %d)." % (filename, VERSION))
+        (count,) = struct.unpack_from('<Q', self.data, index_offset)
+        position = index_offset + 8
+        self.records = []
+        self.by_name = {}
+        for n in range(count):
+            (name_length,) = struct.unpack_from('<I', self.data, position)
+            name = self.data[position+4:position+4+name_length].decode('ascii')
+            position = position + 4 + name_length
+            (length, packed_offset, exceptions_offset, exception_count,
+             masks_offset, mask_count) = INDEX_ENTRY.unpack_from(self.data, position)
+            position = position + INDEX_ENTRY.size
+            exceptions = []
+            for i in range(exception_count):
+                (run_start, run_length, letter) = EXCEPTION_RUN.unpack_from(self.data, exceptions_offset + i*EXCEPTION_RUN.size)
+                exceptions.append((run_start, run_start+run_length, chr(letter)))
+            masks = []
+            for i in range(mask_count):
+                (run_start, run_length) = MASK_RUN.unpack_from(self.data, masks_offset + i*MASK_RUN.size)
+                masks.append((run_start, run_start+run_length))
+            record = PackedSeq(self, name, length, packed_offset, exceptions, masks)
+            self.records.append(record)
+            self.by_name[name] = record
+
+    def __len__(self):
+        return len(self.records)
+
+    def __iter__(self):
+        return iter(self.records)
+
+    def __getitem__(self, name):
+        return self.by_name[name]
+
+    def close(self):
+        self.data.close()
+        self.file.close()
+
+
+class RecordPacker():
+    '''Packs one record's sequence, supplied in pieces of any length, into outfile.'''
+
+    def __init__(self, outfile, name):
+        self.outfile = outfile
+        self.name = name
+        self.packed_offset = outfile.tell()
+        self.length = 0
+        self.pending = ''
+        self.exceptions = []                                                    # [start, length, letter]
+        self.masks = []                                                         # [start, length]
+
+    def add(self, seq):
+        for match in EXCEPTION_PATTERN.finditer(seq.upper()):
+            add_run(self.exceptions, self.length + match.start(), match.end() - match.start(), ord(match.group(1)))
+        for match in MASK_PATTERN.finditer(seq):
+            add_run(self.masks, self.length + match.start(), match.end() - match.start())
+        self.length = self.length + len(seq)
+        self.pending = self.pending + seq
+        if len(self.pending) >= CHUNK_LENGTH:
+            whole = len(self.pending) - len(self.pending) % 4
+            self.pack(self.pending[:whole])
+            self.pending = self.pending[whole:]
+
+    def pack(self, seq):
+        seq = EXCEPTION_PATTERN.sub(lambda match: 'T' * len(match.group(0)), seq.upper())   # exceptions are stored as runs
+        self.outfile.write(bytearray([PACK[seq[i:i+4]] for i in range(0, len(seq), 4)]))
+
+    def finish(self):
+        '''Write the rest of the record and its runs. Returns the record's index entry.'''
+        self.pack(self.pending + 'T' * (-len(self.pending) % 4))
+        self.pending = ''
+        exceptions_offset = self.outfile.tell()
+        for run in self.exceptions:
+            self.outfile.write(EXCEPTION_RUN.pack(*run))
+        masks_offset = self.outfile.tell()
+        for run in self.masks:
+            self.outfile.write(MASK_RUN.pack(*run))
+        return (self.name, self.length, self.packed_offset, exceptions_offset, len(self.exceptions),
+                masks_offset, len(self.masks))
+
+
+def add_run(runs, start, length, letter=None):
+    '''Append a run, merging it with the previous run if they are contiguous (and the same letter).'''
+    if runs and runs[-1][0] + runs[-1][1] == start and (letter is None or runs[-1][2] == letter):
+        runs[-1][1] = runs[-1][1] + length
+    elif letter is None:
+        runs.append([start, length])
+    else:
+        runs.append([start, length, letter])
+
+
+def build(fasta_filename, packed_filename=None):
+    '''Build the packed sequence store for a FASTA file, reading it line by line. Returns the store's filename.'''
+    if packed_filename is None:
+        packed_filename = fasta_filename + EXTENSION
+    temp_filename = '%s.%d.tmp' % (packed_filename, os.getpid())
+    index = []
+    with open(fasta_filename) as infile:
+        with open(temp_filename, 'wb') as outfile:
+            outfile.write(HEADER.pack(MAGIC, VERSION, 0))
+            packer = None
+            for line in infile:
+                if line.startswith('>'):
+                    if packer is not None:
+                        index.append(packer.finish())
+                    packer = RecordPacker(outfile, line[1:].split()[0])             # name = first word, as in Biopython's record.id
+                elif packer is not None:
+                    packer.add(line.strip())
+            if packer is not None:
+                index.append(packer.finish())
+            index_offset = outfile.tell()
+            outfile.write(struct.pack('<Q', len(index)))
+            for entry in index:
+                name = entry[0].encode('ascii')
+                outfile.write(struct.pack('<I', len(name)) + name)
+                outfile.write(INDEX_ENTRY.pack(*entry[1:]))
+            outfile.seek(0)
+            outfile.write(HEADER.pack(MAGIC, VERSION, index_offset))
+    os.rename(temp_filename, packed_filename)                                   # atomic, so concurrent readers never see a partial store
+    return packed_filename
+
+
+def open_fasta(fasta_filename):
+    '''Open the packed sequence store for a FASTA file, building it first if it is missing or out of date.'''
+    packed_filename = fasta_filename + EXTENSION
+    if (not os.path.exists(packed_filename) or
+            os.path.getmtime(packed_filename) < os.path.getmtime(fasta_filename)):
+        print('DEBUG: Building packed sequence file %s...' % packed_filename, file=sys.stderr)
+        build(fasta_filename, packed_filename)
+    return PackedSeqFile(packed_filename)
+
+
+def parse_cl():
+    parser = argparse.ArgumentParser()
+    parser.add_argument('infilenames', nargs='+',
+                        help='FASTA file(s) to pack; each store is written to [infilename]' + EXTENSION)
+    return parser.parse_args()
+
+if __name__ == '__main__':
+    args = parse_cl()
+    for infilename in args.infilenames:
+        build(infilename)
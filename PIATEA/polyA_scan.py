@@ -4,40 +4,48 @@
 
 from __future__ import print_function
 import sys
+import re
 import argparse
-from Bio import SeqIO
+import packed_seq
+
+CHUNK_LENGTH = 1000000
 
 def parse_cl():
     parser = argparse.ArgumentParser()
-    parser.add_argument('infile', nargs='?', type=argparse.FileType('r'), default=sys.stdin,
-                        help='BedGraph input file [default: STDIN]')
+    parser.add_argument('infilename',
+                        help='FASTA input file (a packed copy, [infilename].pseq, is made if needed)')
     parser.add_argument('outfile', nargs='?', type=argparse.FileType('w'), default=sys.stdout,
-                        help='BedGraph output file [default: STDOUT]')
+                        help='BED output file [default: STDOUT]')
     parser.add_argument('--min_length', type=int, default=6,
                         help='minimum number of consecutive As [default: 6]')
     return parser.parse_args()
 
-def scan(infile, outfile, min_length):
-    for seq in SeqIO.parse(infile, "fasta"):
-        countA = 0
-        countT = 0
-        for i in range(len(seq)):
-            if seq[i] == 'A':
-                countA = countA + 1
-            else:
-                if countA >= min_length:
-                    recordCount(countA, i, '+', seq, outfile)
-                countA = 0    
-            if seq[i] == 'T':
-                countT = countT + 1
-            else:
-                if countT >= min_length:
-                    recordCount(countT, i, '-', seq, outfile)
-                countT = 0
+def scan(infilename, outfile, min_length):
+    for seq in packed_seq.open_fasta(infilename):
+        pending = {'A': None, 'T': None}                                        # start of a run that reached the end of the previous chunk
+        for chunk_start in range(0, len(seq), CHUNK_LENGTH):
+            chunk = seq.fetch(chunk_start, chunk_start + CHUNK_LENGTH)
+            runs = []
+            for (letter, strand) in (('A', '+'), ('T', '-')):
+                if pending[letter] is not None and not chunk.startswith(letter):
+                    runs.append((pending[letter], chunk_start, strand))
+                    pending[letter] = None
+                for match in re.finditer(letter + '+', chunk):
+                    start = chunk_start + match.start()
+                    if pending[letter] is not None:                             # match starts the chunk, continuing the run
+                        start = pending[letter]
+                        pending[letter] = None
+                    if match.end() == len(chunk):
+                        pending[letter] = start
+                    else:
+                        runs.append((start, chunk_start + match.end(), strand))
+            for (start, end, strand) in sorted(runs, key=lambda run: run[1]):   # in order of run end, as scanned
+                if end - start >= min_length:
+                    recordCount(end - start, end, strand, seq, outfile)
 
 def recordCount(count, i, strand, seq, outfile):
     print('%s\t%i\t%i\t%s\t%i\t%s' % (seq.name, i-count, i, 'polyA', count, strand), file=outfile)
 
 if __name__ == '__main__':
     args = parse_cl()
-    scan(args.infile, args.outfile, args.min_length)
\ No newline at end of file
+    scan(args.infilename, args.outfile, args.min_length)
@@ -37,7 +37,6 @@ def parse_cl():
     parser.add_argument('infiles', nargs='+',
                         help='FASTA file(s) to search')
     
-    # TO DO
     parser.add_argument('--cpus', type=int, default=4,
                         help='max number of cpus to use')
     
@@ -95,6 +94,7 @@ if __name__ == '__main__':
         cfg.gap = args.gap
         cfg.ydrop = args.ydrop
         cfg.start = args.start
+        cfg.cpus = args.cpus
         termini_search.run(fasta_infile+'.termini_search', cfg)            
         
         print '\n*** Completed processing of file %s in %i seconds. ***\n' % (fasta_infile, time.time()-time0)
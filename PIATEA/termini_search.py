@@ -2,7 +2,7 @@
 
 """
 Run a sliding window self-LASTZ scan to identify potential terminal TE repeats, e.g. LTRs and TIRs.
-Input:  A FASTA sequence file to be scanned, e.g. a chromosome assembly.
+Input:  A FASTA sequence file to be scanned, e.g. a chromosome assembly, or a multi-FASTA genome assembly.
 Output: A BED file, written to STDOUT.
 
 Revisions:
@@ -11,6 +11,17 @@ Revisions:
     about an order of magnitude. (Not sure why as it's not clearly stated in the docs what steps are skipped
     for this action.) So instead, revised to manually chunk the input sequence into files and feed them to
     LASTZ, then adjust the coordinates.
+2. LASTZ output is read through a pipe rather than a temp file, and both the BED hits and the alignments
+    come from a single LASTZ run per window: the general format is extended with the text1/text2 fields
+    (aligned sequence text), from which the alignment file is rendered, instead of running LASTZ again
+    with --format=text.
+3. The sequence is read from a memory-mapped packed sequence store (packed_seq.py, built next to the FASTA
+    file on first use), so each window is extracted in O(window) time instead of parsing the whole
+    chromosome into memory in every process.
+4. Multi-FASTA input: sequences longer than the window length are scanned with sliding windows as before,
+    while shorter ones (e.g. the many small scaffolds of a draft assembly) are packed whole into shared
+    windows, separated by runs of Ns, and the hits are mapped back to each sequence. Hits spanning two
+    packed sequences are discarded.
 
 """
 
@@ -21,15 +32,15 @@ import re
 import time
 import argparse
 import os
-from subprocess import call
-from Bio import SeqIO
+import json
+import bisect
+from subprocess import Popen, PIPE
+from multiprocessing import Pool
+import packed_seq
 
 #START_POSITION = 9400001           # reverse strand error (chr1)
 #START_POSITION = 1450001           # reverse strand error (scaffold_1)
 
-hit_id_plus = 1                     # TO DO: make not global
-hit_id_minus = 1                    # TO DO: make not global
-
 def parse_cl():
     parser = argparse.ArgumentParser()
     parser.add_argument('infilename',
@@ -46,12 +57,16 @@ def parse_cl():
                         help='LASTZ gap penalties [default "400,30"]')
     parser.add_argument('--ydrop',
                         help='LASTZ y-drop threshold [default: not set => open+300*extend = 9400 for default gap settings]')   # see http://galaxylocal.genenetwork.org:8080/tool_runner?tool_id=lastz_paired_reads_wrapper
+    parser.add_argument('--cpus', type=int, default=1,
+                        help='number of windows to scan in parallel [default 1]')
     parser.add_argument('--start', type=int, default=0,
                         help='start at this position in the sequence (bp); zero-based indexing [default 0]')
+    parser.add_argument('--resume', action='store_true',
+                        help='resume an interrupted run from its journal ([outfilename].journal)')
     parser.add_argument('--alignments', action='store_true',
-                        help='output alignment files (requires an extra scan per window)')
+                        help='output alignment files')
     parser.add_argument('--no_bed', action='store_true',
-                        help='do not output bed files (requires an extra scan per window)')
+                        help='do not output bed files')
     args = parser.parse_args()
     if not (args.alignments) and args.no_bed:
         print("Cannot have --alignments=False and --no_bed=True because nothing will be output!", file=sys.stderr)
@@ -65,6 +80,8 @@ def parse_cl():
     cfg.gap = args.gap
     cfg.ydrop = args.ydrop
     cfg.start = args.start
+    cfg.cpus = args.cpus
+    cfg.resume = args.resume
     cfg.alignments = args.alignments
     cfg.no_bed = args.no_bed
     return cfg
@@ -79,119 +96,353 @@ class Config():
         self.gap = '400,30'
         self.ydrop = None
         self.start = 0
+        self.cpus = 1
+        self.resume = False
         self.alignments = False
         self.no_bed = False
 
-def read_seq(infile):
-    result = list(SeqIO.parse(infile, "fasta"))
+def read_seqs(infilename):
+    """Open the sequences as memory-mapped packed sequences (see packed_seq.py), without reading them into memory."""
+    result = packed_seq.open_fasta(infilename)
     if len(result) == 0:
-        raise Exception("No sequence found in file %s. Are you sure this is a FASTA file?" % (infile.name))
-    if len(result) > 1:
-        raise Exception("More than one sequence found in file %s." % (infile.name))
-    return result[0]
-
-def write_subseq(outfile, seq, start, end):
-    subseq = seq[start:end+1]                                                                       # adjust end b/c biopython appears to use non-inclusive end (right?)
-    SeqIO.write(subseq, outfile, "fasta")
+        raise Exception("No sequence found in file %s. Are you sure this is a FASTA file?" % (infilename))
+    return result
+
+def write_window(outfile, seqs, window, line_length=60):
+    """Write the window's segments to outfile as a single FASTA sequence, separated by runs of Ns."""
+    subseq = ('N' * SPACER_LENGTH).join(seqs[name].fetch(start, end+1)                            # fetch() uses non-inclusive end
+                                        for (name, start, end, cut_position) in window)
+    outfile.write('>%s\n' % window[0][0])
+    for i in range(0, len(subseq), line_length):
+        outfile.write(subseq[i:i+line_length] + '\n')
     outfile.flush()                                                                                 # needed!
 
-def calculate_windows(seq_length, cfg):
+def calculate_windows(seqs, cfg):
+    """
+    Divide the sequences into windows, each a list of segments (name, start, end, cut_position), with
+    start and end inclusive. A sequence longer than the window length is covered by overlapping windows
+    of a single segment; hits that terminate at or before cut_position are discarded because they were
+    already reported by the previous window. Shorter sequences are packed whole, in file order, into
+    shared windows, so that a draft assembly's many small scaffolds do not each need a LASTZ run.
+    """
+    if cfg.start != 0 and len(seqs) > 1:
+        raise Exception("--start can only be used with a single sequence; use --resume to restart a multi-sequence run.")
     windows = []
-    for start in range(cfg.start, seq_length, cfg.window_length - cfg.max_te_length):
-        windows.append((start, min(start + cfg.window_length-1, seq_length)))
+    packed = []
+    packed_length = 0
+    for seq in seqs:
+        seq_length = len(seq)
+        if seq_length <= cfg.window_length and cfg.start == 0:
+            if packed and packed_length + SPACER_LENGTH + seq_length > cfg.window_length:
+                windows.append(packed)
+                packed = []
+            if packed:
+                packed_length = packed_length + SPACER_LENGTH + seq_length
+            else:
+                packed_length = seq_length
+            packed.append((seq.name, 0, seq_length-1, -1))
+            continue
+        if packed:
+            windows.append(packed)
+            packed = []
+        cut_position = cfg.start-1
+        for start in range(cfg.start, seq_length, cfg.window_length - cfg.max_te_length):
+            end = min(start + cfg.window_length-1, seq_length-1)
+            windows.append([(seq.name, start, end, cut_position)])
+            cut_position = end
+    if packed:
+        windows.append(packed)
     return windows
 
-def to_bed(outfile, lastzfile, cut_position, window, cfg):
-    """Convert LASTZ output (default general format) to BED."""
-    global hit_id_plus
-    global hit_id_minus
+def describe_window(window):
+    if len(window) == 1:
+        (name, start, end, cut_position) = window[0]
+        return '%s [%d..%d]' % (name, start+1, end+1)                                               # convert to 1-based indexing: easier to read
+    return '%d packed sequences [%s..%s]' % (len(window), window[0][0], window[-1][0])
+
+class HitIds():
+    """Sequential hit IDs, numbered separately for each strand."""
+    def __init__(self, plus=1, minus=1):
+        self.plus = plus
+        self.minus = minus
+
+    def next(self, strand):
+        if strand == '+':
+            hit_id = "%s%s" % (self.plus, '+')
+            self.plus = self.plus + 1
+        else:
+            hit_id = "%s%s" % (self.minus, '-')
+            self.minus = self.minus + 1
+        return hit_id
+
+LASTZ_FIELDS = ['score', 'name1', 'strand1', 'size1', 'zstart1', 'end1', 'name2', 'strand2',
+                'size2', 'zstart2', 'end2', 'identity', 'idPct', 'coverage', 'covPct']        # LASTZ default general format
+LASTZ_TEXT_FIELDS = ['text1', 'text2']                                                      # aligned text, for the alignment file
+SPACER_LENGTH = 1000                                                                        # Ns between sequences packed into one window
+
+def parse_lastz(lastzfile, window, cfg):
+    """
+    Convert LASTZ output (general format) for a window to a list of hits in sequence coordinates, keeping
+    only hits that lie within a single segment of the window, terminate after the segment's cut_position
+    and are no longer than max_te_length. Lines are converted as they are read, so lastzfile may be a pipe.
+    If the output includes the text1/text2 fields, the alignments are also rendered as text.
+    Returns (hits, alignments).
+    """
     line1 = lastzfile.readline()
-    if line1 != ("#score\tname1\tstrand1\tsize1\tzstart1\tend1\tname2\tstrand2"+
-                 "\tsize2\tzstart2\tend2\tidentity\tidPct\tcoverage\tcovPct\n"):
+    if line1 == '#' + '\t'.join(LASTZ_FIELDS) + '\n':
+        with_text = False
+    elif line1 == '#' + '\t'.join(LASTZ_FIELDS + LASTZ_TEXT_FIELDS) + '\n':
+        with_text = True
+    else:
         raise Exception("Unexpected first line of LASTZ output file:\n"+line1)
+    offsets = []                                                                                # start of each segment in the window
+    offset = 0
+    for (name, start, end, cut_position) in window:
+        offsets.append(offset)
+        offset = offset + (end - start + 1) + SPACER_LENGTH
+    window_length = offset - SPACER_LENGTH
+    hits = []
+    alignments = []
     empty = True
     for line in lastzfile:
         empty = False
+        fields = line.split()
         (score, name1, strand1, size1, zstart1, end1, name2, strand2, size2,
-         zstart2, end2, identity, idPct, coverage, covPct) = line.split()
+         zstart2, end2, identity, idPct, coverage, covPct) = fields[:15]
         zstart1 = int(zstart1)
         zstart2 = int(zstart2)
         size2 = int(size2)
         end1 = int(end1)
         end2 = int(end2)
-        zstart1 = zstart1 + window[0]
-        end1 = end1 + window[0]
-        if (strand2 == '+'):
-            zstart2 = zstart2 + window[0]
-            end2 = end2 + window[0]
-        elif (strand2 == '-'):
-            right2 = window[1] - zstart2 + 1
-            left2 = window[1] - end2 + 1
+        if (strand2 == '-'):                                                                    # convert to forward strand
+            right2 = window_length - zstart2
+            left2 = window_length - end2
             zstart2 = left2
             end2 = right2
-        else:
+        elif (strand2 != '+'):
             raise Exception("Unexpected strand: '%s' " % strand2)
+        segment = bisect.bisect_right(offsets, min(zstart1, zstart2)) - 1
+        (name, start, end, cut_position) = window[segment]
+        if max(end1, end2) > offsets[segment] + (end - start + 1):                                # spans sequences packed into the window
+            continue
+        shift = start - offsets[segment]
+        name1 = name
+        name2 = name
+        zstart1 = zstart1 + shift
+        end1 = end1 + shift
+        zstart2 = zstart2 + shift
+        end2 = end2 + shift
+        if with_text:
+            alignments.append(format_alignment(name1, zstart1, end1, strand1, name2, zstart2, end2, strand2,
+                                               score, identity, idPct, fields[15], fields[16]))
         real_end =   max(zstart1, zstart2, end1, end2)
         real_start = min(zstart1, zstart2, end1, end2)
         if (real_end > cut_position) and (real_end - real_start <= cfg.max_te_length):
-            if (strand2 == '+'):
-                hit_id = "%s%s" % (hit_id_plus, '+')
-                hit_id_plus = hit_id_plus + 1
-            else:
-                hit_id = "%s%s" % (hit_id_minus, '-')
-                hit_id_minus = hit_id_minus + 1
-            if end2 != real_end:
-                print("\nDEBUG: end2 not max: ID %s %d-%d, %d-%d\n\t\t\t\t\t"
-                                 % (hit_id, zstart1, end1, zstart2, end2), file=sys.stderr)
             score = min(int(score)/100, 1000)                                                           # cram LASTZ score into range 1-1000
-            if cfg.format_type == 'blocks':
-                bSizes  = '%d,%d' % (end1-zstart1, end2-zstart2)
-                bStarts = '0,%d'  % (zstart2-zstart1)
-                label = '%s%s(%s)' % (identity, strand2, idPct)
-                print('%s\t'*12 % (name1, zstart1, end2, label, score, strand2, 0, 0, 0, 2, bSizes, bStarts), file=outfile)
-            else: # cfg.format == 'simple'
-                print('%s\t'*6 % (name1, zstart1, end1, hit_id, score, strand1), file=outfile)
-                print('%s\t'*6 % (name1, zstart2, end2, hit_id, score, strand2), file=outfile)
+            hits.append((segment, (name1, zstart1, end1, strand1, zstart2, end2, strand2, score, identity, idPct)))
     if empty:
-        print('WARNING!! No LASTZ results for %s in window [%d..%d].'
-                         % (cfg.infilename, window[0]+1, window[1]+1), file=sys.stderr)                              # convert to 1-based indexing: easier to read
+        print('WARNING!! No LASTZ results for %s in window %s.'
+                         % (cfg.infilename, describe_window(window)), file=sys.stderr)
+    hits.sort(key=lambda hit: hit[0])                                                           # group by sequence, otherwise in LASTZ order
+    return ([hit for (segment, hit) in hits], ''.join(alignments))
+
+def format_alignment(name1, zstart1, end1, strand1, name2, zstart2, end2, strand2, score, identity, idPct,
+                     text1, text2, width=60):
+    """Render one alignment as text, in blocks of width columns with a match line between the sequences."""
+    lines = ['#%s:%d-%d%s %s:%d-%d%s score=%s identity=%s(%s)' % (name1, zstart1+1, end1, strand1,   # 1-based, as in LASTZ text format
+                                                                   name2, zstart2+1, end2, strand2,
+                                                                   score, identity, idPct)]
+    for i in range(0, len(text1), width):
+        block1 = text1[i:i+width]
+        block2 = text2[i:i+width]
+        lines.append(block1)
+        lines.append(''.join('|' if a.upper() == b.upper() and a != '-' else ' ' for (a, b) in zip(block1, block2)))
+        lines.append(block2)
+        lines.append('')
+    return '\n'.join(lines) + '\n'
+
+def to_bed(hits, hit_ids, cfg):
+    """Format hits as BED, numbering them with hit_ids. Returns the BED text."""
+    lines = []
+    for (name1, zstart1, end1, strand1, zstart2, end2, strand2, score, identity, idPct) in hits:
+        hit_id = hit_ids.next(strand2)
+        if end2 != max(zstart1, zstart2, end1, end2):
+            print("\nDEBUG: end2 not max: ID %s %d-%d, %d-%d\n\t\t\t\t\t"
+                             % (hit_id, zstart1, end1, zstart2, end2), file=sys.stderr)
+        if cfg.format_type == 'blocks':
+            bSizes  = '%d,%d' % (end1-zstart1, end2-zstart2)
+            bStarts = '0,%d'  % (zstart2-zstart1)
+            label = '%s%s(%s)' % (identity, strand2, idPct)
+            lines.append('%s\t'*12 % (name1, zstart1, end2, label, score, strand2, 0, 0, 0, 2, bSizes, bStarts))
+        else: # cfg.format == 'simple'
+            lines.append('%s\t'*6 % (name1, zstart1, end1, hit_id, score, strand1))
+            lines.append('%s\t'*6 % (name1, zstart2, end2, hit_id, score, strand2))
+    return ''.join(line + '\n' for line in lines)
+
+class Journal():
+    """
+    Per-run record of completed windows, used by --resume to restart a killed scan without re-scanning.
+    One JSON object per line: first the settings that determine the windows and output, then, for each
+    completed window in order, the window, its BED fragment, the hit ID counters after the window and
+    the length of the alignment file after the window. Each record is synced to disk only after the
+    window's output has been, so every journaled window is safely in the output files.
+    """
+    def __init__(self, filename, cfg):
+        self.filename = filename
+        self.settings = {'infilename': os.path.abspath(cfg.infilename),
+                         'max_te_length': cfg.max_te_length, 'window_length': cfg.window_length,
+                         'format_type': cfg.format_type, 'gap': cfg.gap, 'ydrop': cfg.ydrop,
+                         'start': cfg.start, 'alignments': cfg.alignments, 'no_bed': cfg.no_bed}
+        self.records = []                                                                       # windows loaded by load(); add() only writes the file
+        self.file = None
+
+    def load(self):
+        """Read the completed windows from an existing journal; a partially written last record is ignored."""
+        if not os.path.exists(self.filename):
+            print('WARNING!! No journal %s; starting from the beginning.' % self.filename, file=sys.stderr)
+            return
+        with open(self.filename) as journal:
+            lines = journal.read().split('\n')[:-1]                                             # anything after the last newline is incomplete
+        if len(lines) == 0:
+            return
+        settings = json.loads(lines[0])
+        if settings.get('alignments') != self.settings['alignments']:
+            raise Exception("Journal %s was written %s --alignments; resume with the same setting."
+                            % (self.filename, 'with' if settings.get('alignments') else 'without'))
+        if settings != self.settings:
+            raise Exception("Journal %s was written with different settings:\n%s" % (self.filename, lines[0]))
+        self.records = [json.loads(line) for line in lines[1:]]
+
+    def open(self):
+        """
+        Start (or restart) the journal file, keeping any records already loaded. The journal is rewritten
+        to a temporary file that replaces it only once synced, so a kill meanwhile leaves the old one intact.
+        """
+        with open(self.filename + '.tmp', 'w') as journal:
+            for record in [self.settings] + self.records:
+                journal.write(json.dumps(record, sort_keys=True) + '\n')
+            self.sync(journal)
+        os.rename(self.filename + '.tmp', self.filename)
+        self.file = open(self.filename, 'a')
+
+    def add(self, window, bed, hit_ids, aln_length):
+        record = {'window': [list(segment) for segment in window], 'bed': bed, 'hit_id_plus': hit_ids.plus,
+                  'hit_id_minus': hit_ids.minus, 'aln_length': aln_length}
+        self.file.write(json.dumps(record, sort_keys=True) + '\n')
+        self.sync(self.file)
+
+    def close(self):
+        self.file.close()
+
+    @staticmethod
+    def sync(outfile):
+        outfile.flush()
+        os.fsync(outfile.fileno())
+
+seqs = None                         # per-process packed sequences being scanned, set by init_worker()
+
+def init_worker(infilename):
+    global seqs
+    seqs = read_seqs(infilename)
+
+def scan_window(task):
+    """Scan one window; runs in a worker process. Returns (window, hits, alignments)."""
+    (window, cfg) = task
+    print('DEBUG: Scanning window %s...' % describe_window(window), file=sys.stderr)
+    with tempfile.NamedTemporaryFile(mode='w') as subseq_file:                                  # automatic deletion on 'with' context exit
+        write_window(subseq_file, seqs, window)
+        time0 = time.time()
+        (hits, alignments) = scan(subseq_file.name, window, cfg)
+        print('\tWindow %s completed in %0.2f seconds.\n'
+              % (describe_window(window), time.time()-time0), file=sys.stderr)
+    return (window, hits, alignments)
+
+def scan_windows(windows, cfg):
+    """Scan the windows on a pool of cfg.cpus processes, yielding results in window order."""
+    tasks = [(window, cfg) for window in windows]
+    if cfg.cpus <= 1:
+        if seqs is None:
+            init_worker(cfg.infilename)
+        for task in tasks:
+            yield scan_window(task)
+        return
+    pool = Pool(cfg.cpus, init_worker, (cfg.infilename,))
+    try:
+        for result in pool.imap(scan_window, tasks):                                            # imap preserves task order
+            yield result
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
 
 def run(outfilename, cfg):
     bedfile = None
     alnfile = None
+    journal = Journal(outfilename+'.journal', cfg)
+    if cfg.resume:
+        journal.load()
+    done = journal.records
     if not cfg.no_bed:
-        bedfile = open(outfilename+'.bed', 'w')
+        bedfile = open(outfilename+'.bed', 'w')                                                 # rebuilt from the journal when resuming
+        for record in done:
+            bedfile.write(record['bed'])
     if cfg.alignments:
-        alnfile = open(outfilename+'.aln', 'w')
-    overlap_position = cfg.start-1
-    whole_seq = read_seq(cfg.infilename)                                                        # read full sequence
-    for window in calculate_windows(len(whole_seq.seq), cfg):
-        print('DEBUG: Scanning window [%d..%d]...' % (window[0]+1, window[1]+1), file=sys.stderr)     # convert to 1-based indexing: easier to read
-        with tempfile.NamedTemporaryFile() as subseq_file:                                      # automatic deletion on 'with' context exit
-            write_subseq(subseq_file, whole_seq, window[0], window[1])
-            time0 = time.time()
-            scan(subseq_file.name, bedfile, alnfile, overlap_position, window, cfg)
-            print('\tCompleted in %0.2f seconds.\n' % (time.time()-time0), file=sys.stderr)
-        overlap_position = window[1]                                                            # do not use hits that terminate before the end of the previous scan window
+        if len(done) > 0:
+            alnfile = open(outfilename+'.aln', 'a+')                                            # created if absent; writes always append
+            alnfile.seek(0, os.SEEK_END)
+            if alnfile.tell() < done[-1]['aln_length']:
+                raise Exception("Alignment file %s is shorter than journal %s records; cannot resume."
+                                % (alnfile.name, journal.filename))
+            alnfile.truncate(done[-1]['aln_length'])                                            # discard output from windows not in the journal
+        else:
+            alnfile = open(outfilename+'.aln', 'w')
+    if len(done) > 0:
+        hit_ids = HitIds(done[-1]['hit_id_plus'], done[-1]['hit_id_minus'])
+        print('DEBUG: Resuming after window %s.' % describe_window(done[-1]['window']), file=sys.stderr)
+    else:
+        hit_ids = HitIds()
+    journal.open()
+    init_worker(cfg.infilename)                                                                 # index the sequences
+    windows = calculate_windows(seqs, cfg)
+    if [[list(segment) for segment in window] for window in windows[:len(done)]] != [record['window'] for record in done]:
+        raise Exception("Journal %s does not match the windows of %s." % (journal.filename, cfg.infilename))
+    for (window, hits, alignments) in scan_windows(windows[len(done):], cfg):
+        bed = ''
+        aln_length = 0
+        if not cfg.no_bed:
+            bed = to_bed(hits, hit_ids, cfg)                                                    # IDs are assigned here, in window order, so they do not depend on cfg.cpus
+            bedfile.write(bed)
+            Journal.sync(bedfile)
+        if cfg.alignments:
+            alnfile.write(alignments)                                                           # concat new results to alignment file
+            Journal.sync(alnfile)
+            aln_length = alnfile.tell()
+        journal.add(window, bed, hit_ids, aln_length)
+    journal.close()
     if not cfg.no_bed:
         bedfile.close()
     if cfg.alignments:
         alnfile.close()
 
-def scan(seqfilename, bedfile, alnfile, overlap_position, window, cfg):
-    common = ['lastz', seqfilename, '--self', '--nomirror', '--ambiguous=iupac', '--gap='+cfg.gap]      # or, --ambiguous=n
-    if cfg.ydrop is not None:
-        common.append('--ydrop='+cfg.ydrop)
-    if not cfg.no_bed:
-        with tempfile.NamedTemporaryFile() as lastz_general:  
-            call(common + ['--format=general', '--output='+lastz_general.name])
-            to_bed(bedfile, lastz_general, overlap_position, window, cfg)
+def scan(seqfilename, window, cfg):
+    fields = LASTZ_FIELDS
     if cfg.alignments:
-        with open(os.devnull, 'w') as FNULL:
-            with tempfile.NamedTemporaryFile() as lastz_text:  
-                call(common + ['--format=text', '--output='+lastz_text.name], stdout=FNULL)     # this format prints tons of blank lines; redirect them to /dev/null
-                alnfile.write(lastz_text.read())                                                        # concat new results to alignment file
-                alnfile.flush()
+        fields = fields + LASTZ_TEXT_FIELDS
+    command = ['lastz', seqfilename, '--self', '--nomirror', '--ambiguous=iupac', '--gap='+cfg.gap,     # or, --ambiguous=n
+               '--format=general:'+','.join(fields)]                                                  # output goes to stdout
+    if cfg.ydrop is not None:
+        command.append('--ydrop='+cfg.ydrop)
+    lastz = Popen(command, stdout=PIPE, universal_newlines=True)
+    try:
+        (hits, alignments) = parse_lastz(lastz.stdout, window, cfg)
+    finally:
+        lastz.stdout.close()
+        returncode = lastz.wait()
+    if returncode != 0:
+        raise Exception("LASTZ failed (exit status %d) on window %s." % (returncode, describe_window(window)))
+    return (hits, alignments)
 
 '''
 TO DO:
@@ -0,0 +1,64 @@
+#!/usr/bin/env python
+
+'''
+Tests for calculate_consistency.py (run with python -m unittest or pytest from this directory).
+'''
+
+from __future__ import print_function
+import io
+import unittest
+import bedgraph
+import calculate_consistency
+
+
+def scan_lines(text, statistic, length):
+    tracks = bedgraph.read_tracks(io.StringIO(text))
+    output = ''.join(calculate_consistency.scan((chrom, tracks[chrom], statistic, length)) for chrom in tracks)
+    return [line.split('\t') for line in output.splitlines()]
+
+def value_at(lines, position):
+    for (chrom, start, end, value) in lines:
+        if int(start) <= position < int(end):
+            return float(value)
+    return None
+
+
+class TtestCodesTest(unittest.TestCase):
+
+    # 0 over [0, 100), 5 over [100, 200), then alternating values
+    TRACK = u'chr1\t0\t100\t0\nchr1\t100\t200\t5\n' + u''.join(
+        u'chr1\t%d\t%d\t%d\n' % (i, i+1, i % 2) for i in range(200, 300))
+
+    def test_all_zero_windows_are_written_as_minus_99(self):
+        lines = scan_lines(self.TRACK, 'ttest', 10)
+        self.assertEqual(value_at(lines, 50), -99)
+
+    def test_equal_constant_windows_are_written_as_minus_1(self):
+        lines = scan_lines(self.TRACK, 'ttest', 10)
+        self.assertEqual(value_at(lines, 150), -1)
+
+    def test_different_constant_windows_are_written_as_99(self):
+        lines = scan_lines(self.TRACK, 'ttest', 10)
+        self.assertEqual(value_at(lines, 100), 99)
+
+    def test_every_tested_base_is_written(self):
+        lines = scan_lines(self.TRACK, 'ttest', 10)
+        self.assertEqual(int(lines[0][1]), 10)
+        self.assertEqual(int(lines[-1][2]), 291)
+        for (previous, line) in zip(lines, lines[1:]):
+            self.assertEqual(previous[2], line[1])
+
+    def test_bases_without_both_windows_are_omitted(self):
+        lines = scan_lines(u'chr1\t0\t40\t5\nchr1\t40\t80\t9\nchr2\t0\t15\t3\n', 'ttest', 10)
+        self.assertEqual(lines[0][:2], ['chr1', '10'])
+        self.assertEqual(lines[-1][:3], ['chr1', '50', '71'])
+        self.assertFalse([line for line in lines if line[0] == 'chr2'])
+
+    def test_variation_keeps_only_positive_values(self):
+        lines = scan_lines(self.TRACK, 'variation', 10)
+        self.assertTrue(lines)
+        self.assertTrue(all(float(value) > 0 for (chrom, start, end, value) in lines))
+
+
+if __name__ == '__main__':
+    unittest.main()
@@ -0,0 +1,175 @@
+#!/usr/bin/env python
+
+'''
+Column store for TAG tuples (i,j,k,l).
+
+Each tuple is one row of the chart: its coordinates, log10 probability, label and back-pointers
+(the rows of the two tuples it was formed from, or -1) are kept in NumPy arrays rather than in one
+Python object per tuple, so that tree operations can be applied to all tuples of a stage at once.
+Derivation trees are not stored; they are rebuilt from the back-pointers only when they are needed,
+e.g. for the final parses.
+
+Coordinates are interned as integer IDs (see coordinateIds), so that tuple lists can be
+indexed by sorted integer arrays and searched with numpy.searchsorted instead of dicts of sets.
+'''
+
+import math
+import numpy
+
+NONE = -1                                                                   # back-pointer for "no sub-tuple"
+
+
+# A log10 probability as a probability, written like a float even where 10**logP would underflow.
+def formatProbability(logP):
+    if logP > -300:
+        return str(math.pow(10, logP))
+    exponent = int(math.floor(logP))
+    return "%se%d" % (str(math.pow(10, logP - exponent)), exponent)
+
+
+class Chart(object):
+
+    COLUMNS = (
+        ('i',       numpy.int32),
+        ('j',       numpy.int32),
+        ('k',       numpy.int32),
+        ('l',       numpy.int32),
+        ('logP',    numpy.float64),
+        ('label',   numpy.int8),
+        ('left',    numpy.int32),
+        ('right',   numpy.int32),
+    )
+
+    __slots__ = ('width', 'size', 'columns', 'labels', 'labelCodes')
+
+    # width: coordinates are < width (i.e. the sequence length + 1)
+    def __init__(self, width, capacity=1024):
+        if width ** 4 > numpy.iinfo(numpy.int64).max:
+            raise Exception("Sequence too long for the chart's coordinate IDs (max %d)." % (int((2**63) ** 0.25) - 1))
+        self.width = width
+        self.size = 0
+        self.columns = dict((name, numpy.zeros(capacity, dtype)) for (name, dtype) in Chart.COLUMNS)
+        self.labels = []                                                    # label code => label
+        self.labelCodes = {}                                                # label => label code
+
+    def __len__(self):
+        return self.size
+
+    # Column as an array over all rows, e.g. chart['logP'][rows]
+    def __getitem__(self, name):
+        return self.columns[name][:self.size]
+
+    def labelCode(self, label):
+        try:
+            return self.labelCodes[label]
+        except KeyError:
+            self.labelCodes[label] = len(self.labels)
+            self.labels.append(label)
+            return self.labelCodes[label]
+
+    # Add tuples, given as arrays (or scalars, which are broadcast), and return their rows.
+    def add(self, i, j, k, l, logP, label, left=NONE, right=NONE):
+        values = (i, j, k, l, logP, left, right)
+        if not any(isinstance(value, numpy.ndarray) for value in values):   # one tuple: no broadcasting
+            row = self.size
+            self.reserve(row + 1)
+            for ((name, dtype), value) in zip(Chart.COLUMNS, values[:5] + (self.labelCode(label),) + values[5:]):
+                self.columns[name][row] = value
+            self.size = row + 1
+            return numpy.arange(row, row + 1)
+        if numpy.ndim(i) and len(i) == 0:
+            return numpy.zeros(0, dtype=numpy.int64)
+        values = numpy.broadcast_arrays(i, j, k, l, logP, self.labelCode(label), left, right)
+        n = len(values[0]) if values[0].ndim else 1
+        self.reserve(self.size + n)
+        rows = numpy.arange(self.size, self.size + n)
+        for ((name, dtype), value) in zip(Chart.COLUMNS, values):
+            self.columns[name][self.size:self.size+n] = value
+        self.size = self.size + n
+        return rows
+
+    def reserve(self, capacity):
+        if capacity <= len(self.columns['i']):
+            return
+        capacity = max(capacity, 2 * len(self.columns['i']))                # grow geometrically
+        for (name, dtype) in Chart.COLUMNS:
+            column = numpy.zeros(capacity, dtype)
+            column[:self.size] = self.columns[name][:self.size]
+            self.columns[name] = column
+
+    # Interned coordinates: one int64 per (i,j,k,l), equal only for equal coordinates.
+    # Sorts by i, then j, k, l.
+    def coordinateIds(self, i, j, k, l):
+        w = self.width
+        return ((numpy.asarray(i, numpy.int64) * w + j) * w + k) * w + l
+
+    def getCoordinateIds(self, rows):
+        return self.coordinateIds(*[self[name][rows] for name in ('i', 'j', 'k', 'l')])
+
+    def coordinates(self, row):
+        return tuple(int(self.columns[name][row]) for name in ('i', 'j', 'k', 'l'))
+
+    def getLabel(self, row):
+        return self.labels[self.columns['label'][row]]
+
+    def getLogP(self, row):
+        return float(self.columns['logP'][row])
+
+    def getChildren(self, row):
+        return (int(self.columns['left'][row]), int(self.columns['right'][row]))
+
+    # Rows of the given rows that are the first with their coordinates, label and probability.
+    def unique(self, rows):
+        if len(rows) == 0:
+            return rows
+        keys = [self['logP'][rows].view(numpy.int64), self['label'][rows], self.getCoordinateIds(rows)]
+        order = numpy.lexsort(keys)
+        sortedKeys = [key[order] for key in keys]
+        first = numpy.ones(len(rows), dtype=bool)
+        first[1:] = numpy.any([key[1:] != key[:-1] for key in sortedKeys], axis=0)
+        return rows[numpy.sort(order[first])]
+
+    # Derivation tree of a row, rebuilt from the back-pointers (iteratively, since derivations can be deep).
+    def derivation(self, row):
+        trees = {}
+        stack = [row]
+        while stack:
+            current = stack[-1]
+            (left, right) = self.getChildren(current)
+            pending = [child for child in (left, right) if child != NONE and child not in trees]
+            if pending:
+                stack.extend(pending)
+                continue
+            stack.pop()
+            trees[current] = DerivationTree(self.coordinates(current), self.getLabel(current),
+                                            trees.get(left), trees.get(right), self.getLogP(current))
+        return trees[row]
+
+
+
+# To track derivation trees
+class DerivationTree(object):
+    
+    __slots__ = ('left', 'right', 'coordinates', 'label', 'logP')
+    
+    def __init__(self, (i,j,k,l), label, left, right, logP):
+        self.left = left
+        self.right = right
+        self.coordinates = (i,j,k,l)
+        self.label = label
+        self.logP = logP
+    
+    # TO DO: __repr__(), not toString()
+    def toString(self, dna):
+        (i,j,k,l) = self.coordinates
+        (s1, s2) = (dna[i:j], dna[k:l])
+        if self.left is None or self.right is None:
+            if s2 == "":
+                return "\n%s:   %s" % (s1, self.label)
+            else:
+                return "\n%s+%s: %s" % (s1, s2, self.label)
+        else:
+            fill = " " * (len(dna) - (j-i+l-k))
+            return "\n\t%s+%s %s %s %s %s %s %s" % (
+                s1, s2, fill, self.label, self.coordinates, formatProbability(self.logP),
+                self.left.toString(dna), self.right.toString(dna))
@@ -6,10 +6,25 @@ into 'middle' sequence.
 '''
 
 import math
-import itertools
 import time
+import numpy
 from sortedcollection import SortedCollection   # efficient sorted lists
 from operator import itemgetter
+from chart import Chart
+
+EMPTY = numpy.zeros(0, dtype=numpy.int64)
+
+def getStart(chart, row):
+    return int(chart['i'][row])
+
+def getEnd(chart, row):
+    return int(chart['l'][row])
+
+def overlaps(chart, row, other):
+    if getStart(chart, row) <= getStart(chart, other):
+        return getEnd(chart, row) > getStart(chart, other)     # Not if end == start because i specifies the index *before* the start)
+    else:
+        return getStart(chart, row) < getEnd(chart, other)
 
 # Like TupleList, but indexed by (yield, i), rather than just yield
 # (where i is the first index of the tuple).
@@ -22,17 +37,17 @@ from operator import itemgetter
 # through all insertables, so indexing is done for the B1 List instead.
 class InsertablesCollection():
 
-    def __init__(self, dna):
+    def __init__(self, dna, chart, maxInsertions):
         self.dna = dna
-        self.byYield    = []
-        self.D          = {}                                                 # (yield, i) => set(Tuple)
-        self.L          = SortedCollection(key=lambda tup: tup.getStart())   # sorted by i
+        self.maxInsertions = maxInsertions                                   # per combination
+        self.chart = chart                                                   # tuples are rows of the chart
+        self.byYield    = []                                                 # yield => rows
+        self.D          = {}                                                 # (yield, i) => rows
+        self.L          = SortedCollection(key=lambda row: chart['i'][row])  # sorted by i
         
-        # Combinations of tuples, stored in a collection sorted by start, of
-        # collections sorted by end, of non-overlapping combinations of Tuples.
-        # Can be accessed with like: groups = C[start][end], which will return
-        # an collection of all combinations of non-overlapping insertables between (start, end).
-        #self.C = CombinationCollection() 
+        # Combinations of tuples: C[start, end] is the list of all combinations of
+        # non-overlapping insertables between (start, end), once computed.
+        self.C = {}
         
     def __repr__(self):
         return self.D.values().__repr__()
@@ -40,106 +55,124 @@ class InsertablesCollection():
     def beginStage(self):
         self.tuplesForStage = []
 
-    def addToStage(self, tup):
-        self.tuplesForStage.append(tup)
+    def addToStage(self, rows):
+        self.tuplesForStage.append(rows)
     
     def getTuplesForStage(self):
-        return self.tuplesForStage
+        return numpy.concatenate([EMPTY] + self.tuplesForStage)
 
     def filterStage(self, aFilter):
-        self.tuplesForStage = aFilter.filter(self.tuplesForStage)
+        self.tuplesForStage = [aFilter.filter(self.chart, self.getTuplesForStage())]
     
     def completeStage(self):
-        self.addAll(self.tuplesForStage)
+        self.addAll(self.getTuplesForStage())
         self.tuplesForStage = None
     
-    def addAll(self, tuples):
-        for tup in tuples:
-            self.add(tup)
-        #if len(self.D.values()) > 12:
-        #    None
-            print "\t\tAdded insertable:" + tup.derivation.toString(self.dna)
+    # Identical tuples (same coordinates, label and probability) are only added once
+    def addAll(self, rows):
+        chart = self.chart
+        yields = chart['j'][rows] - chart['i'][rows] + chart['l'][rows] - chart['k'][rows]
+        added = [EMPTY]
+        for tYield in numpy.unique(yields):
+            existing = self.getTuplesOfYield(tYield)
+            merged = chart.unique(numpy.concatenate((existing, rows[yields == tYield])))
+            added.append(merged[len(existing):])
+            for row in added[-1]:
+                print "\t\tAdded insertable:" + chart.derivation(row).toString(self.dna)
+        self.addRows(numpy.concatenate(added))
     
-    def add(self, tup):
-        (i,j,k,l) = tup.coordinates
+    def add(self, row):
+        self.addRows(numpy.array([row], dtype=numpy.int64))
+    
+    # Add a batch of rows, extending each yield's and (yield, i)'s rows once per batch
+    def addRows(self, rows):
+        if len(rows) == 0:
+            return
+        chart = self.chart
+        i = chart['i'][rows]
+        l = chart['l'][rows]
+        yields = chart['j'][rows] - i + l - chart['k'][rows]
         
-        # add to byYield
-        try:
-            setByYield = self.byYield[tup.getYield()]
-        except IndexError:
-            setByYield = set()
-            self.byYield.extend([set() for x in range(len(self.byYield), tup.getYield())])  # fill in any missing entries up to current tuple yield (which may never be used)
-            self.byYield.append(setByYield)
-        setByYield.add(tup)
-        
-        # add to D
-        tupleSet = set()
-        try:
-            tupleSet = self.D[tup.getYield(), i]
-        except KeyError:
-            self.D[tup.getYield(), i] = tupleSet
-        tupleSet.add(tup)
+        # add to byYield and D
+        if yields.max() >= len(self.byYield):
+            self.byYield.extend([EMPTY for x in range(len(self.byYield), yields.max()+1)])  # fill in any missing entries up to the largest tuple yield (which may never be used)
+        for tYield in numpy.unique(yields):
+            ofYield = yields == tYield
+            self.byYield[tYield] = numpy.concatenate((self.byYield[tYield], rows[ofYield]))
+            for start in numpy.unique(i[ofYield]):
+                key = (int(tYield), int(start))
+                self.D[key] = numpy.concatenate((self.D.get(key, EMPTY), rows[ofYield & (i == start)]))
         
         # add to sorted list
-        self.L.insert_right(tup)
+        for row in rows:
+            self.L.insert_right(row)
+        
+        # forget combinations of the regions that may contain a new tuple
+        (first, last) = (i.max(), l.min())
+        for (start, end) in self.C.keys():
+            if start <= first and last <= end:
+                del self.C[start, end]
  
     # return all tuples (i,j,k,l) such that i>=start and l<=end, *** sorted by i ***
     def getTuplesInSegment(self, start, end):
+        chart = self.chart
         tuples = []
-        if (len(self.L) == 0) or (start > self.L[-1].getStart()):
+        if (len(self.L) == 0) or (start > getStart(chart, self.L[-1])):
             return tuples
         left = self.L.find_ge(start)  # tuple with lowest i >= start
-        for tup in self.L[self.L.index(left):]:
-            (i,j,k,l) = tup.coordinates
-            if (tup.getStart() > end):
+        for row in self.L[self.L.index(left):]:
+            if (getStart(chart, row) > end):
                 return tuples
-            if (tup.getEnd() > end):
+            if (getEnd(chart, row) > end):
                 continue
-            tuples.append(tup)
+            tuples.append(row)
         return tuples
     
-    # Return a list of all tuples
+    # Return all rows
     def getAllTuples(self):
-        tuples = []
-        for tupleSet in self.D.itervalues():
-            tuples.extend(tupleSet)
-        return tuples
+        return numpy.concatenate([EMPTY] + self.D.values())
     
-    # Return a list of tuples for the given yield
+    # Return the rows for the given yield
     def getTuplesOfYield(self, tYield):
         try:
-            return list(self.byYield[tYield])
+            return self.byYield[tYield]
         except IndexError:
-            return []                           # no parse entries for stage
+            return EMPTY                        # no parse entries for stage
     
-    # Return a list of tuples for the given yield
+    # Return the rows for the given yield and i
     def getTuplesOfYieldAndI(self, tYield, i):
-        if (tYield, i) in self.D:
-            return self.D[tYield, i]
-        else:
-            return set()
+        return self.D.get((tYield, i), EMPTY)
         
-    # Return a list of all combinations of non-overlapping insertables in region (start, end)
+    # Return a list of all combinations of non-overlapping insertables in region (start, end),
+    # as tuples of rows sorted by i: by number of insertables, then in order of the segment.
+    # Combinations are built as chains (each insertable followed only by those starting at or after its end),
+    # so overlapping sets are never generated, and are cached until an insertable is added inside the region.
     def combinations(self, start, end):
+        try:
+            return self.C[start, end]
+        except KeyError:
+            None
         time0 = time.clock()
+        chart = self.chart
         segment = self.getTuplesInSegment(start, end)
+        starts = [getStart(chart, row) for row in segment]
+        ends = [getEnd(chart, row) for row in segment]
+        following = [[b for b in range(a+1, len(segment)) if starts[b] >= ends[a]] for a in range(len(segment))]
+        chains = {}                                                             # (a, k) => chains of k insertables starting with a
+        def getChains(a, k):
+            if (a, k) not in chains:
+                if k == 1:
+                    chains[a, k] = [(a,)]
+                else:
+                    chains[a, k] = [(a,) + chain for b in following[a] for chain in getChains(b, k-1)]
+            return chains[a, k]
         nonoverlapping = []
-        limit = min(stag13.Probabilities.MAX_INSERTIONS_PER_MIDDLE+1, len(segment)+1)
-        for k in range(1, limit):
-            for combination in itertools.combinations(segment, k):
-                try:
-                    tup0 = None
-                    for tup in combination:
-                        if tup0 is None:
-                            tup0 = tup
-                        else:
-                            if tup.overlaps(tup0):
-                                raise ValueError()
-                            tup0 = tup
-                    nonoverlapping.append(combination)
-                except ValueError: None
+        for k in range(1, min(self.maxInsertions, len(segment)) + 1):
+            for a in range(len(segment)):
+                nonoverlapping.extend([tuple([segment[b] for b in chain]) for chain in getChains(a, k)])
         #print "\t\t---> insertion combinations (%s..%s): %-3s %0.1e s" % (
         #    start, end, len(nonoverlapping), time.clock()-time0)
+        self.C[start, end] = nonoverlapping
         return nonoverlapping
 
 if __name__ == "__main__":
@@ -152,9 +185,10 @@ if __name__ == "__main__":
     #    for o in combinations: print o
     #    None
     
-    insertables = InsertablesCollection()
+    chart = Chart(10)
+    insertables = InsertablesCollection("", chart, 5)
     for t in test:
-        insertables.add(stag13.Tuple((t[0],t[1],t[1],t[1]), None, None, '', 1))
+        insertables.add(chart.add(t[0], t[1], t[1], t[1], 0, '')[0])
     
     for c in insertables.combinations(3,5):
-        print c
+        print [chart.coordinates(row) for row in c]
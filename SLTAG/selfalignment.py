@@ -0,0 +1,157 @@
+#!/usr/bin/env python
+
+'''
+Self-alignment blocks of a sequence, i.e. the regions in which tree B1 looks for direct repeats.
+
+Each source iterates over blocks ((start0, end0), (start1, end1)), in 0-based, half-open coordinates
+of the parsed sequence, where [start0, end0) aligns to [start1, end1). Tree B1 is seeded with the
+position pairs inside the blocks rather than by testing every pair of positions.
+
+Sources:
+    AllMatch:       every position aligns to every other (for short test sequences)
+    BlastnHsps:     self-BLASTN HSPs, tabular output (-outfmt 6 or 7)
+    LastzBlocks:    self-LASTZ hits as written by PIATEA/termini_search.py (BED, either format_type)
+
+Only forward-strand alignments are used, since B1 parses direct repeats.
+'''
+
+import abc
+import numpy
+
+
+
+class SelfAlignment(object):
+    __metaclass__ = abc.ABCMeta
+
+    # Pairs are only taken within this many bases of a block's diagonal, beyond the difference in
+    # the lengths of its two sides (None: the whole rectangle).
+    band = None
+
+    @abc.abstractmethod
+    def blocks(self):
+        """Iterate over aligned blocks ((start0, end0), (start1, end1))."""
+        return
+
+    # Position pairs (i, j), i < j, inside the blocks, as two arrays sorted by i then j.
+    def pairs(self, length):
+        ids = [numpy.zeros(0, dtype=numpy.int64)]
+        for ((start0, end0), (start1, end1)) in self.blocks():
+            (start0, end0, start1, end1) = (max(start0, 0), min(end0, length), max(start1, 0), min(end1, length))
+            if end0 <= start0 or end1 <= start1:
+                continue
+            if self.band is None:
+                (i, j) = numpy.meshgrid(numpy.arange(start0, end0, dtype=numpy.int64),
+                                        numpy.arange(start1, end1, dtype=numpy.int64), indexing='ij')
+            else:
+                # only the diagonals j - i = (start1 - start0) + d, |d| <= width: O(aligned length * band)
+                width = self.band + abs((end1 - start1) - (end0 - start0))
+                (i, d) = numpy.meshgrid(numpy.arange(start0, end0, dtype=numpy.int64),
+                                        numpy.arange(-width, width + 1, dtype=numpy.int64), indexing='ij')
+                j = i + (start1 - start0) + d
+            keep = (i < j) & (j >= start1) & (j < end1)
+            ids.append(i[keep] * length + j[keep])
+        ids = numpy.unique(numpy.concatenate(ids))
+        return (ids // length, ids % length)
+
+    # Whether positions i and j (1-based) align to one another (kept for older grammars)
+    def containsPair(self, i, j):
+        for ((start0, end0), (start1, end1)) in self.blocks():
+            if start0 < i <= end0 and start1 < j <= end1:
+                return True
+        return False
+
+
+
+# Every position aligns to every other.
+class AllMatch(SelfAlignment):
+
+    def __init__(self, length):
+        self.length = length
+
+    def blocks(self):
+        yield ((0, self.length), (0, self.length))
+
+    def containsPair(self, i, j):
+        return True
+
+
+
+# Base class for alignments read from a file, optionally of a larger sequence (e.g. a chromosome)
+# of which the parsed sequence starts at offset.
+class AlignmentFile(SelfAlignment):
+
+    band = 10
+
+    def __init__(self, filename, offset=0, band=None):
+        self.filename = filename
+        self.offset = offset
+        if band is not None:
+            self.band = band
+        self.alignments = []
+        with open(filename) as infile:
+            for line in infile:
+                if line.strip() == "" or line[0] == '#' or line[0:5] == 'track' or line[0:7] == 'browser':
+                    continue
+                alignment = self.parseLine(line.split())
+                if alignment is not None:
+                    self.alignments.append(alignment)
+        self.alignments = self.pairHits(self.alignments)
+
+    @abc.abstractmethod
+    def parseLine(self, fields):
+        """Return ((start0, end0), (start1, end1)) in 0-based coordinates, or None to skip the line."""
+        return
+
+    def pairHits(self, alignments):
+        return alignments
+
+    def blocks(self):
+        for ((start0, end0), (start1, end1)) in self.alignments:
+            if start1 < start0:
+                ((start0, end0), (start1, end1)) = ((start1, end1), (start0, end0))
+            yield ((start0 - self.offset, end0 - self.offset), (start1 - self.offset, end1 - self.offset))
+
+
+
+# Self-BLASTN HSPs: qseqid sseqid pident length mismatch gapopen qstart qend sstart send evalue bitscore
+# (1-based, inclusive). The trivial self hit and minus-strand hits are skipped.
+class BlastnHsps(AlignmentFile):
+
+    def parseLine(self, fields):
+        (qstart, qend, sstart, send) = [int(x) for x in fields[6:10]]
+        if sstart > send or qend < qstart:
+            return None                                 # minus strand
+        if (qstart, qend) == (sstart, send):
+            return None                                 # sequence aligned to itself
+        return ((qstart-1, qend), (sstart-1, send))
+
+
+
+# Self-LASTZ hits from termini_search.py: either format_type 'blocks' (one BED12 line per hit, the
+# two sides as blocks) or 'simple' (one BED6 line per side, paired by hit ID).
+class LastzBlocks(AlignmentFile):
+
+    def parseLine(self, fields):
+        if len(fields) >= 12:
+            (start, strand) = (int(fields[1]), fields[5])
+            if strand != '+':
+                return None
+            sizes = [int(x) for x in fields[10].rstrip(',').split(',')]
+            starts = [int(x) for x in fields[11].rstrip(',').split(',')]
+            return ((start+starts[0], start+starts[0]+sizes[0]), (start+starts[1], start+starts[1]+sizes[1]))
+        else:
+            (start, end, hitId) = (int(fields[1]), int(fields[2]), fields[3])
+            if not hitId.endswith('+'):
+                return None
+            return (hitId, (start, end))
+
+    def pairHits(self, alignments):
+        blocks = [alignment for alignment in alignments if not isinstance(alignment[0], str)]
+        sides = {}
+        for alignment in alignments:
+            if isinstance(alignment[0], str):
+                sides.setdefault(alignment[0], []).append(alignment[1])
+        for hitId in sorted(sides):
+            if len(sides[hitId]) == 2:
+                blocks.append(tuple(sides[hitId]))
+        return blocks
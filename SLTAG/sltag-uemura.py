@@ -3,124 +3,199 @@
 """
 Simple linear tree adjoining grammar demo/test parser.
 See Uemura et al. 1999
+
+The recognition matrix M(i,j,k,l) is sparse: only the items that some tree actually derives are kept,
+as sorted arrays of interned coordinates (one int64 per (i,j,k,l)), by tree. Items are built bottom-up,
+by yield (j-i)+(l-k): every tree adds at least one terminal, so an item's inner item always has a smaller
+yield, and each yield is final once the smaller ones have been extended. Time and memory depend on the
+number of reachable items rather than on (n+1)^4, so kilobase inputs can be recognized.
 """
 
 
 
 import sys
 import time
+import numpy
+
+
+
+COMPLEMENT = numpy.arange(256, dtype=numpy.uint8)                   # other characters are their own complement
+for (base, complement) in zip("acgtACGT", "tgcaTGCA"):
+    COMPLEMENT[ord(base)] = ord(complement)
 
 
 
 class BetaTree:
     """An auxiliary tree"""
-    
+
     name = ""
     LU = 0
     LD = 0
     RD = 0
     RU = 0
-    
+    inverted = False                                    # right terminals are the reverse complement of the left ones
+    adjoinsInto = ()                                    # names of the trees whose items this tree can adjoin into
+
     def L(self):
         return self.LU + self.LD
-    
+
     def R(self):
         return self.RU + self.RD
-    
-    def __init__(self, aName, lu, ld, rd, ru):
+
+    def __init__(self, aName, lu, ld, rd, ru, inverted=False, adjoinsInto=None):
         self.name = aName
         self.LU = lu
         self.LD = ld
         self.RD = rd
-        self.RU = ru    
-
-
-
-# 4D square matrix
-def printMatrix(matrix):
-    n = len(matrix[0][0][0])
-    for i in range (0, n):
-        for j in range (0, n):
-            for k in range (0, n):
-                for l in range (0, n):
-                    if (matrix[i][j][k][l] != 0):
-                        print "M(%d,%d,%d,%d) = %s" % (i,j,k,l, matrix[i][j][k][l])
-
-
-
-def initialize(matrix, tree, dna):                           # TODO: multiple trees
+        self.RU = ru
+        self.inverted = inverted
+        self.adjoinsInto = (aName,) if adjoinsInto is None else tuple(adjoinsInto)
+        if self.L() != self.R() or self.L() == 0:
+            raise Exception("Tree %s must have as many terminals on the left as on the right, and at least one." % aName)
+
+    # Conditions (1.3) and (1.4), or (2.2) to (2.5): whether the terminals that this tree adds around items
+    # (i,j,k,l) (arrays) are a(i+1)...a(i+LU), a(j-LD+1)...a(j) on the left and a(k+1)...a(k+RD),
+    # a(l-RU+1)...a(l) on the right, and pair up as a direct or an inverted repeat.
+    def terminalsMatch(self, codes, i, j, k, l):
+        left = [i + t for t in range(self.LU)] + [j - self.LD + t for t in range(self.LD)]
+        right = [k + t for t in range(self.RD)] + [l - self.RU + t for t in range(self.RU)]
+        if self.inverted:
+            right = right[::-1]
+        valid = numpy.ones(numpy.shape(i), dtype=bool)
+        for (x, y) in zip(left, right):
+            y = COMPLEMENT[codes[y]] if self.inverted else codes[y]
+            valid = valid & (codes[x] == y)
+        return valid
+
+
+
+class Chart:
+    """Sparse M(i,j,k,l): the derived items of each tree, as sorted coordinate IDs"""
+
+    def __init__(self, n, trees):
+        self.width = n + 1
+        self.items = dict((tree.name, []) for tree in trees)  # tree name => ID arrays, one per yield
+        self.pending = {}                               # yield => tree name => list of ID arrays not yet added
+
+    def ids(self, i, j, k, l):
+        w = self.width
+        return ((numpy.asarray(i, numpy.int64) * w + j) * w + k) * w + l
+
+    def coordinates(self, ids):
+        w = self.width
+        return (ids // (w*w*w), ids // (w*w) % w, ids // w % w, ids % w)
+
+    # Queue items of tree name for adding, once all smaller yields have been processed.
+    def propose(self, name, i, j, k, l):
+        if len(i) == 0:
+            return
+        for (size, selected) in groupByYield((j - i) + (l - k)):
+            ids = self.ids(i[selected], j[selected], k[selected], l[selected])
+            self.pending.setdefault(size, {}).setdefault(name, []).append(ids)
+
+    # Add the pending items of the smallest yield; returns (yield, tree name => their IDs), or None when done.
+    # Items of one yield are only ever proposed before that yield is added, so they are new.
+    def nextYield(self):
+        if not self.pending:
+            return None
+        size = min(self.pending)
+        added = {}
+        for (name, ids) in self.pending.pop(size).items():
+            added[name] = numpy.unique(numpy.concatenate(ids))
+            self.items[name].append(added[name])
+        return (size, added)
+
+    # Sorted IDs of all items of a tree
+    def getItems(self, name):
+        if len(self.items[name]) != 1:
+            self.items[name] = [numpy.sort(numpy.concatenate(self.items[name] + [numpy.zeros(0, dtype=numpy.int64)]))]
+        return self.items[name][0]
+
+    def __len__(self):
+        return sum(len(ids) for arrays in self.items.values() for ids in arrays)
+
+
+
+def groupByYield(yields):
+    for size in numpy.unique(yields):
+        yield (int(size), yields == size)
+
+
+
+# 4D sparse matrix
+def printChart(chart):
+    for name in sorted(chart.items):
+        for (i,j,k,l) in zip(*[x.tolist() for x in chart.coordinates(chart.getItems(name))]):
+            print "M(%d,%d,%d,%d) = %s" % (i,j,k,l, name)
+
+
+
+def initialize(chart, trees, dna):
     n = len(dna)
-    for i in range(0, n+1):
-        for k in range(i, n+1):
-                                                        # TODO: for each beta tree
-            if (initializeConditionsAreValid(tree, dna, i, k)):
-                matrix[i][i+tree.L()][k][k+tree.R()] = tree.name
-
+    codes = numpy.frombuffer(dna, dtype=numpy.uint8)
+    for tree in trees:
+        for i in range(0, n - tree.L() - tree.R() + 1):
+            # (1.1) Beta is mature                      # TODO
+            # (1.2) i + |L(Beta)| <= k:
+            k = numpy.arange(i + tree.L(), n - tree.R() + 1)
+            i_ = numpy.repeat(i, len(k))
+            # (1.3) and (1.4)
+            valid = tree.terminalsMatch(codes, i_, i_ + tree.L(), k, k + tree.R())
+            chart.propose(tree.name, i_[valid], i_[valid] + tree.L(), k[valid], k[valid] + tree.R())
 
 
-def initializeConditionsAreValid(tree, dna, i, k):
-    # (1.1) Beta is mature                              # TODO
-    # (1.2) i + |L(Beta)| <= k:
-    if (i + tree.L() > k):   
-        return False
-    # (1.3) L(Beta) = a(i+1)...a(i+|L(Beta)|)
-    # (1.4) R(Beta) = a(k+1)...a(k+|R(Beta)|)
-    # combined 1.3 and 1.4 for treeB1 only:             # TODO: generalize, make part of tree classes
-    if (dna[i:i+1] != dna[k:k+1]):
-        return False
-    return True
 
-
-
-def construct(matrix, tree, dna):                       # TODO: multiple trees
+def construct(chart, trees, dna):
     n = len(dna)
-    for l in range(0, n+1):
-        for i in range(l, -1, -1):
-            for j in range(i, l+1):
-                for k in range(l, j-1, -1):
-                                                        # TODO: for each beta tree
-                    if (constructConditionsAreValid(matrix, tree, dna, i, j, k, l)):
-                        M[i][j][k][l] = tree.name
-
-
-
-def constructConditionsAreValid(matrix, tree, dna, i, j, k, l):
-    # (2.1) (See Urema et al. 1999)
-    n = len(matrix[0][0][0])
-    if (i+tree.LU < n and k+tree.RD < n and                           # !!! This part not specified in conditions... mistake in Uemura, or bug?
-        matrix[i+tree.LU][j-tree.LD][k+tree.RD][l-tree.RU]) != "B1":
-        return False
-    #print "M(%d,%d,%d,%d) == B1" % (i+tree.LU, j-tree.LD, k+tree.RD, l-tree.RU)
-    # (2.2) to (2.5):                                   # TODO: generalize, make part of tree classes
-    if (dna[i:i+1] != dna[k:k+1]):
-        return False
-    return True
-
-
-
-def recognize(matrix):
-    n = len(matrix[0][0][0])
-    for i in range(0, n):
-        if (matrix[0][i][i][n-1] == "B1"):
-            print "Accepted (M(%d,%d,%d,%d))" % (0,i,i,n)
+    codes = numpy.frombuffer(dna, dtype=numpy.uint8)
+    while True:
+        step = chart.nextYield()
+        if step is None:
+            break
+        (size, added) = step
+        for tree in trees:
+            inner = [added[name] for name in tree.adjoinsInto if name in added]
+            if not inner:
+                continue
+            (i, j, k, l) = chart.coordinates(numpy.concatenate(inner))
+            # (2.1) (See Uemura et al. 1999): M(i+LU, j-LD, k+RD, l-RU) is derived, for the item being built
+            (i, j, k, l) = (i - tree.LU, j + tree.LD, k - tree.RD, l + tree.RU)
+            valid = (i >= 0) & (j <= k) & (l <= n)
+            (i, j, k, l) = (i[valid], j[valid], k[valid], l[valid])
+            # (2.2) to (2.5)
+            valid = tree.terminalsMatch(codes, i, j, k, l)
+            chart.propose(tree.name, i[valid], j[valid], k[valid], l[valid])
+
+
+
+def recognize(chart):
+    n = chart.width - 1
+    for name in sorted(chart.items):
+        (i, j, k, l) = chart.coordinates(chart.getItems(name))
+        for middle in j[(i == 0) & (j == k) & (l == n)].tolist():
+            print "Accepted (M(%d,%d,%d,%d) = %s)" % (0,middle,middle,n, name)
 
 
 
 # Main:
 
-start = time.clock()
-dna = sys.argv[1]
-n = len(dna)
-treeB1 = BetaTree("B1",1,0,1,0)  # direct repeat tree (LTR or TSD)
-M = [[[[0 for x in xrange(n+1)] for x in xrange(n+1)] for x in xrange(n+1)] for x in xrange(n+1)]  # TODO: use NumPy
-initialize(M, treeB1, dna)
-#printMatrix(M); print; print
-construct(M, treeB1, dna)
-#printMatrix(M)
-recognize(M)
-end = time.clock()
-print "dna length: ", n
-print "elpsed time: ", end - start
-raw_input("Press any key to exit: ")
-
-# End
\ No newline at end of file
+if __name__ == "__main__":
+    start = time.clock()
+    dna = sys.argv[1]
+    n = len(dna)
+    treeB1 = BetaTree("B1",1,0,1,0)  # direct repeat tree (LTR or TSD)
+    treeB2 = BetaTree("B2",1,0,0,1,inverted=True)  # inverted repeat tree (TIR)
+    trees = [treeB1, treeB2]
+    M = Chart(n, trees)
+    initialize(M, trees, dna)
+    construct(M, trees, dna)
+    #printChart(M)
+    recognize(M)
+    end = time.clock()
+    print "dna length: ", n
+    print "items: ", len(M)
+    print "elpsed time: ", end - start
+    if sys.stdin.isatty():
+        raw_input("Press any key to exit: ")
+
+# End
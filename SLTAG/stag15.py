@@ -67,6 +67,11 @@ v13: Changed how "middle" sequence is handled. Motivation: middle is essentially
         a string of whatever length is needed to join the LTRs (only when the final length of the contiguous sequence matches the stage).
             - As a result, need to change how "evaluate" is done. Rather than direclty accessing the A1 list from B1, have B1 ask A1 for the requisite
                 sequence, which is then generated on the fly.
+
+v15: Tuples are rows of a column store (see chart.py) rather than one object each: coordinates, log10 probabilities,
+        labels and back-pointers are NumPy arrays, and adjoin, substitute, insert and the filters work on all tuples of
+        a stage at once. Derivation trees are rebuilt from the back-pointers when printed.
+     Probabilities are log10 throughout (constants, substitution probabilities, filters), so long sequences do not underflow.
     
 TO DO next: - Allow gaps (use BLASTN results?). Also allow N's (allow them to match or not?)
             - Find TEs embedded in genomic sequence, not just full TEs.
@@ -124,7 +129,9 @@ import re                                       # regular expressions
 import math
 import time                                     # to measure performance
 from operator import attrgetter                 # for sorting
+import numpy
 import insertables
+from chart import Chart, DerivationTree, NONE, formatProbability
 
 
 
@@ -137,6 +144,7 @@ class Probabilities:
     ALPHA_IDENTICAL_COORDS      = 0.999     # don't set to 1 b/c floating point imprecision may causes issues??
     
     A1_PROBABILITY = 0.25     # "Middle" sequence. Should be > mismatch P but << than match P. ??? Needs to be 0.25 (to sum to 1) ???
+    LOG_A1_PROBABILITY = math.log10(A1_PROBABILITY)
     
     # Blastn alignment adjustments
     #class Blastn:
@@ -146,7 +154,7 @@ class Probabilities:
     # Match/mismatch probabilities
     class B1Matrix:
         # Should the sum add to one, or the sum of the square roots (since there are 2 terminals being generated)?
-        M = math.log(0.90/4  # match         
+        M = 0.90/4  # match         
         I = 0.12/4  # transition      # Needs to be < a1Probability^2 ??
         V = 0.08/8  # transversion    # Needs to be < a1Probability^2 ??
         X = {
@@ -155,6 +163,7 @@ class Probabilities:
             ('a','t'): V, ('t','a'): V, ('g','t'): V, ('t','g'): V,     # transversions
             ('a','c'): V, ('c','a'): V, ('c','g'): V, ('g','c'): V,     # transversions
         }
+        LOG_X = dict((pair, math.log10(p)) for (pair, p) in X.items())
     
     # Operations
     # TO DO: How exactly should operation probabilities add to 1? Seems like it should be
@@ -167,68 +176,70 @@ class Probabilities:
         B1_ADJOIN       = 0.95
         B1_SUBSTITUTE   = 1 - B1_ADJOIN - INSERT     # square-root of B1_ADJOIN to normalize
         A1_SUBSTITUTE   = 1 - INSERT
+        LOG_INSERT          = math.log10(INSERT)
+        LOG_B1_ADJOIN       = math.log10(B1_ADJOIN)
+        LOG_B1_SUBSTITUTE   = math.log10(B1_SUBSTITUTE)
+        LOG_A1_SUBSTITUTE   = math.log10(A1_SUBSTITUTE)
 
 
 
     # Class methods
+    # All probabilities are log10, so that long sequences (0.25^length) do not underflow.
+    # length may be an array.
     @staticmethod
-    def calcSubstitutionProb(length):
-        assert length > 0
-        prob = math.pow(Probabilities.A1_PROBABILITY, length)                     # P (emissions)
-        return prob * math.pow(Probabilities.Operations.A1_SUBSTITUTE, length)    # P (substitutions)
+    def calcSubstitutionLogProb(length):
+        assert numpy.all(length > 0)
+        return length * (Probabilities.LOG_A1_PROBABILITY +                       # P (emissions)
+                         Probabilities.Operations.LOG_A1_SUBSTITUTE)              # P (substitutions)
 
 
 
 class Filter:
     @abc.abstractmethod
-    def filter(self, tuples):
-        """Filter tuples."""
+    def filter(self, chart, rows):
+        """Filter tuples (rows of the chart). Returns the rows that pass."""
         return
 
 
 
+# For each element, the maximum of values over all elements with the same keys (a list of arrays).
+def groupMaximum(keys, values):
+    if len(values) == 0:
+        return values
+    order = numpy.lexsort(keys)
+    first = numpy.ones(len(values), dtype=bool)
+    first[1:] = numpy.any([key[order][1:] != key[order][:-1] for key in keys], axis=0)
+    maxima = numpy.maximum.reduceat(values[order], numpy.flatnonzero(first))
+    result = numpy.empty_like(values)
+    result[order] = maxima[numpy.cumsum(first) - 1]
+    return result
+
+
+
 # Filter tuples that have identical coordinates, but probability' < alpha*probability.
 # Identical coordinates means that (i,j,k,l) == (i',j',k',l'), or
 # (i,l) == (i',l') and j == k and j' == k' (but j might not == j' nor k == k').
 # (The latter case is for contiguous substrings.)
 class IdenticalCoordinatesFilter(Filter):
     
-    # Generate set of tuples used for filtering.
-    # Input: Iterator over tuples, all to be used for filtering.
-    def __init__(self, alpha, tuples):
-        self.alpha = alpha
-
-        # construct data structures:
-        # 1. j == k: (i,l) => maxP
-        # 2. j != k: (i,j,k,l) => maxP
-        self.ilMap = {}
-        self.ijklMap = {}
-        for tup in tuples:
-            (i,j,k,l) = tup.coordinates
-            if j == k:
-                try:
-                    self.ilMap[(i,l)] = max(self.ilMap[(i,l)], tup.getProbability())
-                except KeyError:
-                    self.ilMap[(i,l)] = tup.getProbability()
-            else:
-                try:
-                    self.ijklMap[(i,j,k,l)] = max(self.ijklMap[(i,j,k,l)], tup.getProbability())
-                except KeyError:
-                    self.ijklMap[(i,j,k,l)] = tup.getProbability()
-    
-    # Perform filtering based on the tuples that must be previously passed to setTuples().
-    # Returns the tuples that pass through the filter.
-    def filter(self, tuples):
-        filtered = []
-        for tup in tuples:
-            (i,j,k,l) = tup.coordinates
-            if j == k:
-                if tup.getProbability() >= self.alpha * self.ilMap[(i,l)]:
-                    filtered.append(tup)
-            else:
-                if tup.getProbability() >= self.alpha * self.ijklMap[(i,j,k,l)]:
-                    filtered.append(tup) 
-        return filtered
+    # Generate the maximum probability for each set of identical coordinates.
+    # Input: rows of the chart, all to be used for filtering.
+    def __init__(self, alpha, chart, rows):
+        self.logAlpha = math.log10(alpha)
+        
+        # key: (i,l) if j == k, (i,j,k,l) otherwise
+        (i, j, k, l) = [chart[name][rows] for name in ('i', 'j', 'k', 'l')]
+        contiguous = j == k
+        keys = [numpy.where(contiguous, NONE, k), numpy.where(contiguous, NONE, j), l, i]
+        self.order = numpy.argsort(rows, kind='mergesort')
+        self.rows = rows[self.order]
+        self.maxLogP = groupMaximum(keys, chart['logP'][rows])[self.order]
+    
+    # Perform filtering based on the rows passed to the constructor.
+    # Returns the rows that pass through the filter.
+    def filter(self, chart, rows):
+        maxLogP = self.maxLogP[numpy.searchsorted(self.rows, rows)]
+        return rows[chart['logP'][rows] >= self.logAlpha + maxLogP]
 
 
 
@@ -236,28 +247,12 @@ class IdenticalCoordinatesFilter(Filter):
 class MatchFilter(Filter):
     
     def __init__(self, alpha):
-        self.alpha = alpha
-    
-    def filter(self, tuples):
-        # construct data structure: (i,j) => maxP
-        ijMap = {}
-        for tup in tuples:
-            (i,j,k,l) = tup.coordinates
-            try:
-                ijMap[(i,j)] = max(ijMap[(i,j)], tup.getProbability())
-            except KeyError:
-                ijMap[(i,j)] = tup.getProbability()
-        
-        # filter
-        filtered = []
-        for tup in tuples:
-            (i,j,k,l) = tup.coordinates
-            if tup.getProbability() >= self.alpha * ijMap[(i,j)]:
-                filtered.append(tup)
-
-        return filtered
+        self.logAlpha = math.log10(alpha)
     
-        # TO DO: don't just throw away these data structures and return a list... they may be useful to keep
+    def filter(self, chart, rows):
+        logP = chart['logP'][rows]
+        maxLogP = groupMaximum([chart['j'][rows], chart['i'][rows]], logP)     # (i,j) => maxP
+        return rows[logP >= self.logAlpha + maxLogP]
     
     
     
@@ -268,17 +263,11 @@ class MatchFilter(Filter):
 class InsertablesFilter(Filter):
     
     def __init__(self, alpha):
-        self.alpha = alpha
-
-    def filter(self, tuples):
-        filtered = []
-        for tup in tuples:
-            if (tup.getProbability() * Probabilities.Operations.INSERT >=
-                self.alpha * Probabilities.calcSubstitutionProb(tup.getEnd() - tup.getStart())):
-                    filtered.append(tup)
-            else:
-                None
-        return filtered
+        self.logAlpha = math.log10(alpha)
+
+    def filter(self, chart, rows):
+        logSubstitution = Probabilities.calcSubstitutionLogProb(chart['l'][rows] - chart['i'][rows])
+        return rows[chart['logP'][rows] + Probabilities.Operations.LOG_INSERT >= self.logAlpha + logSubstitution]
 
 
 
@@ -288,10 +277,13 @@ class Grammar:
     def __init__(self, selfBlastn, dna):
         
         # BLASTN-defined regions in which to look for termini, of form [(start0,end0),(start1,end1)],
-        # which define the two blocks that align to one another.
+        # which define the two blocks that align to one another (see selfalignment.py).
         self.selfBlastn = selfBlastn
         self.dna = dna
         
+        # All tuples of all trees, which the trees' tuple lists refer to by row
+        self.chart = Chart(len(dna)+1)
+        
         # Initial Trees
         self.treeA1 = TreeA1(self)
         
@@ -299,7 +291,7 @@ class Grammar:
         self.treeB1 = TreeB1(self)
         
         # Insertables, which are common to all trees
-        self.insertables = insertables.InsertablesCollection(dna)
+        self.insertables = insertables.InsertablesCollection(dna, self.chart, Probabilities.MAX_INSERTIONS_PER_MIDDLE)
         
         # Probabilities & Filters
         #self.probabilities = Probabilities()
@@ -347,13 +339,13 @@ class Grammar:
         self.treeB1.filterStage(self.matchFilter)
             
         # Filter all tuples for low probability derivations
-        allTuples = []
-        allTuples.extend(self.insertables.getTuplesForStage())
-        #allTuples.extend(self.treeA1.nonadjoinables.getTuplesForStage())
-        allTuples.extend(self.treeB1.adjoinables.getTuplesForStage())
-        allTuples.extend(self.treeB1.nonadjoinables.getTuplesForStage())
+        allTuples = numpy.concatenate((
+            self.insertables.getTuplesForStage(),
+            #self.treeA1.nonadjoinables.getTuplesForStage(),
+            self.treeB1.adjoinables.getTuplesForStage(),
+            self.treeB1.nonadjoinables.getTuplesForStage()))
         identicalCoordFilter = IdenticalCoordinatesFilter(
-            Probabilities.ALPHA_IDENTICAL_COORDS, allTuples)
+            Probabilities.ALPHA_IDENTICAL_COORDS, self.chart, allTuples)
         self.treeB1.filterStage(identicalCoordFilter)
         #self.treeA1.filterStage(identicalCoordFilter)
         self.insertables.filterStage(identicalCoordFilter)
@@ -369,7 +361,7 @@ class Grammar:
         
     def recognizeInput(self, dna):
         #completeParses = self.insertables.getTuplesOfYield(len(dna))
-        completeParses = self.treeB1.adjoinables.getTuplesOfYield(len(dna))     # Note: Always of form (0,p,p,len(dna))
+        completeParses = self.getTuples(self.treeB1.adjoinables.getTuplesOfYield(len(dna)))     # Note: Always of form (0,p,p,len(dna))
         for tup in completeParses:
             (i,j,k,l) = tup.coordinates
             assert j == k
@@ -385,27 +377,32 @@ class Grammar:
             return True
     
     def printParses(self, stage):
-        parses = self.treeB1.getTuplesOfYield(stage)     # Note: Always of form (0,p,p,len(dna))
+        parses = self.getTuples(self.treeB1.getTuplesOfYield(stage))     # Note: Always of form (0,p,p,len(dna))
         print "\n%s Parses:" % len(parses)
         self.printDerivations(parses)
     
     def printInsertables(self, stage):
-        insertables = self.insertables.getTuplesOfYield(stage)     # Note: Always of form (0,p,p,len(dna))
+        insertables = self.getTuples(self.insertables.getTuplesOfYield(stage))     # Note: Always of form (0,p,p,len(dna))
         print "\n%s Insertables:" % len(insertables)
         self.printDerivations(insertables)
     
     def printDerivations(self, tuples):
-        tuples.sort(key=attrgetter('logP'), reverse=False)
+        dna = self.dna
+        tuples = sorted(tuples, key=attrgetter('logP'), reverse=False)
         for count in range(0, len(tuples)):
             tup = tuples[count]
             (i,j,k,l) = tup.coordinates
             (s1, s2) = (dna[i:j], dna[k:l])
             print "\nDerivation #%s: (%d,%d,%d,%d) %s+%s %s" % (
                     len(tuples)-count,
-                    i,j,k,l,s1,s2, math.pow(10, tup.logP))
+                    i,j,k,l,s1,s2, formatProbability(tup.logP))
             print "=" * (len(dna)+48)
             #print; print tup.derivationString
-            print tup.derivation.toString(dna)
+            print tup.getDerivation().toString(dna)
+    
+    # Tuple objects for rows of the chart, e.g. for printing
+    def getTuples(self, rows):
+        return [Tuple(self.chart, row) for row in rows]
     
     def dump(self):
         print "\n\n\n" + "*" * 30
@@ -414,47 +411,29 @@ class Grammar:
         print "\nTree B1:\n%s" % self.treeB1.__repr__()
         print "\nTree A1:\n%s" % self.treeA1.__repr__()
 
-    def isInsertable(self, tup, dna):
-        (i,j,k,l) = tup.coordinates
-        if j == k and l-i >= min(Probabilities.MIN_INSERTABLE_LENGTH, len(dna)):
-            #(s1, s2) = (dna[i:j], dna[k:l])
-            #print "%s+%s \t length %d \t (%d,%d,%d,%d)" % (s1,s2,l-i,i,j,k,l)           
-            return True
-        return False
+    # Which of the rows are insertable: contiguous and long enough
+    def isInsertable(self, rows, dna):
+        chart = self.chart
+        return ((chart['j'][rows] == chart['k'][rows]) &
+                (chart['l'][rows] - chart['i'][rows] >= min(Probabilities.MIN_INSERTABLE_LENGTH, len(dna))))
 
 
 
-# Tuple coordinates plus other data, such as the sub-tuples that formed this tuple for back-tracing.
-class Tuple:
+# A tuple of the chart: its coordinates plus other data, such as the sub-tuples that formed this
+# tuple for back-tracing (which are kept in the chart as back-pointers).
+class Tuple(object):
     
-    def __init__(self, (i,j,k,l), leftTuple, rightTuple, label, probability=None):
-        '''If proabability is specified, it is used. Otherwise, leftTuple and rightTuple must not
-        be none and probability is the product of their probabilities'''
-        self.coordinates = (i,j,k,l)
-        self.label = label
-        #self.derivationString = label + ":"
-        
-        if probability is not None:
-            self.setProbability(probability)
-        else:
-            self.setProbability(leftTuple.getProbability() * rightTuple.getProbability())
-            
-        leftDerivation = None
-        if leftTuple is not None:
-            leftDerivation = leftTuple.derivation
-        #    self.derivationString = self.derivationString + leftTuple.derivationString + ","
-        #else:
-        #    self.derivationString = self.derivationString + "E,"
-        rightDerivation = None
-        if rightTuple is not None:
-            rightDerivation = rightTuple.derivation
-        #    self.derivationString = self.derivationString + rightTuple.derivationString
-        #else:
-        #    self.derivationString = self.derivationString + "E"
-        self.derivation = DerivationTree((i,j,k,l), label, leftDerivation, rightDerivation, self.getProbability())  # TO DO: Ugly to store this in both Tuple & DerivationTree
+    __slots__ = ('chart', 'row', 'coordinates', 'label', 'logP')
+    
+    def __init__(self, chart, row):
+        self.chart = chart
+        self.row = row
+        self.coordinates = chart.coordinates(row)
+        self.label = chart.getLabel(row)
+        self.logP = chart.getLogP(row)
   
     def __repr__(self):
-        return "%s %s" % (self.coordinates.__repr__(), self.getProbability())
+        return "%s %s" % (self.coordinates.__repr__(), formatProbability(self.logP))
     
     def __eq__(self, other):
         if isinstance(other, Tuple):
@@ -484,57 +463,37 @@ class Tuple:
         else:
             return self.getStart() < other.getEnd()
     
-    def scaleProbability(self, coeff):
-        self.setProbability(self.getProbability() * coeff)
-    
     def getYield(self):
         (i,j,k,l) = self.coordinates
         return j-i+l-k
     
+    # May underflow to 0 for long tuples; use logP where possible
     def getProbability(self):
         return math.pow(10, self.logP)
     
-    def setProbability(self, prob):
-        self.logP = math.log10(prob)
+    # Built from the chart's back-pointers on each call
+    def getDerivation(self):
+        return self.chart.derivation(self.row)
 
 
 
-# To track derivation trees
-class DerivationTree:
+# Lists of tuples (rows of the chart), indexed by yield.
+# Every tuple formed at a stage has the stage as its yield, so each yield's rows are added at once.
+# Lookups by J, L or coordinates use sorted integer arrays per yield (built on first use), rather than
+# dicts of sets, so each tuple is stored once (as a row) plus one int64 key and row per index.
+class TupleList(object):
     
-    def __init__(self, (i,j,k,l), label, left, right, probability):
-        self.left = left
-        self.right = right
-        self.coordinates = (i,j,k,l)
-        self.label = label
-        self.probability = probability
+    __slots__ = ('chart', 'byYield', 'yields', 'allTuples', 'indexes', 'tuplesForStage')
     
-    # TO DO: __repr__(), not toString()
-    def toString(self, dna):
-        (i,j,k,l) = self.coordinates
-        (s1, s2) = (dna[i:j], dna[k:l])
-        if self.left is None or self.right is None:
-            if s2 == "":
-                return "\n%s:   %s" % (s1, self.label)
-            else:
-                return "\n%s+%s: %s" % (s1, s2, self.label)
-        else:
-            fill = " " * (len(dna) - (j-i+l-k))
-            return "\n\t%s+%s %s %s %s %s %s %s" % (
-                s1, s2, fill, self.label, self.coordinates, self.probability,
-                self.left.toString(dna), self.right.toString(dna))
-
-
-# Lists (actually, sets) of tuples, indexed by yield
-class TupleList:
-    
-    def __init__(self):
-        # TO DO: integrate these data structures into one (to save memory and a bit of time?)
-        self.allTuples      = []
-        self.byYield        = {}     
-        self.byYieldAndJ    = {}
-        self.byYieldAndL    = {}
-        self.byIJKL         = {}    # for adjoin
+    EMPTY = numpy.zeros(0, dtype=numpy.int64)
+    
+    def __init__(self, chart):
+        self.chart = chart
+        self.byYield        = {}        # yield => rows
+        self.yields         = []        # in the order added
+        self.allTuples      = None      # all rows, cached
+        self.indexes        = {}        # (yield, column) => (sorted keys, rows in key order)
+        self.tuplesForStage = None
         
     def __repr__(self):
         return self.byYield.__repr__()
@@ -542,96 +501,83 @@ class TupleList:
     def beginStage(self):
         self.tuplesForStage = []
 
-    def addToStage(self, tup):
-        self.tuplesForStage.append(tup)
+    def addToStage(self, rows):
+        self.tuplesForStage.append(rows)
     
     def getTuplesForStage(self):
-        return self.tuplesForStage
+        return numpy.concatenate([TupleList.EMPTY] + self.tuplesForStage)
 
     def filterStage(self, aFilter):
-        self.tuplesForStage = aFilter.filter(self.tuplesForStage)
+        self.tuplesForStage = [aFilter.filter(self.chart, self.getTuplesForStage())]
     
     def completeStage(self):
-        self.addAll(self.tuplesForStage)
+        self.addAll(self.getTuplesForStage())
         self.tuplesForStage = None
     
-    def addAll(self, tuples):
-        for tup in tuples:
-            self.add(tup)
-    
-    # TO DO: shouldn't allow both add & addToStage -- confusing. Make all TupleLists filtered and disallow direct usage of add().
-    def add(self, tup):
-        (i,j,k,l) = tup.coordinates
-        
-        # add to allTuples
-        self.allTuples.append(tup)
-        
-        # add to byYield
-        setByYield = set()
-        try:
-            setByYield = self.byYield[tup.getYield()]
-        except KeyError:
-            #self.byYield.extend([set() for x in range(len(self.byYield), tup.getYield())])  # fill in any missing entries up to current tuple yield (which may never be used)
-            #self.byYield.append(setByYield)
-            self.byYield[tup.getYield()] = setByYield
-        setByYield.add(tup)
-        
-        # add to byYieldAndJ
-        setByJ = set()
-        try:
-            setByJ = self.byYieldAndJ[tup.getYield(), j]
-        except KeyError:
-            self.byYieldAndJ[tup.getYield(), j] = setByJ
-        setByJ.add(tup)
-        
-        # add to byYieldAndL
-        setByL = set()
-        try:
-            setByL = self.byYieldAndL[tup.getYield(), l]
-        except KeyError:
-            self.byYieldAndL[tup.getYield(), l] = setByL
-        setByL.add(tup)
-        
-        # add to byIJKL
-        setByIJKL = set()
-        try:
-            setByIJKL = self.byIJKL[(i,j,k,l)]
-        except KeyError:
-            self.byIJKL[(i,j,k,l)] = setByIJKL
-        setByIJKL.add(tup)
+    # Identical tuples (same coordinates, label and probability) are only added once
+    def addAll(self, rows):
+        chart = self.chart
+        yields = chart['j'][rows] - chart['i'][rows] + chart['l'][rows] - chart['k'][rows]
+        for tYield in numpy.unique(yields):
+            if tYield not in self.byYield:
+                self.yields.append(tYield)
+            existing = self.getTuplesOfYield(tYield)
+            self.byYield[tYield] = chart.unique(numpy.concatenate((existing, rows[yields == tYield])))
+            for column in ('j', 'l', 'ijkl'):
+                self.indexes.pop((tYield, column), None)
+        self.allTuples = None
+    
+    def add(self, row):
+        self.addAll(numpy.array([row]))
  
-    # Return a list of all tuples
+    # Return all rows
     def getAllTuples(self):
+        if self.allTuples is None:
+            self.allTuples = numpy.concatenate([TupleList.EMPTY] + [self.byYield[y] for y in self.yields])
         return self.allTuples
-        #tuples = []
-        #for y in range(len(self.byYield)):
-        #    tuples.extend(self.getTuplesOfYield(y))
-        #return tuples
     
-    # Return a list of tuples for the given yield
+    # Return the rows for the given yield
     def getTuplesOfYield(self, tYield):
         try:
             return self.byYield[tYield]
         except KeyError:
-            return []                           # no parse entries for stage
+            return TupleList.EMPTY              # no parse entries for stage
+    
+    # Index of the given yield's rows by column ('j', 'l' or 'ijkl' for coordinate IDs)
+    def getIndex(self, tYield, column):
+        try:
+            return self.indexes[tYield, column]
+        except KeyError:
+            rows = self.getTuplesOfYield(tYield)
+            if column == 'ijkl':
+                keys = self.chart.getCoordinateIds(rows)
+            else:
+                keys = self.chart[column][rows]
+            order = numpy.argsort(keys, kind='mergesort')
+            self.indexes[tYield, column] = (keys[order], rows[order])
+            return self.indexes[tYield, column]
+    
+    # Rows of the given yield whose column matches each of keys (an array).
+    # Returns (counts, rows): the number of matches for each key, and the matches in key order.
+    def lookup(self, tYield, column, keys):
+        (sortedKeys, sortedRows) = self.getIndex(tYield, column)
+        (lo, hi) = (numpy.searchsorted(sortedKeys, keys, 'left'), numpy.searchsorted(sortedKeys, keys, 'right'))
+        counts = hi - lo
+        positions = numpy.arange(counts.sum()) - numpy.repeat(numpy.cumsum(counts) - counts, counts) + numpy.repeat(lo, counts)
+        return (counts, sortedRows[positions])
         
     def getTuplesOfYieldAndJ(self, tYield, j):
-        if (tYield, j) in self.byYieldAndJ:
-            return self.byYieldAndJ[tYield, j]
-        else:
-            return set()
+        (sortedKeys, sortedRows) = self.getIndex(tYield, 'j')
+        return sortedRows[numpy.searchsorted(sortedKeys, j, 'left'):numpy.searchsorted(sortedKeys, j, 'right')]
     
     def getTuplesOfYieldAndL(self, tYield, l):
-        if (tYield, l) in self.byYieldAndL:
-            return self.byYieldAndL[tYield, l]
-        else:
-            return set()
+        (sortedKeys, sortedRows) = self.getIndex(tYield, 'l')
+        return sortedRows[numpy.searchsorted(sortedKeys, l, 'left'):numpy.searchsorted(sortedKeys, l, 'right')]
     
     def getTuplesOfIJKL(self, (i,j,k,l)):
-        if ((i,j,k,l)) in self.byIJKL:
-            return self.byIJKL[(i,j,k,l)]
-        else:
-            return set()
+        (sortedKeys, sortedRows) = self.getIndex(j-i+l-k, 'ijkl')
+        key = self.chart.coordinateIds(i, j, k, l)
+        return sortedRows[numpy.searchsorted(sortedKeys, key, 'left'):numpy.searchsorted(sortedKeys, key, 'right')]
 
 
 
@@ -677,8 +623,8 @@ class TreeB1(Tree):
     
     def __init__(self, grammar):
         self.grammar = grammar
-        self.adjoinables = TupleList()
-        self.nonadjoinables = TupleList()
+        self.adjoinables = TupleList(grammar.chart)
+        self.nonadjoinables = TupleList(grammar.chart)
         self.name = "B1"
         
     def __repr__(self):
@@ -691,16 +637,10 @@ class TreeB1(Tree):
         return (self.adjoinables, self.nonadjoinables)
     
     def getAllTuples(self):
-        tuples = []
-        tuples.extend(self.adjoinables.getAllTuples())
-        tuples.extend(self.nonadjoinables.getAllTuples())
-        return tuples
+        return numpy.concatenate((self.adjoinables.getAllTuples(), self.nonadjoinables.getAllTuples()))
         
     def getTuplesOfYield(self, tYield):
-        tuples = []
-        tuples.extend(self.adjoinables.getTuplesOfYield(tYield))
-        tuples.extend(self.nonadjoinables.getTuplesOfYield(tYield))
-        return tuples
+        return numpy.concatenate((self.adjoinables.getTuplesOfYield(tYield), self.nonadjoinables.getTuplesOfYield(tYield)))
 
     def evaluate(self, dna, stage):
         if (stage < 2):
@@ -712,46 +652,45 @@ class TreeB1(Tree):
             self.substitute(stage, dna)
             self.insert(stage, dna)
     
+    # Add new tuples to the stage (and those that are insertable to the insertables).
+    def addToStage(self, tuples, rows, dna):
+        tuples.addToStage(rows)
+        self.grammar.insertables.addToStage(rows[self.grammar.isInsertable(rows, dna)])
+    
     def initialize(self, dna):
         start = time.clock()
-        nPairs = 0
-        for i in range(len(dna)):
-            for j in range(i+1, len(dna)):
-                if not self.grammar.selfBlastn.containsPair(i+1, j+1):
-                    continue
-                #if (dna[i:i+1] == dna[j:j+1]):
-                prob = Probabilities.B1Matrix.X[dna[i:i+1], dna[j:j+1]]
-                #if self.grammar.selfBlastn.containsPair(i+1, j+1):             # this approach proved to be too slow
-                #    prob = prob * Probabilities.Blastn.FOUND
-                #else:
-                #    prob = prob * Probabilities.Blastn.MISSING
-                tup = Tuple((i,i+1,j,j+1), None, None, "B  ", prob)
-                self.adjoinables.addToStage(tup)
-                if self.grammar.isInsertable(tup, dna):
-                    self.grammar.insertables.addToStage(tup)
-                nPairs = nPairs + 1
+        (i, j) = self.grammar.selfBlastn.pairs(len(dna))       # only pairs inside the self-alignment blocks
+        #if self.grammar.selfBlastn.containsPair(i+1, j+1):             # this approach proved to be too slow
+        #    prob = prob * Probabilities.Blastn.FOUND
+        #else:
+        #    prob = prob * Probabilities.Blastn.MISSING
+        bases = "acgt"
+        logX = numpy.array([[Probabilities.B1Matrix.LOG_X[a, b] for b in bases] for a in bases])
+        codes = numpy.array([bases.index(base) for base in dna], dtype=numpy.int64)
+        logP = logX[codes[i], codes[j]]
+        rows = self.grammar.chart.add(i, i+1, j, j+1, logP, "B  ")
+        self.addToStage(self.adjoinables, rows, dna)
+        nPairs = len(rows)
         print "\tB1 initialize:\t%-8s %0.1e s" % (nPairs, time.clock()-start)
     
     # Tree B1: Adjoin B1 to itself. Result is still adjoinable.
     # For this tree, self adjoin always results in extending by 2 (identical) terminals,
     # i.e. (i,j,k,l) + (j,j+1,l,l+1) => (i,j+1,k,l+1)
+    # All tuples of yield stage-2 are looked up in the index of the pairs (j,j+1,l,l+1) at once.
     def adjoin(self, stage, dna):
-        #if (stage == 12):
-        #    None
         start = time.clock()
-        nAdjoins = 0
+        chart = self.grammar.chart
         self.adjoinables.beginStage()
-        for t1 in self.adjoinables.getTuplesOfYield(stage-2):
-            (i,j,k,l) = t1.coordinates
-            if (j == k):    # don't extend j beyond k (i<=j<=k<=l)
-                continue
-            for t2 in self.adjoinables.getTuplesOfIJKL((j,j+1,l,l+1)):
-                newTuple = Tuple((i,j+1,k,l+1), t1, t2, "Ba ")
-                newTuple.scaleProbability(Probabilities.Operations.B1_ADJOIN)
-                self.adjoinables.addToStage(newTuple)
-                if self.grammar.isInsertable(newTuple, dna):
-                    self.grammar.insertables.addToStage(newTuple)
-                nAdjoins = nAdjoins + 1
+        t1 = self.adjoinables.getTuplesOfYield(stage-2)
+        t1 = t1[chart['j'][t1] != chart['k'][t1]]      # don't extend j beyond k (i<=j<=k<=l)
+        (j, l) = (chart['j'][t1], chart['l'][t1])
+        (counts, right) = self.adjoinables.lookup(2, 'ijkl', chart.coordinateIds(j, j+1, l, l+1))
+        left = numpy.repeat(t1, counts)
+        rows = chart.add(chart['i'][left], chart['j'][left]+1, chart['k'][left], chart['l'][left]+1,
+                         chart['logP'][left] + chart['logP'][right] + Probabilities.Operations.LOG_B1_ADJOIN,
+                         "Ba ", left, right)
+        self.addToStage(self.adjoinables, rows, dna)
+        nAdjoins = len(rows)
         print "\tB1 adjoin:\t%-8s %0.1e s" % (nAdjoins, time.clock()-start)
     
     # Tree A1: Substitute into B1. Result is no longer adjoinable. This is the "middle" part of the TE, between TIRs.
@@ -760,21 +699,30 @@ class TreeB1(Tree):
     # (In general, may want to keep track of the list lengths and iterate through the shorter one -- TODO.)
     def substitute(self, stage, dna):
         start = time.clock()
-        nSubstitutions = 0
-        for termini in self.adjoinables.getAllTuples():
-            (i,j,k,l) = termini.coordinates
-            if stage == 26:# and (i,j,k,l) == (0,3,9,12):
-                None
-            if l-i == stage and j<k:
-                for middle in self.grammar.treeA1.getTuplesForSegment(j,k):        
-                    newTuple = Tuple((i,k,k,l), termini, middle, "Bs ")
-                    newTuple.scaleProbability(Probabilities.Operations.B1_SUBSTITUTE)
-                    self.nonadjoinables.addToStage(newTuple)
-                    if self.grammar.isInsertable(newTuple, dna):
-                        self.grammar.insertables.addToStage(newTuple)
-                    nSubstitutions = nSubstitutions + 1
+        chart = self.grammar.chart
+        termini = self.adjoinables.getAllTuples()
+        termini = termini[(chart['l'][termini] - chart['i'][termini] == stage) & (chart['j'][termini] < chart['k'][termini])]
+        (terminus, right) = self.getMiddles(chart['j'][termini], chart['k'][termini])
+        left = termini[terminus]
+        rows = chart.add(chart['i'][left], chart['k'][left], chart['k'][left], chart['l'][left],
+                         chart['logP'][left] + chart['logP'][right] + Probabilities.Operations.LOG_B1_SUBSTITUTE,
+                         "Bs ", left, right)
+        self.addToStage(self.nonadjoinables, rows, dna)
+        nSubstitutions = len(rows)
         print "\tB1 substitute:\t%-8s %0.1e s" % (nSubstitutions, time.clock()-start)
     
+    # A1 tuples for the middle segments (j,k) of termini (arrays), looked up once per distinct segment.
+    # Returns (index of the terminus, A1 row) for every pair, in the order of the termini.
+    def getMiddles(self, j, k):
+        width = self.grammar.chart.width
+        (segments, inverse) = numpy.unique(numpy.asarray(j, numpy.int64) * width + k, return_inverse=True)
+        middles = [self.grammar.treeA1.getTuplesForSegment(int(segment // width), int(segment % width)) for segment in segments]
+        lengths = numpy.array([len(rows) for rows in middles], dtype=numpy.int64)
+        counts = lengths[inverse]
+        terminus = numpy.repeat(numpy.arange(len(counts)), counts)
+        first = (numpy.cumsum(lengths) - lengths)[inverse] - (numpy.cumsum(counts) - counts)   # of each terminus's middles, less its first pair
+        return (terminus, numpy.concatenate([TupleList.EMPTY] + middles)[first[terminus] + numpy.arange(len(terminus))])
+    
     # Tree A2: Insert permitted tuples inside either or both TIRs. Permitted tuples are currently
     # contiguous parses that
     # Iterate through allowed insertions, which should be much fewer in number than the tuples in this tree.
@@ -783,30 +731,25 @@ class TreeB1(Tree):
     # This may eventually need to be changed.
     def insert(self, stage, dna):
         start = time.clock()
+        chart = self.grammar.chart
         nInsertions = 0
+        logInsert = Probabilities.Operations.LOG_INSERT
         for insertable in self.grammar.insertables.getAllTuples():
-            (s,t,u,v) = insertable.coordinates
+            (s,t,u,v) = chart.coordinates(insertable)
             if (t != u):
                 raise Exception     # sanity check
-            remainingYield = stage - insertable.getYield()
-            for left in self.adjoinables.getTuplesOfYieldAndJ(remainingYield, s):    # left TIR
-                (i,j,k,l) = left.coordinates
-                if v > k:
-                    continue    # not enough room between TIRs to insert (TODO?: optimize lookup to avoid these cases)
-                newTuple = Tuple((i,v,k,l), insertable, left, "Bil")
-                newTuple.scaleProbability(Probabilities.Operations.INSERT)
-                self.adjoinables.addToStage(newTuple)
-                if self.grammar.isInsertable(newTuple, dna):
-                        self.grammar.insertables.addToStage(newTuple)
-                nInsertions = nInsertions + 1
-            for right in self.adjoinables.getTuplesOfYieldAndL(remainingYield, s):    # right TIR
-                (i,j,k,l) = right.coordinates
-                newTuple = Tuple((i,j,k,v), insertable, right, "Bir")
-                newTuple.scaleProbability(Probabilities.Operations.INSERT)
-                self.adjoinables.addToStage(newTuple)
-                if self.grammar.isInsertable(newTuple, dna):
-                        self.grammar.insertables.addToStage(newTuple)
-                nInsertions = nInsertions + 1
+            remainingYield = stage - (t-s+v-u)
+            lefts = self.adjoinables.getTuplesOfYieldAndJ(remainingYield, s)    # left TIR
+            lefts = lefts[chart['k'][lefts] >= v]       # not enough room between TIRs to insert (TODO?: optimize lookup to avoid these cases)
+            rows = chart.add(chart['i'][lefts], v, chart['k'][lefts], chart['l'][lefts],
+                             chart['logP'][insertable] + chart['logP'][lefts] + logInsert, "Bil", insertable, lefts)
+            self.addToStage(self.adjoinables, rows, dna)
+            nInsertions = nInsertions + len(rows)
+            rights = self.adjoinables.getTuplesOfYieldAndL(remainingYield, s)   # right TIR
+            rows = chart.add(chart['i'][rights], chart['j'][rights], chart['k'][rights], v,
+                             chart['logP'][insertable] + chart['logP'][rights] + logInsert, "Bir", insertable, rights)
+            self.addToStage(self.adjoinables, rows, dna)
+            nInsertions = nInsertions + len(rows)
         print "\tB1 insert:\t%-8s %0.1e s" % (nInsertions, time.clock()-start)
 
 
@@ -821,55 +764,75 @@ class TreeA1():
         self.grammar = grammar
         #self.nonadjoinables = TupleList()
         self.name = "A1"
+        self.segments = {}          # (start, end) => (insertables combinations, rows), reused while the combinations are
         
     def __repr__(self):
         return self.nonadjoinables.__repr__()
     
+    # Returns rows of the chart: the tuple (start,end,end,end) with no insertions, then one per combination
+    # of insertables in the segment. They are only added to the chart again for the same segment once its
+    # combinations have changed (see InsertablesCollection.combinations).
     def getTuplesForSegment(self, start, end):
+        combinations = self.grammar.getInsertablesCombinations(start, end)
+        cached = self.segments.get((start, end))
+        if cached is not None and cached[0] is combinations:
+            return cached[1]
+        rows = self.addTuplesForSegment(start, end, combinations)
+        self.segments[start, end] = (combinations, rows)
+        return rows
+    
+    # All combinations are built at once, one insertable at a time: the m-th step scans (if needed) to the m-th
+    # insertable of each combination that has one and inserts it.
+    def addTuplesForSegment(self, start, end, combinations):
         # insertables in each combination must be sorted by i for the following to work
         time0 = time.clock()
-        combinations = self.grammar.getInsertablesCombinations(start, end)
-        tuples = []
+        chart = self.grammar.chart
         
         # with no insertions
-        prob = Probabilities.calcSubstitutionProb(end-start)
-        tuples.append(Tuple((start, end, end, end), None, None, "A  ", prob))
+        logP = Probabilities.calcSubstitutionLogProb(end-start)
+        tuples = [chart.add(start, end, end, end, logP, "A  ")]
         
         # with insertions
-        for combn in combinations:    # each group forms one tuple
-            join = None
-            pJoin = 1
-            startScan = start
-            for insertable in combn:
+        if len(combinations) > 0:    # each group forms one tuple
+            sizes = numpy.array([len(combn) for combn in combinations])
+            insertables = numpy.full((len(combinations), sizes.max()), NONE, dtype=numpy.int64)
+            for (n, combn) in enumerate(combinations):
+                insertables[n, :len(combn)] = combn
+            join = numpy.full(len(combinations), NONE, dtype=numpy.int64)
+            logPJoin = numpy.zeros(len(combinations))
+            startScan = numpy.full(len(combinations), start, dtype=numpy.int64)
+            for m in range(sizes.max()):
+                combns = numpy.flatnonzero(sizes > m)
+                insertable = insertables[combns, m]
+                
                 # 1. Scan to insert (if needed)
-                if insertable.getStart() != startScan:
-                    endScan = insertable.getStart()
-                    pScan = Probabilities.calcSubstitutionProb(endScan-startScan)
-                    scan = Tuple((startScan, endScan, endScan, endScan), None, None, "As ", pScan)
-                    pJoin = pJoin * pScan
-                    join = Tuple((start, endScan, endScan, endScan), join, scan, "Aj ", pJoin)
+                scanning = chart['i'][insertable] != startScan[combns]
+                self.scan(start, combns[scanning], chart['i'][insertable[scanning]], startScan, join, logPJoin)
                 
                 # 2. Insert
-                pJoin = pJoin * insertable.getProbability() * Probabilities.Operations.INSERT
-                endInsert = insertable.getEnd()
-                join = Tuple((start, endInsert, endInsert, endInsert), join, insertable, "Ai ", pJoin)
-                startScan = endInsert
+                logPJoin[combns] = logPJoin[combns] + chart['logP'][insertable] + Probabilities.Operations.LOG_INSERT
+                endInsert = chart['l'][insertable]
+                join[combns] = chart.add(start, endInsert, endInsert, endInsert, logPJoin[combns], "Ai ", join[combns], insertable)
+                startScan[combns] = endInsert
                 
             # 3. Scan to end
-            if join.getEnd() < end:
-                endScan = end
-                pScan = Probabilities.calcSubstitutionProb(endScan-startScan)
-                scan = Tuple((startScan, endScan, endScan, endScan), None, None, "As ", pScan)
-                pJoin = pJoin * pScan
-                join = Tuple((start, endScan, endScan, endScan), join, scan, "Aj ", pJoin)
+            combns = numpy.flatnonzero(startScan < end)
+            self.scan(start, combns, numpy.repeat(end, len(combns)), startScan, join, logPJoin)
             tuples.append(join)
-            #print join.derivation.toString(dna)
-            #print "-"*10
-            None
         elapsed = time.clock()-time0
         if elapsed > 1:
-            print "\tA1:       \t%-8s %0.1e s" % (len(tuples), elapsed)
-        return tuples
+            print "\tA1:       \t%-8s %0.1e s" % (len(combinations) + 1, elapsed)
+        return numpy.concatenate(tuples).astype(numpy.int64)
+    
+    # Scan the given combinations from startScan to endScan and join the scans to their tuples so far,
+    # updating join, logPJoin and startScan.
+    def scan(self, start, combns, endScan, startScan, join, logPJoin):
+        chart = self.grammar.chart
+        logPScan = Probabilities.calcSubstitutionLogProb(endScan-startScan[combns])
+        scan = chart.add(startScan[combns], endScan, endScan, endScan, logPScan, "As ")
+        logPJoin[combns] = logPJoin[combns] + logPScan
+        join[combns] = chart.add(start, endScan, endScan, endScan, logPJoin[combns], "Aj ", join[combns], scan)
+        startScan[combns] = endScan
     
     #def getTupleLists(self):
     #    return (self.nonadjoinables,)
@@ -928,19 +891,26 @@ class TreeA1():
 if __name__ == "__main__":
     import sys      # for command-line arguments
     import time     # for performance metrics
-    import selfblastn01
+    import selfalignment
 
     start = time.clock()
-    if len(sys.argv) != 2:
-        print "Usage: <program> DNA"
+    if len(sys.argv) not in (2, 3):
+        print "Usage: <program> DNA [self-alignments]"
+        print "  self-alignments: self-BLASTN HSPs (tabular) or termini_search.py hits (.bed); default: all pairs"
         exit(0)
     dna = sys.argv[1]
+    if len(sys.argv) == 2:
+        selfBlastn = selfalignment.AllMatch(len(dna))
+    elif sys.argv[2].endswith(".bed"):
+        selfBlastn = selfalignment.LastzBlocks(sys.argv[2])
+    else:
+        selfBlastn = selfalignment.BlastnHsps(sys.argv[2])
     print "\nInput:\n%s" % (dna)
     print "1234567890" * 3
     print "         1         2         3\n"
     print "Input length: %d" % len(dna)
-    print "Probability of random sequence of this length: %s" % math.pow(0.25, len(dna))
-    grammar = Grammar(selfblastn01.AllMatch(), dna)
+    print "Probability of random sequence of this length: %s" % formatProbability(len(dna) * math.log10(0.25))
+    grammar = Grammar(selfBlastn, dna)
     grammar.parse()
     end = time.clock()
     print; print "Elapsed time: %f s" % (end - start)
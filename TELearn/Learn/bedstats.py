@@ -6,14 +6,23 @@ including those needed by TE Learn; E.g.,
 + # of each type
 + coverage of each type
 + average length of each type
++ length histogram of each type, and of the gaps between records
+
+Records are not kept: each one is added to its state's running totals as it is read, so memory does
+not depend on the number of records. Stats of BED files holding different chromosomes (shards) can be
+computed separately, e.g. in parallel (see bedstats_for_shards), and merged.
 '''
 
 from __future__ import print_function
 import sys
 import argparse
+import collections
+import multiprocessing
 from tenames import TeNames
 
-class BedRecord():
+class BedRecord(object):
+    
+    __slots__ = ('scaffold', 'start', 'end', 'name', 'score')
     
     def __init__(self, line):
         record = (line.split())[0:5]
@@ -33,12 +42,26 @@ class BedRecord():
 
 class StateStats():
     
-    def __init__(self, records):
+    def __init__(self, records=()):
         self.count = 0.0                                                        # use float to defeat python integer division
         self.totalLen = 0.0
+        self.lengthHistogram = collections.Counter()                            # bin b: lengths in [2**(b-1), 2**b)
         for r in records:
-            self.count += 1
-            self.totalLen += r.len()
+            self.add(r.len())
+    
+    def add(self, length):
+        self.count += 1
+        self.totalLen += length
+        self.lengthHistogram[int(length).bit_length()] += 1
+    
+    def merge(self, other):
+        self.count += other.count
+        self.totalLen += other.totalLen
+        self.lengthHistogram.update(other.lengthHistogram)
+    
+    def histogram(self):
+        '''Length histogram as a list of (min length, max length + 1, count), by increasing length.'''
+        return [((1 << b) >> 1, 1 << b, self.lengthHistogram[b]) for b in sorted(self.lengthHistogram)]
     
     def avg_len(self):
         return self.totalLen / self.count
@@ -73,40 +96,80 @@ class BedStats():
     def __init__(self, bedfile, chromsizes, bgState):
         self.bgState = bgState
         self.scafSizes = ScaffoldSizes(chromsizes)
-        self.records = {}
+        self.recordStats = {}                                                   # state -> StateStats, without the background
         self.stateStats = {}
+        self.gapStats = StateStats()                                            # gaps between consecutive records of a scaffold
+        self.lastEnds = {}                                                      # scaffold -> end of its last record so far
+        self.overlaps = 0                                                       # records starting before the previous one ended
+        self.superfamilies = {}                                                 # name -> superfamily, to look each name up once
         self.nRecords = 0
         self.recordsLen = 0                                                       # assumes no overlaps
         self._load(bedfile)
         self._calc()
-
+    
     def _load(self, bedfile):
         for line in bedfile:
-            if '#' == line[0]:                                                  # skip comment lines
+            if '#' == line[0] or not line.strip():                              # skip comment lines
                 continue
-            self._add(BedRecord(line))
+            (scaffold, start, end, name) = line.split()[0:4]
+            self._add_interval(scaffold, int(start), int(end), name)
     
     def _add(self, bedRecord):
-        if bedRecord.scaffold not in self.scafSizes.sizes:
-            raise Exception('scaffold ' + bedRecord.scaffold + ' not in chrom.sizes')
-        state = bedRecord.superfamily()                                   
-        if state not in self.records:
-            self.records[state] = []
-        self.records[state].append(bedRecord)
+        self._add_interval(bedRecord.scaffold, bedRecord.start, bedRecord.end, bedRecord.name)
+    
+    # Gaps are measured assuming that the records of each scaffold are sorted by start.
+    def _add_interval(self, scaffold, start, end, name):
+        if scaffold not in self.scafSizes.sizes:
+            raise Exception('scaffold ' + scaffold + ' not in chrom.sizes')
+        if name not in self.superfamilies:
+            self.superfamilies[name] = TeNames.superfamily_for(name)
+        state = self.superfamilies[name]
+        if state not in self.recordStats:
+            self.recordStats[state] = StateStats()
+        self.recordStats[state].add(end - start)
+        if scaffold in self.lastEnds:
+            lastEnd = self.lastEnds[scaffold]
+            if start > lastEnd:
+                self.gapStats.add(start - lastEnd)
+            elif start < lastEnd:
+                self.overlaps += 1
+            self.lastEnds[scaffold] = max(lastEnd, end)
+        else:
+            self.lastEnds[scaffold] = end
     
     def _calc(self):
-        for state in self.records:
-            stateStats = StateStats(self.records[state])
+        self.stateStats = {}
+        self.nRecords = 0
+        self.recordsLen = 0
+        for state in self.recordStats:
+            stateStats = self.recordStats[state]
             self.stateStats[state] = stateStats
             self.nRecords += stateStats.count
             self.recordsLen += stateStats.totalLen
         if self.bgState in self.stateStats:
-            raise Exception('Cannot initialize background to ' + bgState + ' because it already exists.')
+            raise Exception('Cannot initialize background to ' + self.bgState + ' because it already exists.')
         bgStats = StateStats([])
         bgStats.count = self.nRecords + 2 * self.scafSizes.numScaffolds         # assumes gap between each record and at start and end of each scaffold
         bgStats.totalLen = self.scafSizes.genomeSize - self.recordsLen
         self.stateStats[self.bgState] = bgStats
     
+    def merge(self, other):
+        '''
+        Add the stats of another BedStats, computed from records of other scaffolds (e.g. another chromosome
+        shard) with the same chrom.sizes and background state.
+        '''
+        for state in other.recordStats:
+            if state not in self.recordStats:
+                self.recordStats[state] = StateStats()
+            self.recordStats[state].merge(other.recordStats[state])
+        self.gapStats.merge(other.gapStats)
+        for scaffold in other.lastEnds:
+            if scaffold in self.lastEnds:
+                raise Exception('scaffold ' + scaffold + ' is in more than one shard')
+            self.lastEnds[scaffold] = other.lastEnds[scaffold]
+        self.overlaps += other.overlaps
+        self._calc()
+    
     def states(self):
         return self.stateStats.keys()
     
@@ -118,21 +181,69 @@ class BedStats():
     def statep(self, state, fudge = 0.0):
         x = self.stateStats[state].totalLen / self.scafSizes.genomeSize
         return x + (1-x)*fudge
+    
+    def __str__(self):
+        lines = ['state\tcount\ttotal_len\tavg_len']
+        for (state, stats) in sorted(self.stateStats.items()) + [('(gaps)', self.gapStats)]:
+            avg = stats.avg_len() if stats.count else 0.0
+            lines.append('%s\t%d\t%d\t%.1f' % (state, stats.count, stats.totalLen, avg))
+        lines.append('')
+        lines.append('state\tmin_len\tmax_len\tcount')
+        for (state, stats) in sorted(self.recordStats.items()) + [('(gaps)', self.gapStats)]:
+            for (low, high, count) in stats.histogram():
+                lines.append('%s\t%d\t%d\t%d' % (state, low, high - 1, count))
+        if self.overlaps:
+            lines.append('')
+            lines.append('%d records overlap the previous record of their scaffold (or are unsorted)' % self.overlaps)
+        return '\n'.join(lines)
+
+
+
+def _shard_stats(task):
+    (bedfileName, chromsizesName, bgState) = task
+    with open(bedfileName) as bedfile:
+        with open(chromsizesName) as chromsizes:
+            return BedStats(bedfile, chromsizes, bgState)
+
+def bedstats_for_shards(bedfileNames, chromsizesName, bgState, cpus=1):
+    '''
+    BedStats of several BED files, each holding different scaffolds (e.g. one chromosome each), computed
+    on a process pool when cpus > 1 and merged.
+    '''
+    tasks = [(name, chromsizesName, bgState) for name in bedfileNames]
+    if cpus > 1 and len(tasks) > 1:
+        pool = multiprocessing.Pool(min(cpus, len(tasks)))
+        try:
+            shards = pool.map(_shard_stats, tasks)
+            pool.close()
+        except:
+            pool.terminate()
+            raise
+        finally:
+            pool.join()
+    else:
+        shards = [_shard_stats(task) for task in tasks]
+    bedStats = shards[0]
+    for shard in shards[1:]:
+        bedStats.merge(shard)
+    return bedStats
 
 
 
 def parse_cl():
     parser = argparse.ArgumentParser()
-    parser.add_argument('bedfile', type=argparse.FileType('r'),
-        help='BED input file')
-    parser.add_argument('chromsizes', type=argparse.FileType('r'),
+    parser.add_argument('bedfile', type=str, nargs='+',
+        help='BED input file(s); several files must hold different scaffolds (e.g. one chromosome each)')
+    parser.add_argument('chromsizes', type=str,
         help='chromosome sizes in a tab-separated file such as that generated by fetchChromSizes '
              '(see https://genome.ucsc.edu/goldenPath/help/bigBed.html)' )
     parser.add_argument('--background', type=str, default='None',
         help='Name of background state (i.e. what to call gaps) [default: \'None\']')
+    parser.add_argument('--cpus', type=int, default=1,
+        help='Number of BED files to read in parallel [default: 1]')
     return parser.parse_args()
 
 if __name__ == '__main__':
     args = parse_cl()
-    stateStats = BedStats(args.bedfile, args.chromsizes, args.background, )
-    print(stateStats)
\ No newline at end of file
+    stateStats = bedstats_for_shards(args.bedfile, args.chromsizes, args.background, args.cpus)
+    print(stateStats)
@@ -5,56 +5,105 @@ Read weka predictions from a file
 '''
 
 import sys
-import re
-import math
+import os
 import argparse
 import datetime
+import gzip
+import itertools
+import numpy
 
-class WekaPredictionsReader():
-    
-    def __init__(self, predFile, states):
-        self.states = states.split(',')
-        self.predictions = [[] for x in range( len(self.states) )]
-        self._load(predFile)
-    
-    ''' Header lines:
-        
+CHUNK_LINES = 1 << 20                                                           # lines parsed at a time
 
-    === Predictions on test data ===
-    
-     inst#     actual  predicted error distribution
+def load_predictions(predFile, nStates, cache=True):
+    '''
+    Class distributions of a Weka predictions file (optionally gzipped) as a float32 positions x states
+    matrix. The matrix is cached next to the file as <file>.npy, and later loads memory-map the cache
+    instead of parsing, as long as it is newer than the file.
     
+    When the cache is written, the file is read twice: once to count the instances, then to parse them
+    a chunk at a time straight into the memory-mapped cache, so the predictions never have to fit in
+    memory. Without a cache (e.g. reading STDIN, or a file in a directory that cannot be written), the
+    parsed chunks are held in memory.
     '''
-    def _load(self, predFile):
-        skipped = 0
-        n = 0
-        for line in predFile:
-            if skipped < 5:                                                     # skip 5 header lines
-                skipped += 1
-                continue
-            probs = self._parse(line.rstrip())
-            for i in range(len(probs)):  
-                self.predictions[i].append(probs[i])
-            if n % 1000000 == 0:
-                print str(n) + "\t" + str(datetime.datetime.now())
-            n += 1
+    name = getattr(predFile, 'name', '')
+    writable = os.path.isfile(name) and os.access(os.path.dirname(name) or '.', os.W_OK)
+    cacheName = name + '.npy' if cache and writable else None
+    if cacheName and os.path.isfile(cacheName) and os.path.getmtime(cacheName) >= os.path.getmtime(name):
+        probabilities = numpy.load(cacheName, mmap_mode='r')
+        if probabilities.ndim == 2 and probabilities.shape[1] == nStates:
+            return probabilities
+    if not cacheName:
+        chunks = [numpy.zeros((0, nStates), dtype=numpy.float32)]
+        for lines in read_chunks(predFile):
+            chunks.append(parse_distributions(lines, nStates))
+        return numpy.concatenate(chunks)
+    with open_predictions(name) as infile:
+        n = sum(1 for line in infile if is_instance(line))
+    temporary = cacheName + '.tmp.npy'
+    probabilities = numpy.lib.format.open_memmap(temporary, mode='w+', dtype=numpy.float32, shape=(n, nStates))
+    written = 0
+    try:
+        with open_predictions(name) as infile:
+            for lines in read_chunks(infile):
+                chunk = parse_distributions(lines, nStates)
+                if written + len(chunk) > n:
+                    raise Exception('Predictions file changed while it was read: ' + name)
+                probabilities[written:written+len(chunk)] = chunk
+                written += len(chunk)
+                print >>sys.stderr, str(written) + "\t" + str(datetime.datetime.now())
+        if written != n:
+            raise Exception('Predictions file changed while it was read: ' + name)
+        probabilities.flush()
+    except:
+        del probabilities
+        os.remove(temporary)
+        raise
+    del probabilities
+    os.rename(temporary, cacheName)
+    return numpy.load(cacheName, mmap_mode='r')
+
+def open_predictions(name):
+    return gzip.open(name) if name.endswith('.gz') else open(name)
+
+def read_chunks(infile, chunkLines=CHUNK_LINES):
+    '''Lists of up to chunkLines lines of infile.'''
+    while True:
+        lines = list(itertools.islice(infile, chunkLines))
+        if not lines:
+            break
+        yield lines
+
+def is_instance(line):
+    return line.lstrip()[:1].isdigit()
+
+''' Header lines (skipped, as is any other line that does not start with an instance number):
     
-    # 700001     1:None     1:None       *0.986,0.002,0.002,0,0,0.008,0,0.002
-    #    281     1:None   7:Simple   +   0.087,0,0,0,0,0.005,*0.716,0.192
-    def _parse(self, line):
-        m = re.search(r'[,\*.\d]*$', line, re.M)
-        if not m:
-            raise Exception('Unable to parse: ' + line)
-        csv = re.sub(r'[*]', '', m.group())
-        fields = csv.split(',')
-        return map(float, fields)
+
+=== Predictions on test data ===
+
+ inst#     actual  predicted error distribution
+
+'''
+# 700001     1:None     1:None       *0.986,0.002,0.002,0,0,0.008,0,0.002
+#    281     1:None   7:Simple   +   0.087,0,0,0,0,0.005,*0.716,0.192
+def parse_distributions(lines, nStates):
+    '''Distributions (the last column) of the instance lines among lines, as a float32 matrix.'''
+    fields = [line.rsplit(None, 1)[-1] for line in lines if is_instance(line)]
+    values = numpy.fromstring(','.join(fields).replace('*', ''), dtype=numpy.float64, sep=',')
+    if len(values) != len(fields) * nStates:
+        raise Exception('Unable to parse distributions of %d states near: %s' % (nStates, fields[0] if fields else lines[0]))
+    return values.astype(numpy.float32).reshape(-1, nStates)
+
+class WekaPredictionsReader():
+    
+    def __init__(self, predFile, states):
+        self.states = states.split(',')
+        self.predictions = load_predictions(predFile, len(self.states))         # positions x states
     
     def log_table(self):
         d = {}
-        i = 0
-        for s in self.states:
-            d[s] = map( math.log, map( lambda x: max(sys.float_info.min, x), self.predictions[i] ))
-            i += 1
+        for (i, s) in enumerate(self.states):
+            d[s] = numpy.log(numpy.maximum(sys.float_info.min, self.predictions[:, i].astype(numpy.float64)))
         return d
     
     def print_table(self, table):
@@ -68,6 +117,59 @@ class WekaPredictionsReader():
             None
 
 
+class WekaPredictionsStream():
+    '''
+    Predictions read one segment at a time from the memory-mapped cache (see load_predictions), so that a
+    genome's predictions need not fit in memory when they are read from a file.
+    
+    Weka's predictions do not say which position each instance is; with a data file (the trackDump
+    .data file that the predicted ARFF was made from, gzipped or not), its first two columns, chromosome
+    and 0-based position, give each instance's position, in the same order as the predictions. A segment
+    ends wherever the chromosome changes or positions are not consecutive. Without a data file, the whole
+    stream is one segment on the given scaffold, beginning at start.
+    '''
+    
+    def __init__(self, predFile, states, dataFile=None, scaffold='scaffold_1', start=0):
+        self.states = states.split(',')
+        self.predFile = predFile
+        self.dataFile = dataFile
+        self.scaffold = scaffold
+        self.start = start
+    
+    # Yields (scaffold, start, probabilities), probabilities being a positions x states NumPy array
+    # (a slice of the memory-mapped cache, see load_predictions()).
+    def segments(self):
+        probabilities = load_predictions(self.predFile, len(self.states))
+        if self.dataFile is None:
+            if len(probabilities):
+                yield (self.scaffold, self.start, probabilities)
+            return
+        (scaffold, start, end, first) = (None, 0, 0, 0)
+        n = 0
+        for (chrom, position) in self._positions():
+            if n == len(probabilities):
+                raise Exception('More positions in %s than predictions' % self.dataFile)
+            if chrom != scaffold or position != end:
+                if n > first:
+                    yield (scaffold, start, probabilities[first:n])
+                (scaffold, start, first) = (chrom, position, n)
+            end = position + 1
+            n += 1
+        if n < len(probabilities):
+            raise Exception('More predictions than positions in ' + self.dataFile)
+        if n > first:
+            yield (scaffold, start, probabilities[first:n])
+    
+    def _positions(self):
+        data = gzip.open(self.dataFile) if self.dataFile.endswith('.gz') else open(self.dataFile)
+        with data:
+            for line in data:
+                if line.strip() == '':
+                    continue
+                fields = line.split(',', 2)
+                yield (fields[0], int(float(fields[1])))
+
+
 # From weka header:
 # @attribute repeat_modeler {None, DNA, LINE, LTR, SINE, Unknown, Simple, Low}
 
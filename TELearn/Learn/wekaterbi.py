@@ -7,44 +7,310 @@ Adapted from http://en.wikipedia.org/wiki/Viterbi_algorithm
 import math
 import sys
 import argparse
+import itertools
+import multiprocessing
+import os
+import shutil
+import tempfile
+import numpy
 from bedstats import BedStats
-from weka_predictions_reader import WekaPredictionsReader
+from weka_predictions_reader import WekaPredictionsStream
+
+class Model():
+    '''
+    Start, state and transition log probabilities as matrices. States are put in reverse name order so
+    that, as in the dict version's max over (prob, state) tuples, ties go to the state with the greatest name.
+    '''
+    
+    def __init__(self, states, startP, stateP, transP, adjustment):
+        self.states = sorted(states, reverse=True)
+        self.startLogP = numpy.array([startP[s] for s in self.states])
+        self.stateLogP = numpy.array([stateP[s] for s in self.states])
+        self.transLogP = numpy.array([[transP[s0][s] for s in self.states] for s0 in self.states])
+        self.adjustment = adjustment
+    
+    # predictions: P(s|o) (or log P(s|o)), positions x predicted states; columns: that of each of self.states
+    def emissions(self, predictions, columns, logPredictions=False):
+        return Emissions(predictions, columns, self.adjustment - self.stateLogP, logPredictions)
+    
+    # Returns (log probability, best path as state indices).
+    def decode(self, emissions, blockLength=None):
+        return viterbi_matrix(emissions, self.startLogP, self.transLogP, blockLength)
+    
+    # Returns (log likelihood, iterator over the posterior state probabilities of consecutive blocks of
+    # positions, as positions x self.states).
+    def posteriors(self, emissions, blockLength=None):
+        return forward_backward(emissions, self.startLogP, self.transLogP, blockLength)
+
+class Emissions():
+    '''
+    Emission log scores of a segment, positions x model states: log P(s|o) - log P(s) + adjustment, or just
+    log P(s|o) at t == 0. They are computed from the predictions (e.g. a float32 memory-mapped slice, floored
+    at sys.float_info.min before taking the log) only for the block of positions sliced, emissions[start:end],
+    so the predictions of a segment are never copied whole.
+    '''
+    
+    def __init__(self, predictions, columns, adjustment, logPredictions=False):
+        self.predictions = predictions
+        self.columns = list(columns)
+        self.adjustment = adjustment                                            # per state: adjustment - log P(s)
+        self.logPredictions = logPredictions                                    # the predictions are log P(s|o) already
+        self.shape = (len(predictions), len(self.columns))
+    
+    def __len__(self):
+        return self.shape[0]
+    
+    def __getitem__(self, positions):
+        (start, end, step) = positions.indices(self.shape[0])
+        block = self.predictions[start:end, self.columns].astype(numpy.float64)
+        if not self.logPredictions:
+            block = numpy.log(numpy.maximum(sys.float_info.min, block))
+        block[max(1 - start, 0):] += self.adjustment                            # P(s|o)/P(s), except at t == 0
+        return block
 
 def viterbi(pred, states, startP, stateP, transP, adjustment):
-    V = [{}]
-    path = {}
- 
-    # Initialize base cases (t == 0)
-    for s in states:
-        V[0][s] =  startP[s] + pred[s][0]
-        path[s] = [s]
- 
-    # Run Viterbi for t > 0
-    n = len(pred[ pred.keys()[0] ])
-    for t in range(1, n):
-        V.append({})
-        newpath = {}
- 
-        for s in states:
-            (prob, state) = max( (V[t-1][s0] + transP[s0][s] + pred[s][t] - stateP[s] + adjustment , s0) for s0 in states )    # P(s|o)/P(s)
-            #(prob, state) = max( (V[t-1][s0] + transP[s0][s] + pred[s0][t] - stateP[s0] + adjustment , s0) for s0 in states )    # P(s|o)/P(s)
-            #(prob, state) = max( (V[t-1][s0] + transP[s0][s] + pred[s0][t] , s0) for s0 in states )    # P(s|o)
-            V[t][s] = prob
-            newpath[s] = path[state] + [s]
- 
-        # Don't need to remember the old paths
-        path = newpath
-        #if not t % 94:
-        #    None
-        #if not t % 10000:
-        #    print(t)
-    n = 0           # if only one element is observed max is sought in the initialization values
-    if n != 1:
-        n = t
-    #print_dptable(V)
-    (prob, state) = max((V[n][y], y) for y in states)
-    return (prob, path[state])
- 
+    model = Model(states, startP, stateP, transP, adjustment)
+    logPred = numpy.column_stack([numpy.asarray(pred[s], dtype=numpy.float64) for s in model.states])
+    (prob, path) = model.decode(model.emissions(logPred, range(len(model.states)), logPredictions=True))
+    return (prob, [model.states[s] for s in path])
+
+def viterbi_matrix(emissions, startLogP, transLogP, blockLength=None):
+    '''
+    Viterbi decoding in log space. emissions: positions x states, an array or Emissions, which is only
+    sliced a block at a time; startLogP: states; transLogP: states x states (from, to). Returns (log
+    probability of the best path, best path as an array of state indices).
+    
+    Only one column of probabilities is kept. Back-pointers (the best predecessor of each state at each
+    position, as small integers) are checkpointed: the forward pass keeps just the column at the start of
+    each block of blockLength positions (default sqrt(n)), and the traceback recomputes the back-pointers
+    (and the emissions) of one block at a time from its checkpoint. This runs the forward pass about twice,
+    but besides the path, memory is O(sqrt(n) * states) instead of O(n * states).
+    '''
+    (n, nStates) = emissions.shape
+    if blockLength is None:
+        blockLength = max(int(math.sqrt(n)), 1)
+    starts = range(0, n, blockLength)
+    back = numpy.zeros((min(blockLength, n), nStates), dtype=numpy.int8 if nStates <= 127 else numpy.int16)
+    transTo = transLogP.T.copy()                                                # row s: transitions into s
+    checkpoints = []
+    with numpy.errstate(over='ignore'):                                         # -sys.float_info.max + ... == -inf
+        V = startLogP + emissions[0:1][0]
+        for start in starts:
+            checkpoints.append(V)
+            V = forward(emissions[start:min(start + blockLength, n)], transTo, V, start, back)
+        path = numpy.empty(n, dtype=back.dtype)
+        path[-1] = V.argmax()
+        for block in xrange(len(starts) - 1, -1, -1):
+            (start, end) = (starts[block], min(starts[block] + blockLength, n))
+            if block < len(starts) - 1:                                         # the last block's are still in back
+                forward(emissions[start:end], transTo, checkpoints[block], start, back)
+            for t in xrange(end - 1, max(start, 1) - 1, -1):
+                path[t-1] = back[t - start, path[t]]
+    return (V[path[-1]], path)
+
+def forward(emissions, transTo, V, start, back):
+    '''
+    Viterbi columns of the block of positions beginning at start whose emissions are given, from the column
+    V before the block (or of position 0, when the block begins there); stores the back-pointers of position
+    t in back[t - start] and returns the last column.
+    '''
+    nStates = len(V)
+    rowStarts = numpy.arange(nStates) * nStates
+    scores = numpy.empty((nStates, nStates))
+    for t in xrange(max(start, 1) - start, len(emissions)):
+        numpy.add(transTo, V, out=scores)
+        best = scores.argmax(axis=1)
+        back[t] = best
+        V = scores.ravel()[rowStarts + best] + emissions[t]
+    return V
+
+def forward_backward(emissions, startLogP, transLogP, blockLength=None):
+    '''
+    Posterior state probabilities by the forward-backward algorithm, in O(n * states^2). emissions,
+    startLogP, transLogP and blockLength are as for viterbi_matrix(). The recursions stay in log space
+    except for the sum over predecessor (or successor) states, which is taken on probabilities shifted so
+    that the largest is 1, so neither very small emissions (e.g. the log of a 0 prediction) nor long
+    sequences underflow.
+    
+    The backward pass runs first and keeps just the backward column of the last position of each block;
+    the forward pass then recomputes the backward columns of one block at a time from its checkpoint, so
+    the posteriors come out in order, a block at a time, in O((sqrt(n) + blockLength) * states) memory.
+    Returns (log likelihood, iterator over the posteriors of consecutive blocks, as positions x states).
+    '''
+    (n, nStates) = emissions.shape
+    if blockLength is None:
+        blockLength = max(int(math.sqrt(n)), 1)
+    starts = range(0, n, blockLength)
+    trans = numpy.exp(transLogP)                                                # exp(-sys.float_info.max) == 0
+    checkpoints = [None] * len(starts)
+    logScale = 0.0                                                              # log backward probabilities are up to this
+    with numpy.errstate(divide='ignore', over='ignore'):
+        logBeta = numpy.zeros(nStates)
+        for block in xrange(len(starts) - 1, -1, -1):
+            (start, end) = (starts[block], min(starts[block] + blockLength, n))
+            checkpoints[block] = logBeta
+            blockEmissions = emissions[start:end]
+            for t in xrange(end - start - 1, max(1 - start, 0) - 1, -1):
+                (logBeta, shift) = backward(logBeta, blockEmissions[t], trans)
+                logScale += shift
+        a = startLogP + blockEmissions[0] + logBeta
+        shift = a.max()
+        logLikelihood = logScale + shift + math.log(numpy.exp(a - shift).sum())
+    return (logLikelihood, posterior_blocks(emissions, startLogP, trans, starts, checkpoints))
+
+def backward(logBeta, emissions, trans):
+    '''
+    Backward log probabilities of a position from those of the next position (logBeta) and its emissions;
+    returns them up to a constant, and that constant (relative to that of logBeta).
+    '''
+    b = logBeta + emissions
+    shift = b.max()
+    return (numpy.log(numpy.dot(trans, numpy.exp(b - shift))), shift)
+
+def posterior_blocks(emissions, startLogP, trans, starts, checkpoints):
+    '''Forward pass of forward_backward(): yields the posteriors of each block of positions from its starts.'''
+    (n, nStates) = emissions.shape
+    with numpy.errstate(divide='ignore', over='ignore'):
+        for block in xrange(len(starts)):
+            (start, end) = (starts[block], starts[block + 1] if block + 1 < len(starts) else n)
+            blockEmissions = emissions[start:end]
+            logBetas = numpy.empty((end - start, nStates))                      # up to a constant at each position
+            logBetas[-1] = checkpoints[block]
+            for t in xrange(end - start - 1, 0, -1):
+                logBetas[t-1] = backward(logBetas[t], blockEmissions[t], trans)[0]
+            posteriors = numpy.empty((end - start, nStates))                    # normalized forward log probabilities, then posteriors
+            for t in xrange(end - start):
+                if start + t:
+                    a = numpy.log(numpy.dot(alpha, trans)) + blockEmissions[t]
+                else:
+                    a = startLogP + blockEmissions[0]
+                shift = a.max()
+                alpha = numpy.exp(a - shift)
+                total = alpha.sum()
+                alpha /= total
+                posteriors[t] = a - (shift + math.log(total))
+            posteriors += logBetas
+            posteriors = numpy.exp(posteriors - posteriors.max(axis=1)[:, None])
+            posteriors /= posteriors.sum(axis=1)[:, None]
+            yield posteriors
+
+def to_bed(path, states, scaffold, offset, background):
+    '''BED lines (as one string) for the runs of non-background states in path, which begins at offset.'''
+    changes = numpy.flatnonzero(path[1:] != path[:-1]) + 1
+    starts = numpy.concatenate(([0], changes))
+    ends = numpy.concatenate((changes, [len(path)]))
+    lines = []
+    for (start, end, state) in zip(starts.tolist(), ends.tolist(), path[starts].tolist()):
+        if states[state] != background:
+            lines.append("\t".join((scaffold, str(start + offset), str(end + offset), states[state])) + "\n")
+    return "".join(lines)
+
+class BedGraphWriter():
+    '''
+    Writes values given a block of consecutive positions at a time, beginning at offset, as bedGraph lines
+    rounded to precision decimals, one line per run of equal values, also across blocks. Runs of 0 are
+    written too, so that bedgraph_to_bed.py does not join the runs on either side of them.
+    '''
+    
+    def __init__(self, outfile, scaffold, offset, precision=3):
+        self.outfile = outfile
+        self.scaffold = scaffold
+        self.end = offset                                                       # end of the values so far
+        self.precision = precision
+        self.lineFormat = "%%s\t%%d\t%%d\t%%.%df\n" % precision
+        self.run = None                                                         # (start, value) of the last run, not yet written
+    
+    def write(self, values):
+        if len(values) == 0:
+            return
+        values = numpy.round(values, self.precision)
+        starts = numpy.concatenate(([0], numpy.flatnonzero(values[1:] != values[:-1]) + 1))
+        runs = zip((starts + self.end).tolist(), values[starts].tolist())
+        if self.run is not None:
+            runs[0:1] = [self.run] if self.run[1] == runs[0][1] else [self.run, runs[0]]
+        self.end += len(values)
+        self.outfile.write("".join([self.lineFormat % (self.scaffold, start, end, value)
+                                    for ((start, value), (end, nextValue)) in zip(runs[:-1], runs[1:])]))
+        self.run = runs[-1]
+    
+    def close(self):
+        if self.run is not None:
+            self.outfile.write(self.lineFormat % (self.scaffold, self.run[0], self.end, self.run[1]))
+            self.run = None
+
+def write_posteriors(model, emissions, scaffold, offset, precision, trackFiles):
+    '''Write the posterior bedGraph track of each state of a segment to trackFiles, a block at a time.'''
+    tracks = [BedGraphWriter(trackFile, scaffold, offset, precision) for trackFile in trackFiles]
+    (logLikelihood, blocks) = model.posteriors(emissions)
+    for posteriors in blocks:
+        for (s, track) in enumerate(tracks):
+            track.write(posteriors[:, s])
+    for track in tracks:
+        track.close()
+
+def decode_segment(task, trackFiles=None):
+    '''
+    Decode one segment of predictions: task = (model, columns, scaffold, start, probabilities, background,
+    precision). Returns its BED lines and, unless precision is None, writes its posterior bedGraph lines to
+    trackFiles (one per state of model.states) or, without them (in a worker process), to temporary files
+    whose names are returned.
+    '''
+    (model, columns, scaffold, start, probabilities, background, precision) = task
+    emissions = model.emissions(probabilities, columns)
+    (prob, path) = model.decode(emissions)
+    bed = to_bed(path, model.states, scaffold, start, background)
+    if precision is None:
+        return (bed, None)
+    if trackFiles is not None:
+        write_posteriors(model, emissions, scaffold, start, precision, trackFiles)
+        return (bed, None)
+    trackFiles = [tempfile.NamedTemporaryFile('w', suffix='.bedGraph', delete=False) for s in model.states]
+    try:
+        write_posteriors(model, emissions, scaffold, start, precision, trackFiles)
+    except:
+        for trackFile in trackFiles:
+            trackFile.close()
+            os.remove(trackFile.name)
+        raise
+    for trackFile in trackFiles:
+        trackFile.close()
+    return (bed, [trackFile.name for trackFile in trackFiles])
+
+def decode_segments(model, columns, segments, background, outfile, cpus=1, trackFiles=None, precision=3):
+    '''
+    Decode segments (scaffold, start, probabilities) independently and write their BED lines in order,
+    and, given trackFiles (one per state of model.states), their posterior bedGraph tracks.
+    With cpus > 1, up to cpus segments at a time are decoded on a process pool.
+    '''
+    if trackFiles is None:
+        precision = None
+    tasks = ((model, columns, scaffold, start, probabilities, background, precision)
+             for (scaffold, start, probabilities) in segments)
+    def write(result):
+        (bed, tracks) = result
+        outfile.write(bed)
+        for (trackFile, track) in zip(trackFiles or [], tracks or []):
+            with open(track) as temporary:
+                shutil.copyfileobj(temporary, trackFile)
+            os.remove(track)
+    if cpus <= 1:
+        for task in tasks:
+            write(decode_segment(task, trackFiles))
+        return
+    pool = multiprocessing.Pool(cpus)
+    try:
+        batch = list(itertools.islice(tasks, cpus))
+        while batch:
+            for result in pool.map(decode_segment, batch):
+                write(result)
+            batch = list(itertools.islice(tasks, cpus))
+        pool.close()
+    except:
+        pool.terminate()
+        raise
+    finally:
+        pool.join()
+
 # Print a table of the steps.
 def print_dptable(V):
     s = "         " + " ".join(("%8d" % i) for i in range(len(V))) + "\n"
@@ -76,6 +342,21 @@ def parse_cl():
     parser.add_argument('--stateX', type=float, default=1.0,
         help='Factor to reduce influence of state probabilities. Range [0,1].'
             'State probabilities remain unadjusted at stateX=0 and approach 1 at stateX=1. [default: 0.0].')
+    parser.add_argument('--data', type=str, default=None,
+        help='Data file (chromosome,position,...; may be gzipped) from which the predictions were made, '
+            'giving the position of each prediction. Each scaffold (and each run of consecutive positions) '
+            'is decoded separately. Without it, all predictions are one sequence starting at --scaffold:--start.')
+    parser.add_argument('--scaffold', type=str, default='scaffold_1',
+        help='Scaffold of the predictions when there is no --data file [default: scaffold_1]')
+    parser.add_argument('--start', type=int, default=0,
+        help='0-based position of the first prediction when there is no --data file [default: 0]')
+    parser.add_argument('--cpus', type=int, default=1,
+        help='Number of scaffolds to decode in parallel [default: 1]')
+    parser.add_argument('--posteriors', type=str, default=None,
+        help='Also write per-base posterior state probabilities (forward-backward) as BedGraph tracks '
+            '<POSTERIORS>.<state>.bedGraph')
+    parser.add_argument('--precision', type=int, default=3,
+        help='Decimals of the posterior probabilities in the BedGraph tracks [default: 3]')
     return parser.parse_args()
 
 if __name__ == '__main__':
@@ -98,7 +379,7 @@ if __name__ == '__main__':
     STATES = ("None", "DNA", "LINE", "LTR", "SINE", "Unknown", "Simple", "Low")
     for s in STATES:
         stateP.append(statePTable[s])
-    print stateP
+    print >>sys.stderr, stateP
     
     transPTable = {}
     for i in states:
@@ -115,12 +396,12 @@ if __name__ == '__main__':
             None
     #print(sum(map(math.exp, transPTable[bedStats.bgState].values())))
     
-    print
+    print >>sys.stderr
     for i in STATES:
         transPi = []
         for j in STATES:
             transPi.append(transPTable[i][j])
-        print transPi    
+        print >>sys.stderr, transPi    
     None
     
     
@@ -142,42 +423,17 @@ if __name__ == '__main__':
     #print
     
     adjustment = math.log( 1.0 / bedStats.scafSizes.genomeSize )
-    print
-    print adjustment
+    print >>sys.stderr
+    print >>sys.stderr, adjustment
     None
     
-    predReader = WekaPredictionsReader(args.predictionsFile, args.states)
-    predictions = predReader.log_table()
-    
-
-    
-    def example():
-        return viterbi(predictions,
-                       states,
-                       startPTable,
-                       statePTable,
-                       transPTable,
-                       adjustment)
-    
-    result = example()
-    
-    #print result[0]
-    #i = 700001
-    #for s in result[1]:
-    #    print("{}: {}".format(i, s))
-    #    i += 1
-    
-    def to_bed(result, scaf, offset, background):
-        prevState = result[0]
-        left = 0
-        for i in range(0, len(result)-1):
-            i += 1
-            if result[i] != prevState:
-                if prevState != background:
-                    print( "\t".join((scaf, str(left+offset), str(i+offset), prevState)))
-                prevState = result[i]
-                left = i
-        if prevState != background:
-            print( "\t".join(scaf, left+offset, i+offset, prevState))
-    to_bed(result[1], 'scaffold_1', 10700002, 'None')
-    
\ No newline at end of file
+    predStream = WekaPredictionsStream(args.predictionsFile, args.states, args.data, args.scaffold, args.start)
+    model = Model(states, startPTable, statePTable, transPTable, adjustment)
+    columns = [predStream.states.index(s) for s in model.states]
+    trackFiles = None
+    if args.posteriors is not None:
+        trackFiles = [open(args.posteriors + '.' + s + '.bedGraph', 'w') for s in model.states]
+    decode_segments(model, columns, predStream.segments(), args.background, sys.stdout, args.cpus,
+                    trackFiles, args.precision)
+    for trackFile in trackFiles or []:
+        trackFile.close()
@@ -1,31 +1,33 @@
 #!/usr/bin/env python
 
 # Make a BED track of the position of all N's in the assembly.
+# N runs are read from the packed sequence store (PIATEA/packed_seq.py), so only the N regions
+# themselves are decoded rather than every base of the assembly.
 
 import sys
+import os
+import re
 import argparse
-from Bio import SeqIO
+sys.path.append(os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'PIATEA'))
+import packed_seq
 
 desc='Make a BED file with the positions of all Ns in the supplied FASTA file.'
 argParser = argparse.ArgumentParser(description=desc)
-argParser.add_argument('-i', '--infile', nargs='?', type=argparse.FileType('r'),              
-                    default=sys.stdin, help='FASTA input file [default: STDIN]')
+argParser.add_argument('-i', '--infile', required=True,
+                    help='FASTA input file (a packed copy, [infile].pseq, is made if needed)')
 argParser.add_argument('-o', '--outfile', nargs='?', type=argparse.FileType('w'),             
                     default=sys.stdout, help='BED output file [default: STDOUT]')
 args = argParser.parse_args()
 
 out = args.outfile
-for record in SeqIO.parse(args.infile, "fasta"):
+for record in packed_seq.open_fasta(args.infile):
     locations = []
-    start = -1
-    for index, letter in enumerate(record):
-        if 'N' == letter and start < 0:
-            start = index
-        if start >= 0:
-            if 'N' != letter:
-                locations.append([start, index-1])
-                start = -1
+    for (start, end, letter) in record.exception_runs():
+        if letter != 'N':
+            continue
+        for match in re.finditer('N+', record.fetch(start, end)):                # soft-masked n's are not N's
+            if start + match.end() < len(record):                               # a run must be followed by another letter
+                locations.append([start + match.start(), start + match.end() - 1])
     out.write("track name=Ns description=\"Ns\" \n");
     for location in locations:
         out.write("{0}\t{1}\t{2}\n".format(record.id, location[0], location[1]))
-